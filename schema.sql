@@ -20,13 +20,56 @@ CREATE TABLE IF NOT EXISTS media (
    longitude   REAL DEFAULT NULL,    -- in degrees
    make        TEXT DEFAULT NULL,    -- make of the camera (NULL if unknown or N/A)
    model       TEXT DEFAULT NULL,    -- model of the camera (NULL if unknown or N/A)
-   sha256      TEXT NOT NULL,        -- SHA256 checksum for the file
-   thumbnail   BYTEA NOT NULL        -- Thumbnail of the media
+   sha256      TEXT DEFAULT NULL,    -- SHA256 checksum for the file (NULL until calculated)
+   fingerprint TEXT DEFAULT NULL,    -- Hash of the size, first, middle and last blocks of the file
+   thumbnail   BYTEA NOT NULL,       -- Thumbnail of the media
+   phash       INT8 DEFAULT NULL,    -- Perceptual hash (dHash) of the thumbnail
+   thumbnail_format   TEXT NOT NULL DEFAULT 'jpeg',  -- Image format of the thumbnails (jpeg or webp)
+   thumbnail_sizes    INT4[] NOT NULL DEFAULT '{}',  -- Sizes of the extra thumbnails, smallest first
+   thumbnails         BYTEA[] NOT NULL DEFAULT '{}', -- Thumbnail for each size (NULL for the size in thumbnail)
+   storyboard         BYTEA DEFAULT NULL,            -- Sprite sheet of evenly spaced video keyframes
+   storyboard_columns INT4 DEFAULT NULL,             -- Number of frames in each row of the storyboard
+   storyboard_times   INT4[] NOT NULL DEFAULT '{}',  -- Time of each storyboard frame in milliseconds
+   quadkey            INT8 DEFAULT NULL              -- Quadkey of the location's tile at zoom 24 (NULL if no location)
 );
+ALTER TABLE media ALTER COLUMN sha256 DROP NOT NULL;
+ALTER TABLE media ADD COLUMN IF NOT EXISTS fingerprint TEXT DEFAULT NULL;
+ALTER TABLE media ADD COLUMN IF NOT EXISTS phash INT8 DEFAULT NULL;
+ALTER TABLE media ADD COLUMN IF NOT EXISTS thumbnail_format TEXT NOT NULL DEFAULT 'jpeg';
+ALTER TABLE media ADD COLUMN IF NOT EXISTS thumbnail_sizes INT4[] NOT NULL DEFAULT '{}';
+ALTER TABLE media ADD COLUMN IF NOT EXISTS thumbnails BYTEA[] NOT NULL DEFAULT '{}';
+ALTER TABLE media ADD COLUMN IF NOT EXISTS storyboard BYTEA DEFAULT NULL;
+ALTER TABLE media ADD COLUMN IF NOT EXISTS storyboard_columns INT4 DEFAULT NULL;
+ALTER TABLE media ADD COLUMN IF NOT EXISTS storyboard_times INT4[] NOT NULL DEFAULT '{}';
+ALTER TABLE media ADD COLUMN IF NOT EXISTS quadkey INT8 DEFAULT NULL;
 CREATE INDEX IF NOT exists media_path_idx ON media(path);
 CREATE INDEX IF NOT exists media_type_idx ON media(type);
 CREATE INDEX IF NOT exists media_timestamp_idx ON media(timestamp);
 CREATE INDEX IF NOT exists media_camera_idx ON media(make, model);
+CREATE INDEX IF NOT exists media_sha256_idx ON media(sha256);
+CREATE INDEX IF NOT exists media_fingerprint_idx ON media(fingerprint);
+CREATE INDEX IF NOT exists media_quadkey_idx ON media(quadkey);
+
+/* Summary tables, updated in the same transaction as every insert or delete of media */
+CREATE TABLE IF NOT EXISTS media_day (
+   day         DATE PRIMARY KEY,     -- day in TIMEZONE
+   count       INT8 NOT NULL         -- number of media on the day
+);
+CREATE TABLE IF NOT EXISTS media_facet (
+   type        TEXT NOT NULL,        -- mime type
+   make        TEXT NOT NULL,        -- make of the camera ('' if unknown or N/A)
+   model       TEXT NOT NULL,        -- model of the camera ('' if unknown or N/A)
+   count       INT8 NOT NULL,        -- number of media with the type, make and model
+   PRIMARY KEY (type, make, model)
+);
+
+/* A table of files that hung or crashed the decoder, which are skipped until they change */
+CREATE TABLE IF NOT EXISTS quarantine (
+   path        TEXT PRIMARY KEY,     -- path relative to root level
+   size        INT8 NOT NULL,        -- file size (in bytes) when it was quarantined
+   reason      TEXT NOT NULL,        -- why the file was quarantined
+   time        TIMESTAMPTZ NOT NULL DEFAULT now()
+);
 
 /* A table for storing running processes and progress */
 CREATE TABLE IF NOT EXISTS progress (
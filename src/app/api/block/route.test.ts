@@ -35,6 +35,7 @@ describe('api/block', () => {
       expect(response.status).toBe(200);
       expect(response.body).toBeDefined();
       expect(response.body).toEqual([1, 2, 3]);
+      expect(db.query).toHaveBeenLastCalledWith(expect.not.stringContaining('media_day'), ['10', '20']);
    });
 
    it('should return a valid response when not given filters', async () => {
@@ -49,6 +50,7 @@ describe('api/block', () => {
       expect(response.status).toBe(200);
       expect(response.body).toBeDefined();
       expect(response.body).toEqual([4, 5, 6]);
+      expect(db.query).toHaveBeenLastCalledWith(expect.stringContaining('FROM media_day'));
    });
 
    it('should return a 500 error on database errors', async () => {
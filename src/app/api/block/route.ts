@@ -14,12 +14,25 @@ export const GET = async (request: NextRequest) => {
    const [filters, bindings] = searchParamsToSQL(searchParams);
 
    try {
+      if (filters === '') {
+         // Without filters, the counts for each day are kept up to date by the processor
+         const result = await db.query(
+            `
+            SELECT TO_CHAR(day, 'YYYY-MM-DD') AS heading, CAST(count AS INTEGER), CAST(SUM(count) OVER (ORDER BY day DESC) AS INTEGER) AS total
+            FROM media_day
+            WHERE count > 0
+            ORDER BY day DESC
+            `
+         );
+         return NextResponse.json(result.rows);
+      }
+
       const result = await db.query(
          `
          WITH GroupedData AS (
             SELECT TO_CHAR(TO_TIMESTAMP(timestamp) AT TIME ZONE '${process.env['TIMEZONE']}', 'YYYY-MM-DD') AS heading, COUNT(*) AS count
             FROM media
-            ${filters !== '' ? `WHERE ${filters}` : ''}
+            WHERE ${filters}
             GROUP BY heading
          )
          SELECT heading, CAST(count AS INTEGER), CAST(SUM(count) OVER (ORDER BY heading DESC) AS INTEGER) AS total
@@ -34,6 +34,7 @@ describe('api/searchOptions', () => {
       expect(response.status).toBe(200);
       expect(response.body).toBeDefined();
       expect(response.body).toEqual(['foo', 'bar']);
+      expect(db.query).toHaveBeenLastCalledWith(expect.objectContaining({ text: expect.stringContaining('FROM media_facet') }));
    });
 
    it('should return a valid response for make,model field', async () => {
@@ -16,7 +16,8 @@ export const GET = async (request: NextRequest) => {
       return NextResponse.json({ message: `Invalid field: ${field}` }, { status: 400 });
    }
    try {
-      const result = await db.query({ text: `SELECT DISTINCT ${field} AS option FROM media`, rowMode: 'array' });
+      // The facets are kept up to date by the processor, so the media table isn't scanned
+      const result = await db.query({ text: `SELECT DISTINCT ${field} AS option FROM media_facet WHERE count > 0`, rowMode: 'array' });
       return NextResponse.json(result.rows.map((v) => v.join(' ')));
    } catch (e) {
       return NextResponse.json({ message: 'Database query failed' }, { status: 500 });
@@ -0,0 +1,57 @@
+/**
+ * MIT License
+ *
+ * Author: Josef Barnes
+ *
+ * Unit tests for api/storyboard/route.ts
+ */
+
+import '@testing-library/jest-dom';
+import { NextRequest } from 'next/server';
+import db from '@/database';
+import { GET } from './route';
+
+jest.mock('../../../database', () => ({
+   ...jest.requireActual('../../../database'),
+   __esModule: true,
+   default: {
+      query: jest.fn(),
+   },
+}));
+
+describe('api/storyboard', () => {
+   it('should return the storyboard and its layout for a valid id', async () => {
+      const request = {
+         nextUrl: {
+            searchParams: new URLSearchParams({
+               id: '123',
+            }),
+         },
+      };
+
+      (db.query as jest.Mock).mockResolvedValue({
+         rows: [{ storyboard: 'abc', storyboard_columns: 4, storyboard_times: [0, 2000, 4000], thumbnail_format: 'jpeg' }],
+      });
+      const response = await GET(request as NextRequest);
+      expect(response.status).toBe(200);
+      expect(response.body).toBeDefined();
+      expect(response.headers.get('Content-Type')).toEqual('image/jpeg');
+      expect(response.headers.get('X-Storyboard-Columns')).toEqual('4');
+      expect(response.headers.get('X-Storyboard-Times')).toEqual('0,2000,4000');
+   });
+
+   it('should return a 404 error if the media has no storyboard', async () => {
+      const request = {
+         nextUrl: {
+            searchParams: new URLSearchParams({
+               id: '123',
+            }),
+         },
+      };
+
+      (db.query as jest.Mock).mockResolvedValue({ rows: [] });
+      const response = await GET(request as NextRequest);
+      expect(response.status).toBe(404);
+      expect(response.body).toEqual({ message: 'Cannot find storyboard' });
+   });
+});
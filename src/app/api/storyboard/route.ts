@@ -0,0 +1,31 @@
+/**
+ * MIT License
+ *
+ * Author: Josef Barnes
+ *
+ * The route to download a video storyboard
+ */
+
+import { NextRequest, NextResponse } from 'next/server';
+import db from '@/database';
+
+export const GET = async (request: NextRequest) => {
+   const searchParams = request.nextUrl.searchParams;
+   const id = +(searchParams.get('id') || 0);
+
+   try {
+      const result = await db.query('SELECT storyboard, storyboard_columns, storyboard_times, thumbnail_format FROM media WHERE id = $1 AND storyboard IS NOT NULL', [id]);
+      const row = result.rows[0];
+      return new NextResponse(row['storyboard'], {
+         status: 200,
+         headers: {
+            'Content-Type': `image/${row['thumbnail_format'] || 'jpeg'}`,
+            'Cache-Control': 'max-age=86400',
+            'X-Storyboard-Columns': `${row['storyboard_columns']}`,
+            'X-Storyboard-Times': row['storyboard_times'].join(','),
+         },
+      });
+   } catch (e) {
+      return NextResponse.json({ message: 'Cannot find storyboard' }, { status: 404 });
+   }
+};
@@ -37,6 +37,23 @@ describe('api/thumb', () => {
       expect(response.headers.get('Cache-Control')).toEqual('max-age=86400');
    });
 
+   it('should return the closest thumbnail for a requested size', async () => {
+      const request = {
+         nextUrl: {
+            searchParams: new URLSearchParams({
+               id: '123',
+               size: '300',
+            }),
+         },
+      };
+
+      (db.query as jest.Mock).mockResolvedValue({ rows: [{ thumbnail: 'abc', thumbnail_format: 'webp' }] });
+      const response = await GET(request as NextRequest);
+      expect(response.status).toBe(200);
+      expect(db.query).toHaveBeenLastCalledWith(expect.stringContaining('UNNEST(m.thumbnail_sizes, m.thumbnails)'), [123, 300]);
+      expect(response.headers.get('Content-Type')).toEqual('image/webp');
+   });
+
    it('should return a 404 error on database errors', async () => {
       const request = {
          nextUrl: {
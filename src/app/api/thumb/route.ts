@@ -12,14 +12,31 @@ import db from '@/database';
 export const GET = async (request: NextRequest) => {
    const searchParams = request.nextUrl.searchParams;
    const id = +(searchParams.get('id') || 0);
+   const size = +(searchParams.get('size') || 0);
 
    try {
-      const result = await db.query('SELECT thumbnail FROM media WHERE id = $1', [id]);
+      /* Pick the smallest thumbnail at least as big as the requested size, or the largest if none are */
+      const result = size
+         ? await db.query(
+              `
+              SELECT COALESCE(t.data, m.thumbnail) AS thumbnail, m.thumbnail_format
+              FROM media m
+              LEFT JOIN LATERAL (
+                 SELECT u.data
+                 FROM UNNEST(m.thumbnail_sizes, m.thumbnails) AS u(size, data)
+                 ORDER BY u.size < $2, ABS(u.size - $2)
+                 LIMIT 1
+              ) t ON TRUE
+              WHERE m.id = $1
+              `,
+              [id, size]
+           )
+         : await db.query('SELECT thumbnail, thumbnail_format FROM media WHERE id = $1', [id]);
       const image = result.rows[0]['thumbnail'];
       return new NextResponse(image, {
          status: 200,
          headers: {
-            'Content-Type': 'image/jpeg',
+            'Content-Type': `image/${result.rows[0]['thumbnail_format'] || 'jpeg'}`,
             'Cache-Control': 'max-age=86400',
          },
       });
@@ -0,0 +1,385 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Benchmarks for the media processing pipeline
+#
+
+'''
+Benchmarks for the media processing pipeline.
+Each benchmark is a sub-command that runs against a list of real files or
+directories (directories are searched recursively), and prints a table of
+results to stdout. For example:
+
+python3 src/py/benchmark.py hashing /path/to/media
+
+Cold cache runs drop each file from the page cache before it is read, so
+they measure the disk rather than memory.
+
+The importtime benchmark measures the startup cost of the scripts instead,
+and exits with an error if it is over a budget, eg.
+
+python3 src/py/benchmark.py importtime --budget 400
+'''
+
+# System Imports
+import os
+import sys
+import time
+import hashlib
+import argparse
+import subprocess
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+# 3rd Party Imports
+import av
+from PIL import Image, ImageOps
+
+# Local Imports
+from media.hashing import HashEngine
+from media.util import decode_exif, extract_exif, resize_thumbnails, encode_thumbnail, generate_storyboard
+
+
+def find_files(paths: List[str]) -> List[Path]:  # pragma: no cover
+    '''
+    Expand a list of files and directories to a sorted list of files
+
+    Args:
+        paths: The files/directories to expand
+
+    Returns:
+        The list of files
+    '''
+    files = set()
+    for path in map(Path, paths):
+        if path.is_file():
+            files.add(path)
+        else:
+            files |= {f for f in path.rglob('*') if f.is_file()}
+    return sorted(files)
+
+
+def drop_cache(path: Path):  # pragma: no cover
+    '''
+    Drop a file from the page cache
+
+    Args:
+        path: The file to drop
+    '''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fdatasync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def warm_cache(path: Path):  # pragma: no cover
+    '''
+    Read a file into the page cache
+
+    Args:
+        path: The file to read
+    '''
+    with open(path, 'rb') as fp:
+        while fp.read(1024 * 1024):
+            pass
+
+
+def legacy_sha256(path: Path) -> str:  # pragma: no cover
+    '''
+    The original checksum loop: a fixed 128 KiB readinto buffer with no
+    access pattern hints.
+
+    Args:
+        path: The file to checksum
+
+    Returns:
+        The hex encoded sha256 digest
+    '''
+    sha = hashlib.sha256()
+    buf = bytearray(128 * 1024)
+    mv = memoryview(buf)
+    with open(path, 'rb', buffering=0) as fp:
+        while nbytes := fp.readinto(mv):
+            sha.update(mv[:nbytes])
+    return sha.hexdigest()
+
+
+def time_files(func: Callable[[List[Path]], object], files: List[Path], cold: bool) -> float:  # pragma: no cover
+    '''
+    Time a function over a list of files
+
+    Args:
+        func:  The function to time, called with the full list of files
+        files: The files to pass to the function
+        cold:  Drop the files from the page cache first, rather than warming it
+
+    Returns:
+        The elapsed wall clock time in seconds
+    '''
+    for f in files:
+        drop_cache(f) if cold else warm_cache(f)
+    start = time.perf_counter()
+    func(files)
+    return time.perf_counter() - start
+
+
+def bench_hashing(args: argparse.Namespace):  # pragma: no cover
+    '''
+    Compare the original checksum loop against the hash engine
+
+    Args:
+        args: The command line arguments
+    '''
+    files = find_files(args.paths)
+    total = sum(f.stat().st_size for f in files)
+    engines = {
+        'legacy': lambda fs: [legacy_sha256(f) for f in fs],
+        'engine-read': lambda fs: [HashEngine(mmap_threshold=0, drop_cache=False).sha256(f) for f in fs],
+        'engine-mmap': lambda fs: [HashEngine(mmap_threshold=1, drop_cache=False).sha256(f) for f in fs],
+        f'engine-x{args.ncpu}': lambda fs: HashEngine(drop_cache=False).hash_files(fs, args.ncpu),
+    }
+
+    print(f'{len(files)} files, {total / 1e6:.1f} MB')
+    print(f'{"method":<16} {"cache":<6} {"seconds":>10} {"MB/s":>10}')
+    for cold in [True, False]:
+        for name, func in engines.items():
+            elapsed = min(time_files(func, files, cold) for _ in range(args.repeat))
+            print(f'{name:<16} {"cold" if cold else "warm":<6} {elapsed:>10.3f} {total / 1e6 / elapsed:>10.1f}')
+
+
+def bench_exif(args: argparse.Namespace):  # pragma: no cover
+    '''
+    Compare the CPU time of decoding all EXIF tags against extracting only
+    the tags that are used
+
+    Args:
+        args: The command line arguments
+    '''
+    files = find_files(args.paths)
+    decoders = {'decode_exif': decode_exif, 'extract_exif': extract_exif}
+    cpu = {name: 0.0 for name in decoders}
+    count = 0
+    for f in files:
+        try:
+            raw = Image.open(f).info.get('exif')
+        except Exception:
+            continue
+        if raw is None:
+            continue
+        count += 1
+        for name, decoder in decoders.items():
+            best = float('inf')
+            for _ in range(args.repeat):
+                exif = Image.Exif()
+                start = time.process_time()
+                exif.load(raw)
+                decoder(exif)
+                best = min(best, time.process_time() - start)
+            cpu[name] += best
+
+    print(f'{count} images with EXIF data')
+    print(f'{"method":<16} {"us/image":>10}')
+    for name, total in cpu.items():
+        print(f'{name:<16} {1e6 * total / max(count, 1):>10.1f}')
+    if cpu['decode_exif'] > 0:
+        print(f'CPU saved per image: {1e6 * (cpu["decode_exif"] - cpu["extract_exif"]) / count:.1f} us ({100 * (1 - cpu["extract_exif"] / cpu["decode_exif"]):.0f}%)')
+
+
+def bench_thumbnails(args: argparse.Namespace):  # pragma: no cover
+    '''
+    Measure the time to build a thumbnail pyramid with successive
+    downscales against resizing the full image for each size, and the
+    encode time and size of each thumbnail format
+
+    Args:
+        args: The command line arguments
+    '''
+    files = find_files(args.paths)
+    sizes = sorted(args.sizes)
+    resize = {'successive': 0.0, 'independent': 0.0}
+    encode: Dict[Tuple[str, int], List[float]] = {(f, s): [0.0, 0.0] for f in args.formats for s in sizes}
+    count = 0
+    for f in files:
+        try:
+            img = ImageOps.exif_transpose(Image.open(f))
+            img.load()
+        except Exception:
+            continue
+        count += 1
+
+        start = time.process_time()
+        thumbs = resize_thumbnails(img, sizes)
+        resize['successive'] += time.process_time() - start
+        start = time.process_time()
+        for size in sizes:
+            resize_thumbnails(img, [size])
+        resize['independent'] += time.process_time() - start
+
+        for format in args.formats:
+            for size in sizes:
+                start = time.process_time()
+                data = encode_thumbnail(thumbs[size], format, args.quality)
+                encode[(format, size)][0] += time.process_time() - start
+                encode[(format, size)][1] += len(data)
+
+    print(f'{count} images, sizes {sizes}, quality {args.quality}')
+    print(f'{"resize":<16} {"ms/image":>10}')
+    for name, total in resize.items():
+        print(f'{name:<16} {1e3 * total / max(count, 1):>10.2f}')
+    print(f'{"format":<8} {"size":>6} {"ms/image":>10} {"KB/image":>10}')
+    for (format, size), (total, nbytes) in encode.items():
+        print(f'{format:<8} {size:>6} {1e3 * total / max(count, 1):>10.2f} {nbytes / 1024 / max(count, 1):>10.1f}')
+
+
+def bench_storyboard(args: argparse.Namespace):  # pragma: no cover
+    '''
+    Measure the cost of generating video storyboards per minute of video,
+    against decoding only the first frame (as the thumbnail does)
+
+    Args:
+        args: The command line arguments
+    '''
+    files = find_files(args.paths)
+    print(f'{"file":<32} {"minutes":>8} {"frames":>7} {"KB":>8} {"first ms":>9} {"board ms":>9} {"ms/min":>8}')
+    total_minutes = 0.0
+    total_elapsed = 0.0
+    for f in files:
+        try:
+            with av.open(str(f)) as container:
+                minutes = container.duration / av.time_base / 60
+                start = time.perf_counter()
+                next(container.decode(video=0)).to_image()
+                first = time.perf_counter() - start
+            start = time.perf_counter()
+            data, _, times = generate_storyboard(str(f), args.frames, args.size)
+            elapsed = time.perf_counter() - start
+        except Exception:
+            continue
+        total_minutes += minutes
+        total_elapsed += elapsed
+        print(f'{f.name[-32:]:<32} {minutes:>8.2f} {len(times):>7} {len(data) / 1024:>8.1f} {1e3 * first:>9.1f} {1e3 * elapsed:>9.1f} {1e3 * elapsed / max(minutes, 1e-6):>8.1f}')
+    if total_minutes > 0:
+        print(f'Overall: {1e3 * total_elapsed / total_minutes:.1f} ms per minute of video')
+
+
+# The modules imported at startup by each script
+STARTUP_MODULES = ['media.media_processor', 'media.cache', 'media.database', 'media.logger', 'media.sync_index', 'media.copier']
+
+# The decoding libraries that shouldn't be imported until a file is decoded
+DEFERRED_MODULES = ['av', 'ffmpeg', 'numpy', 'PIL', 'pillow_heif', 'rawpy']
+
+
+def import_times(modules: List[str]) -> Tuple[float, Dict[str, float], List[str]]:  # pragma: no cover
+    '''
+    Import modules in a new interpreter with -X importtime
+
+    Args:
+        modules: The modules to import
+
+    Returns:
+        A tuple of the total import time in ms, the cumulative time in ms of
+        every module that was imported, and the deferred modules that were
+        imported
+    '''
+    code = f'import sys, {", ".join(modules)}; print(" ".join(m for m in {DEFERRED_MODULES!r} if m in sys.modules))'
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=Path(__file__).parent, capture_output=True, text=True, check=True)
+    times: Dict[str, float] = {}
+    total = 0.0
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        times[name.strip()] = int(cumulative) / 1000
+        if not name.startswith('  '):
+            # Top level imports (including the interpreter's own startup)
+            total += int(cumulative) / 1000
+    return total, times, result.stdout.split()
+
+
+def bench_importtime(args: argparse.Namespace):  # pragma: no cover
+    '''
+    Measure the time to import the modules the scripts need at startup, and
+    check it against a budget
+
+    Args:
+        args: The command line arguments
+
+    Returns:
+        0 if within the budget, otherwise 1
+    '''
+    runs = [import_times(args.modules) for _ in range(args.repeat)]
+    total, times, deferred = min(runs, key=lambda r: r[0])
+    print(f'{"module":<40} {"ms":>8}')
+    for name, ms in sorted(times.items(), key=lambda t: t[1], reverse=True)[:args.top]:
+        print(f'{name[-40:]:<40} {ms:>8.1f}')
+    print(f'Total import time: {total:.1f} ms (budget {args.budget:.0f} ms)')
+    failed = total > args.budget
+    if deferred:
+        print(f'Decoding libraries imported at startup: {", ".join(deferred)}')
+        failed = True
+    return 1 if failed else 0
+
+
+def parse_args():  # pragma: no cover
+    '''
+    Parse the command line arguments
+
+    Returns:
+        The parsed arguments
+    '''
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    subparsers = parser.add_subparsers(required=True)
+
+    hashing = subparsers.add_parser('hashing', help='Compare checksum implementations on cold and warm caches')
+    hashing.add_argument('-n', '--ncpu', type=int, default=2, help='Number of threads for the parallel engine')
+    hashing.add_argument('-r', '--repeat', type=int, default=3, help='Number of times to repeat each run')
+    hashing.add_argument('paths', nargs='+', help='Files or directories to hash')
+    hashing.set_defaults(func=bench_hashing)
+
+    exif = subparsers.add_parser('exif', help='Compare the CPU time of full and selective EXIF decoding')
+    exif.add_argument('-r', '--repeat', type=int, default=5, help='Number of times to repeat each decode')
+    exif.add_argument('paths', nargs='+', help='Image files or directories to decode')
+    exif.set_defaults(func=bench_exif)
+
+    thumbnails = subparsers.add_parser('thumbnails', help='Compare thumbnail pyramid resize strategies, and the encode time and size of each format')
+    thumbnails.add_argument('-f', '--formats', nargs='+', default=['jpeg', 'webp'], help='Thumbnail formats to encode')
+    thumbnails.add_argument('-q', '--quality', type=int, default=75, help='Encoder quality (0-100)')
+    thumbnails.add_argument('-s', '--sizes', nargs='+', type=int, default=[128, 256, 512], help='Thumbnail sizes to generate')
+    thumbnails.add_argument('paths', nargs='+', help='Image files or directories to thumbnail')
+    thumbnails.set_defaults(func=bench_thumbnails)
+
+    storyboard = subparsers.add_parser('storyboard', help='Measure the cost of video storyboards per minute of video')
+    storyboard.add_argument('-f', '--frames', type=int, default=16, help='Number of frames in each storyboard')
+    storyboard.add_argument('-s', '--size', type=int, default=160, help='Width of each frame in pixels')
+    storyboard.add_argument('paths', nargs='+', help='Video files or directories')
+    storyboard.set_defaults(func=bench_storyboard)
+
+    importtime = subparsers.add_parser('importtime', help='Measure the startup import time against a budget')
+    importtime.add_argument('-b', '--budget', type=float, default=500, help='The maximum total import time, in ms')
+    importtime.add_argument('-r', '--repeat', type=int, default=5, help='Number of times to repeat the import (the fastest is used)')
+    importtime.add_argument('-t', '--top', type=int, default=15, help='Number of the slowest modules to list')
+    importtime.add_argument('modules', nargs='*', default=STARTUP_MODULES, help='The modules to import')
+    importtime.set_defaults(func=bench_importtime)
+
+    return parser.parse_args()
+
+
+def main(args: argparse.Namespace):  # pragma: no cover
+    '''
+    Main function.
+
+    Args:
+        args: The command line arguments
+    '''
+    return args.func(args) or 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main(parse_args()))
@@ -0,0 +1,98 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# The script to list clusters of near duplicate media
+#
+
+'''
+List clusters of near duplicate media.
+This finds media whose thumbnails have perceptual hashes within a hamming
+distance of each other (eg. resized or re-encoded copies of the same photo)
+and prints each cluster as a group of paths. It gets the connection
+information for the database from the env file passed in to the -e flag.
+The following must be set in the env file:
+
+PGHOST - host of the postgres database
+PGUSER - The user to connect as
+PGDATABASE - The database to connect to
+TIMEZONE - Name of the timezone to use
+'''
+
+# System Imports
+import sys
+import json
+import argparse
+from pathlib import Path
+
+# 3rd Party Imports
+from dotenv import load_dotenv
+
+# Local Imports
+from media.phash import PhashIndex, MAX_DISTANCE
+from media.logger import logger, init_logger
+from media.database import db
+
+
+def parse_args():  # pragma: no cover
+    '''
+    Parse the command line arguments
+
+    Returns:
+        The parsed arguments
+    '''
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('-d', '--debug', action='store_true', help='Enable debug logging')
+    parser.add_argument('-e', '--env', required=True, type=str, help='Path to .env file')
+    parser.add_argument('-j', '--json', action='store_true', help='Print each cluster as a JSON list of paths')
+    parser.add_argument('-t', '--threshold', type=int, default=4, help=f'Maximum hamming distance between near duplicates (0-{MAX_DISTANCE})')
+
+    args = parser.parse_args()
+
+    if not Path(args.env).exists():
+        parser.error(f'{args.env} not found')
+    if not 0 <= args.threshold <= MAX_DISTANCE:
+        parser.error(f'Invalid threshold: {args.threshold}')
+
+    return args
+
+
+def main(args: argparse.Namespace):  # pragma: no cover
+    '''
+    Main function.
+
+    Args:
+        args: The command line arguments
+    '''
+    if args.env:
+        load_dotenv(args.env)
+
+    init_logger(None, args.debug)
+
+    with db.open():
+        rows = db.get_phashes()
+
+    logger.info(f'Indexing {len(rows)} perceptual hashes')
+    paths = {id: path for id, path, _ in rows}
+    index = PhashIndex((r[0] for r in rows), (r[2] for r in rows), args.threshold)
+    clusters = index.clusters()
+    logger.info(f'Found {len(clusters)} clusters of near duplicates')
+
+    for cluster in clusters:
+        if args.json:
+            print(json.dumps([paths[id] for id in cluster]))
+        else:
+            print('\n'.join(paths[id] for id in cluster) + '\n')
+
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    try:
+        sys.exit(main(parse_args()))
+    except Exception as exc:  # pylint: disable=broad-except
+        logger.exception(exc, exc_info=True)
@@ -0,0 +1,77 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Memory admission control for decoding
+#
+
+'''
+Memory admission control for decoding. The thread count alone doesn't bound
+the memory used by the decoders, since one 100MP panorama needs as much as
+fifty phone photos. Each file is admitted with an estimate of its decoded
+size, and a worker waits until the estimates of every file being decoded fit
+within the budget. A file that is larger than the whole budget is decoded
+alone, once every other file has finished.
+'''
+
+# System Imports
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+# Local Imports
+from media.logger import logger
+
+
+class DecodeBudget:
+    '''
+    Limits the total estimated memory of the files being decoded at once
+    '''
+
+    def __init__(self, budget: int):
+        '''
+        Constructor
+
+        Args:
+            budget: The memory budget in bytes
+        '''
+        self.budget = budget
+        self.used = 0
+        self.alone = False
+        self.waiting_alone = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def admit(self, size: int) -> Iterator[bool]:
+        '''
+        A context manager that waits until a file fits in the budget, and
+        holds its share of the budget until it exits
+
+        Args:
+            size: The estimated decoded size of the file, in bytes
+
+        Yields:
+            True if the file is larger than the budget, and is being decoded alone
+        '''
+        oversized = size > self.budget
+        with self.condition:
+            if oversized:
+                # Stop admitting other files, so the ones being decoded can drain
+                self.waiting_alone += 1
+                logger.debug('Waiting to decode %d MB alone', size // 2**20)
+                self.condition.wait_for(lambda: self.used == 0 and not self.alone)
+                self.waiting_alone -= 1
+                self.alone = True
+            else:
+                self.condition.wait_for(lambda: not self.alone and not self.waiting_alone and self.used + size <= self.budget)
+                self.used += size
+        try:
+            yield oversized
+        finally:
+            with self.condition:
+                if oversized:
+                    self.alone = False
+                else:
+                    self.used -= size
+                self.condition.notify_all()
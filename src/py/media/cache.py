@@ -0,0 +1,193 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# A local cache of extracted file metadata
+#
+
+'''
+A local cache of extracted file metadata. Rebuilding the database means
+decoding, thumbnailing and hashing every file in the library again, which
+can take days. The cache keeps the extracted metadata in a SQLite database
+(usually next to the library), keyed by the device, inode, size and mtime
+of each file, so re-indexing a file that hasn't changed is just a lookup.
+Entries are also keyed by a hash of the thumbnail settings, so changing them
+re-extracts the files, and the whole cache is cleared when the stored
+metadata changes shape (CACHE_VERSION).
+
+The sha256 of a file can also be stored in a `user.media.sha256` extended
+attribute on the file itself, which survives the cache being deleted and
+follows the file if it is moved within the filesystem.
+'''
+
+# System Imports
+import os
+import json
+import base64
+import hashlib
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional, Tuple
+
+# Local Imports
+from media.model import FileMetadata
+from media.logger import logger
+
+
+# The extended attribute used to store the sha256 of a file
+SHA256_XATTR = 'user.media.sha256'
+
+# The version of the cached metadata. Bump this whenever FileMetadata or
+# the extraction changes, to discard the entries made by older versions
+CACHE_VERSION = 2
+
+# The environment variables that change the thumbnails of a file
+THUMBNAIL_SETTINGS = ('THUMBNAIL_SIZE', 'THUMBNAIL_SIZES', 'THUMBNAIL_FORMAT', 'THUMBNAIL_QUALITY')
+
+
+def settings_hash() -> str:
+    '''
+    Get a hash of the cache version and the thumbnail settings
+
+    Returns:
+        The hash as a hex string
+    '''
+    settings = [CACHE_VERSION] + [os.environ.get(name) for name in THUMBNAIL_SETTINGS]
+    return hashlib.sha1(json.dumps(settings).encode()).hexdigest()
+
+
+def read_sha256_xattr(path: Path | str) -> Optional[str]:
+    '''
+    Read the sha256 of a file from its extended attributes. The attribute is
+    ignored if the file has been modified since it was written.
+
+    Args:
+        path: The path of the file
+
+    Returns:
+        The sha256, or None if it isn't stored or is out of date
+    '''
+    try:
+        stats = os.stat(path)
+        sha256, size, mtime = os.getxattr(path, SHA256_XATTR).decode().split(':')
+    except (OSError, AttributeError, ValueError):
+        return None
+    if int(size) != stats.st_size or int(mtime) != stats.st_mtime_ns or len(sha256) != 64:
+        return None
+    return sha256
+
+
+def write_sha256_xattr(path: Path | str, sha256: str):
+    '''
+    Store the sha256 of a file in its extended attributes. This is best
+    effort, so filesystems without xattr support are silently ignored.
+
+    Args:
+        path:   The path of the file
+        sha256: The sha256 of the file
+    '''
+    try:
+        stats = os.stat(path)
+        os.setxattr(path, SHA256_XATTR, f'{sha256}:{stats.st_size}:{stats.st_mtime_ns}'.encode())
+    except (OSError, AttributeError) as e:
+        logger.debug('Unable to set %s on %s: %s', SHA256_XATTR, path, e)
+
+
+class ExtractionCache:
+    '''
+    A SQLite cache of extracted file metadata
+    '''
+
+    def __init__(self, path: Path | str):
+        '''
+        Constructor
+
+        Args:
+            path: The path of the SQLite database file. It is created if it doesn't exist,
+                  and cleared if it was made by a different CACHE_VERSION
+        '''
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != CACHE_VERSION:
+            logger.info('Clearing the extraction cache from an older version')
+            self.db.execute('DROP TABLE IF EXISTS metadata')
+            self.db.execute(f'PRAGMA user_version = {CACHE_VERSION}')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS metadata (
+                dev INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                use_file_mtime INTEGER NOT NULL,
+                settings TEXT NOT NULL,
+                metadata TEXT NOT NULL,
+                thumbnail BLOB NOT NULL,
+                PRIMARY KEY (dev, inode, size, mtime, use_file_mtime, settings)
+            )
+        ''')
+
+    def close(self):
+        '''
+        Close the cache
+        '''
+        with self.lock:
+            self.db.close()
+
+    @staticmethod
+    def key(path: Path | str, use_file_mtime: bool) -> Tuple[int, int, int, int, int, str]:
+        '''
+        Get the cache key of a file
+
+        Args:
+            path:           The path of the file
+            use_file_mtime: Whether the metadata uses the filesystem mtime rather than the exif data
+
+        Returns:
+            A tuple of (device, inode, size, mtime in ns, use_file_mtime, settings hash)
+        '''
+        stats = os.stat(path)
+        return stats.st_dev, stats.st_ino, stats.st_size, stats.st_mtime_ns, int(use_file_mtime), settings_hash()
+
+    def get(self, path: Path, use_file_mtime: bool) -> Optional[FileMetadata]:
+        '''
+        Look up the metadata of a file
+
+        Args:
+            path:           The path of the file
+            use_file_mtime: Whether the metadata uses the filesystem mtime rather than the exif data
+
+        Returns:
+            The cached metadata, or None if the file isn't cached or has changed
+        '''
+        key = self.key(path, use_file_mtime)
+        with self.lock:
+            row = self.db.execute('''
+                SELECT metadata, thumbnail FROM metadata WHERE dev = ? AND inode = ? AND size = ? AND mtime = ? AND use_file_mtime = ? AND settings = ?
+            ''', key).fetchone()
+        if row is None:
+            return None
+        metadata = json.loads(row[0])
+        thumbnails = [t if t is None else base64.b64decode(t) for t in metadata.pop('thumbnails', [])]
+        storyboard = metadata.pop('storyboard', None)
+        storyboard = storyboard if storyboard is None else base64.b64decode(storyboard)
+        return FileMetadata(**metadata, path=str(path), thumbnail=row[1], thumbnails=thumbnails, storyboard=storyboard)
+
+    def put(self, file: FileMetadata, use_file_mtime: bool):
+        '''
+        Store the metadata of a file
+
+        Args:
+            file:           The metadata to store
+            use_file_mtime: Whether the metadata uses the filesystem mtime rather than the exif data
+        '''
+        key = self.key(file.path, use_file_mtime)
+        metadata = file.model_dump(exclude={'path', 'thumbnail', 'thumbnails', 'storyboard'})
+        metadata['thumbnails'] = [t if t is None else base64.b64encode(t).decode() for t in file.thumbnails]
+        metadata['storyboard'] = file.storyboard if file.storyboard is None else base64.b64encode(file.storyboard).decode()
+        metadata = json.dumps(metadata)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?)', key + (metadata, file.thumbnail))
@@ -0,0 +1,267 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Adaptive concurrency for the processor
+#
+
+'''
+Adaptive concurrency for the processor. The processor has two stages with
+different bottlenecks: reading (fingerprints and checksums), which is bound
+by the disk, and decoding (metadata and thumbnails), which is bound by the
+CPU. The controller keeps a number of workers for each, and adjusts them
+from what it observes after each chunk of files:
+
+- If the system load passes the ceiling, both stages back off, to leave
+  room for the web app and anything else on the machine
+- If the disk is saturated (high iowait), the read stage backs off
+- If inserts are taking much longer than usual, postgres is busy, so the
+  decode stage backs off
+- Otherwise, the decode stage hill climbs on throughput: it keeps adding (or
+  removing) workers while the files per second improve, and turns around
+  when they get worse. It never adds workers while the CPU is saturated
+
+The limits can be changed at runtime with set(), eg. from the socket API,
+and SIGTTIN/SIGTTOU raise or lower the worker counts by one.
+'''
+
+# System Imports
+import os
+import time
+import signal
+import threading
+from typing import Dict, Optional, Tuple
+
+# Local Imports
+from media.logger import logger
+
+
+# The stages of the processor that have their own workers
+STAGES = ['io', 'decode']
+
+# The CPU utilisation (0-1) above which no more decode workers are added
+MAX_CPU = 0.9
+
+# The fraction of CPU time spent waiting on the disk above which the read workers back off
+MAX_IOWAIT = 0.25
+
+# How many times slower than the fastest insert seen an insert can be before backing off
+MAX_DB_SLOWDOWN = 3.0
+
+# The relative change in throughput that counts as better or worse
+THROUGHPUT_TOLERANCE = 0.05
+
+
+def read_cpu_times() -> Optional[Tuple[int, int, int]]:
+    '''
+    Read the total CPU times from /proc/stat
+
+    Returns:
+        A tuple of the (busy, iowait, total) time in ticks, or None if they
+        aren't available
+    '''
+    try:
+        with open('/proc/stat') as fp:
+            fields = [int(f) for f in fp.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    idle, iowait = fields[3], fields[4] if len(fields) > 4 else 0
+    total = sum(fields[:8])
+    return total - idle - iowait, iowait, total
+
+
+class ConcurrencyController:
+    '''
+    Adjusts the number of workers for each stage of the processor
+    '''
+
+    def __init__(self, workers: int, max_workers: Optional[int] = None, max_load=1.5, adaptive=True, interval=5.0):
+        '''
+        Constructor
+
+        Args:
+            workers:     The initial number of workers for each stage
+            max_workers: The most workers a stage can have (defaults to the number of CPUs, or workers if higher)
+            max_load:    The ceiling for the 1 minute load average, per CPU
+            adaptive:    Adjust the workers automatically. If not, they only change when set
+            interval:    The minimum time between adjustments, in seconds
+        '''
+        self.lock = threading.RLock()
+        self.cpus = os.cpu_count() or 1
+        self.max_workers = max(1, max_workers or max(self.cpus, workers))
+        self.workers: Dict[str, int] = {stage: max(1, min(workers, self.max_workers)) for stage in STAGES}
+        self.max_load = max_load
+        self.adaptive = adaptive
+        self.interval = interval
+        self.direction = 1
+        self.last_throughput: Optional[float] = None
+        self.fastest_insert: Optional[float] = None
+        self.cpu_times = read_cpu_times()
+        self.last_update = time.monotonic()
+        self.files = 0
+        self.elapsed = 0.0
+        self.db_elapsed = 0.0
+        self.chunks = 0
+
+    def get(self, stage: str) -> int:
+        '''
+        Get the number of workers for a stage
+
+        Args:
+            stage: One of STAGES
+
+        Returns:
+            The number of workers
+        '''
+        with self.lock:
+            return self.workers[stage]
+
+    def state(self) -> Dict:
+        '''
+        Get the current settings
+
+        Returns:
+            The workers for each stage, the limits, and whether it is adaptive
+        '''
+        with self.lock:
+            return {'workers': dict(self.workers), 'max_workers': self.max_workers, 'max_load': self.max_load, 'adaptive': self.adaptive}
+
+    def set(self, workers: Optional[Dict[str, int]] = None, max_workers: Optional[int] = None, max_load: Optional[float] = None, adaptive: Optional[bool] = None):
+        '''
+        Change the settings at runtime
+
+        Args:
+            workers:     The number of workers for any of the stages
+            max_workers: The most workers a stage can have
+            max_load:    The ceiling for the 1 minute load average, per CPU
+            adaptive:    Adjust the workers automatically
+
+        Raises:
+            ValueError: If a setting is invalid
+        '''
+        for stage, count in (workers or {}).items():
+            if stage not in STAGES:
+                raise ValueError(f'Invalid stage: {stage}')
+            if not isinstance(count, int) or count < 1:
+                raise ValueError(f'Invalid number of workers: {count}')
+        if max_workers is not None and (not isinstance(max_workers, int) or max_workers < 1):
+            raise ValueError(f'Invalid maximum number of workers: {max_workers}')
+        if max_load is not None and (not isinstance(max_load, (int, float)) or max_load <= 0):
+            raise ValueError(f'Invalid maximum load: {max_load}')
+        if adaptive is not None and not isinstance(adaptive, bool):
+            raise ValueError(f'Invalid adaptive setting (must be true or false): {adaptive}')
+
+        with self.lock:
+            if max_workers is not None:
+                self.max_workers = max_workers
+            if max_load is not None:
+                self.max_load = float(max_load)
+            if adaptive is not None:
+                self.adaptive = adaptive
+            self.workers |= workers or {}
+            self.workers = {stage: min(count, self.max_workers) for stage, count in self.workers.items()}
+            # Start measuring again from the new settings
+            self.last_throughput = None
+        logger.info('Concurrency set to %s', self.state())
+
+    def step(self, delta: int):
+        '''
+        Add or remove a worker from every stage
+
+        Args:
+            delta: The number of workers to add (or remove if negative)
+        '''
+        with self.lock:
+            self.workers = {stage: max(1, min(count + delta, self.max_workers)) for stage, count in self.workers.items()}
+            self.last_throughput = None
+        logger.info('Concurrency set to %s', self.state())
+
+    def install_signal_handlers(self):  # pragma: no cover
+        '''
+        Add a worker to each stage on SIGTTIN, and remove one on SIGTTOU
+        '''
+        signal.signal(signal.SIGTTIN, lambda *_: self.step(1))
+        signal.signal(signal.SIGTTOU, lambda *_: self.step(-1))
+
+    def record(self, files: int, elapsed: float, db_elapsed: float):
+        '''
+        Record a chunk of processed files, and adjust the workers if it has
+        been long enough since the last adjustment
+
+        Args:
+            files:      The number of files in the chunk
+            elapsed:    The time taken to process the chunk, in seconds
+            db_elapsed: The time taken to insert the chunk, in seconds
+        '''
+        with self.lock:
+            self.files += files
+            self.elapsed += elapsed
+            self.db_elapsed += db_elapsed
+            self.chunks += 1
+            if time.monotonic() - self.last_update < self.interval or self.elapsed <= 0:
+                return
+            self.adjust()
+
+    def adjust(self):
+        '''
+        Adjust the workers from the measurements since the last adjustment.
+        This must be called with the lock held.
+        '''
+        throughput = self.files / self.elapsed
+        insert_time = self.db_elapsed / self.chunks
+        cpu_times = read_cpu_times()
+        busy = iowait = 0.0
+        if cpu_times is not None and self.cpu_times is not None and cpu_times[2] > self.cpu_times[2]:
+            total = cpu_times[2] - self.cpu_times[2]
+            busy = (cpu_times[0] - self.cpu_times[0]) / total
+            iowait = (cpu_times[1] - self.cpu_times[1]) / total
+        load = os.getloadavg()[0] / self.cpus
+
+        self.cpu_times = cpu_times
+        self.last_update = time.monotonic()
+        self.files = 0
+        self.elapsed = 0.0
+        self.db_elapsed = 0.0
+        self.chunks = 0
+        self.fastest_insert = insert_time if self.fastest_insert is None else min(self.fastest_insert, insert_time)
+        if not self.adaptive:
+            return
+
+        before = dict(self.workers)
+        if load > self.max_load:
+            reason = f'load {load:.2f} per cpu'
+            self.workers = {stage: max(1, count - 1) for stage, count in self.workers.items()}
+            self.direction = -1
+        else:
+            reasons = []
+            if iowait > MAX_IOWAIT:
+                reasons.append(f'iowait {iowait:.0%}')
+                self.workers['io'] = max(1, self.workers['io'] - 1)
+            elif iowait < MAX_IOWAIT / 2 and self.workers['io'] < min(self.workers['decode'], self.max_workers):
+                self.workers['io'] += 1
+
+            if insert_time > MAX_DB_SLOWDOWN * max(self.fastest_insert, 0.001):
+                reasons.append(f'insert time {1000 * insert_time:.0f} ms')
+                self.workers['decode'] = max(1, self.workers['decode'] - 1)
+                self.direction = -1
+            else:
+                reasons.append(f'{throughput:.1f} files/s')
+                if self.last_throughput is None or throughput > self.last_throughput * (1 + THROUGHPUT_TOLERANCE):
+                    # Keep going in the direction that helped
+                    step = self.direction
+                elif throughput < self.last_throughput * (1 - THROUGHPUT_TOLERANCE):
+                    # The last change made it worse, so turn around
+                    self.direction = -self.direction
+                    step = self.direction
+                else:
+                    step = 0
+                if step > 0 and busy > MAX_CPU:
+                    reasons.append(f'cpu {busy:.0%}')
+                    step = 0
+                self.workers['decode'] = max(1, min(self.workers['decode'] + step, self.max_workers))
+            reason = ', '.join(reasons)
+        self.last_throughput = throughput
+
+        if self.workers != before:
+            logger.info('Adjusted workers from %s to %s (%s)', before, self.workers, reason)
@@ -0,0 +1,223 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Fast file copying
+#
+
+'''
+Fast file copying. Each copy is tried as a reflink first (a copy on write
+clone, on filesystems like btrfs and XFS), then with copy_file_range (which
+copies inside the kernel, or on the server for network filesystems), and
+only falls back to reading and writing the data in userspace if neither is
+supported. A userspace copy already has every byte of the file in hand, so
+it calculates the sha256 as it goes, and the file doesn't need to be read
+again to checksum it.
+
+Files are copied to a temporary name next to the destination and linked
+into place once complete, so a partial file is never visible, and existing
+files are never overwritten, even by a copy running at the same time.
+'''
+
+# System Imports
+import os
+import errno
+import fcntl
+import shutil
+import hashlib
+import concurrent.futures
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple
+
+# 3rd Party Imports
+from pydantic import BaseModel
+
+# Local Imports
+from media.logger import logger
+
+
+# The ioctl to clone a file (FICLONE from linux/fs.h)
+FICLONE = 0x40049409
+
+# The errors that mean an accelerated copy isn't supported for a pair of files
+UNSUPPORTED_ERRORS = {errno.EBADF, errno.EINVAL, errno.ENOSYS, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EXDEV, errno.ENOTTY, errno.EPERM}
+
+# The errors that mean a filesystem doesn't support hard links
+NO_LINK_ERRORS = {errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOSYS}
+
+# The buffer size for userspace copies
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class CopiedFile(BaseModel):
+    '''
+    The result of copying a file
+    '''
+    path: Path                   # The path of the copy
+    size: int                    # The size of the copy in bytes
+    mtime_ns: int                # The mtime of the copy in ns
+    method: str                  # How it was copied: reflink, copy_file_range or userspace
+    sha256: Optional[str] = None # The sha256 of the file, if it was calculated during the copy
+
+    def is_current(self) -> bool:
+        '''
+        Check that the copy hasn't been modified since it was made
+
+        Returns:
+            True if the size and mtime of the file still match
+        '''
+        try:
+            stats = os.stat(self.path)
+        except OSError:
+            return False
+        return stats.st_size == self.size and stats.st_mtime_ns == self.mtime_ns
+
+
+def reflink(src_fd: int, dst_fd: int) -> bool:
+    '''
+    Clone a file, sharing its data blocks
+
+    Args:
+        src_fd: The open source file
+        dst_fd: The open (empty) destination file
+
+    Returns:
+        True if the file was cloned, or False if the filesystem doesn't support it
+    '''
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except OSError as e:
+        if e.errno in UNSUPPORTED_ERRORS:
+            return False
+        raise
+
+
+def copy_range(src_fd: int, dst_fd: int, size: int) -> bool:
+    '''
+    Copy a file inside the kernel with copy_file_range
+
+    Args:
+        src_fd: The open source file
+        dst_fd: The open (empty) destination file
+        size:   The size of the source file
+
+    Returns:
+        True if the file was copied, or False if copy_file_range isn't supported
+    '''
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    offset = 0
+    while offset < size:
+        try:
+            nbytes = os.copy_file_range(src_fd, dst_fd, size - offset)
+        except OSError as e:
+            if offset == 0 and e.errno in UNSUPPORTED_ERRORS:
+                return False
+            raise
+        if nbytes == 0:
+            if offset == 0:
+                # Some filesystems (eg. procfs-like or FUSE) report success but copy nothing
+                return False
+            break
+        offset += nbytes
+    return True
+
+
+def copy_userspace(src_fd: int, dst_fd: int) -> str:
+    '''
+    Copy a file through a userspace buffer, calculating its sha256 on the way
+
+    Args:
+        src_fd: The open source file
+        dst_fd: The open (empty) destination file
+
+    Returns:
+        The hex encoded sha256 digest
+    '''
+    sha = hashlib.sha256()
+    mv = memoryview(bytearray(COPY_BUFFER_SIZE))
+    while nbytes := os.readv(src_fd, [mv]):
+        sha.update(mv[:nbytes])
+        offset = 0
+        while offset < nbytes:
+            offset += os.write(dst_fd, mv[offset:nbytes])
+    return sha.hexdigest()
+
+
+def copy_file(src: Path, dst: Path) -> Optional[CopiedFile]:
+    '''
+    Copy a file, along with its permissions and timestamps (like shutil.copy2).
+    The copy is hard linked to dst, which fails rather than replacing a file
+    that already exists. On filesystems without hard links it is renamed
+    into place if dst doesn't exist, which can race with another copy.
+
+    Args:
+        src: The file to copy
+        dst: The path to copy it to. This must not exist
+
+    Returns:
+        The copied file, or None if dst already exists
+    '''
+    tmp = dst.with_name(f'.{dst.name}.part')
+    with open(src, 'rb', buffering=0) as src_fp:
+        dst_fp = open(tmp, 'wb', buffering=0)
+        try:
+            with dst_fp:
+                src_fd, dst_fd = src_fp.fileno(), dst_fp.fileno()
+                sha256 = None
+                if reflink(src_fd, dst_fd):
+                    method = 'reflink'
+                elif copy_range(src_fd, dst_fd, os.fstat(src_fd).st_size):
+                    method = 'copy_file_range'
+                else:
+                    os.lseek(src_fd, 0, os.SEEK_SET)
+                    os.ftruncate(dst_fd, 0)
+                    os.lseek(dst_fd, 0, os.SEEK_SET)
+                    sha256 = copy_userspace(src_fd, dst_fd)
+                    method = 'userspace'
+            shutil.copystat(src, tmp)
+
+            try:
+                os.link(tmp, dst)
+            except FileExistsError:
+                return None
+            except OSError as e:
+                if e.errno not in NO_LINK_ERRORS:
+                    raise
+                if dst.exists():
+                    return None
+                os.rename(tmp, dst)
+        finally:
+            tmp.unlink(missing_ok=True)
+    stats = os.stat(dst)
+    return CopiedFile(path=dst, size=stats.st_size, mtime_ns=stats.st_mtime_ns, method=method, sha256=sha256)
+
+
+def parallel_copy(pairs: Iterable[Tuple[Path, Path]], workers: int) -> Dict[Path, CopiedFile]:
+    '''
+    Copy many files in parallel
+
+    Args:
+        pairs:   The (src, dst) of each file to copy
+        workers: The number of files to copy at once
+
+    Returns:
+        A map of dst to the copied file. Files that could not be copied, or
+        whose dst already exists, are omitted
+    '''
+    results: Dict[Path, CopiedFile] = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(copy_file, src, dst): (src, dst) for src, dst in pairs}
+        for future in concurrent.futures.as_completed(futures):
+            src, dst = futures[future]
+            try:
+                copied = future.result()
+            except Exception as e:
+                logger.error('Unable to copy %s to %s: %s', src, dst, e)
+                continue
+            if copied is not None:
+                logger.debug('Copied %s to %s with %s', src, dst, copied.method)
+                results[dst] = copied
+    return results
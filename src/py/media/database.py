@@ -21,10 +21,13 @@ TIMEZONE - Name of the timezone to use
 '''
 
 # System Imports
+import os
 import time
 import json
+import zoneinfo
+import concurrent.futures
 from contextlib import contextmanager
-from typing import Optional, Set, Dict, List
+from typing import Iterator, Optional, Set, Dict, List, Tuple
 from pathlib import Path
 
 # 3rd Party Imports
@@ -32,10 +35,32 @@ import psycopg
 from pydantic import BaseModel
 
 # Local imports
-from media.model import FileMetadata
+from media.model import FileMetadata, MediaBatch, FILE_FIELDS
 from media.logger import logger
 
 
+# The table that media is bulk loaded into when rebuilding the database
+STAGING_TABLE = 'media_staging'
+
+
+def get_timezone() -> str:
+    '''
+    Get the timezone from the TIMEZONE environment variable
+
+    Raises:
+        ValueError: If TIMEZONE isn't set to the name of a known timezone
+
+    Returns:
+        The name of the timezone
+    '''
+    name = os.environ.get('TIMEZONE', '')
+    try:
+        zoneinfo.ZoneInfo(name)
+    except (ValueError, zoneinfo.ZoneInfoNotFoundError):
+        raise ValueError(f'TIMEZONE must be set to the name of a timezone, eg. Australia/Brisbane (not {name!r})') from None
+    return name
+
+
 class ProgressCacheEntry(BaseModel):
     '''
     An entry in the progress cache
@@ -57,12 +82,19 @@ class Database:
         self.db: Optional[psycopg.Cursor] = None
         self.progress_cache: Dict[str, ProgressCacheEntry] = {}
         self.locked = False
+        self.timezone: Optional[str] = None
 
     @contextmanager
     def open(self):
         '''
-        A context manager to lock the database
+        A context manager to open the database. TIMEZONE is checked first, so
+        a missing or unknown timezone fails here rather than part way through
+        an ingest.
+
+        Raises:
+            ValueError: If TIMEZONE isn't set to the name of a known timezone
         '''
+        self.timezone = get_timezone()
         with psycopg.connect(autocommit=True) as connection:
             with connection.cursor() as cursor:
                 self.db = cursor
@@ -106,6 +138,23 @@ class Database:
         '''
         return self.locked
 
+    @staticmethod
+    def copy_media(cursor: psycopg.Cursor, table: str, media: List[FileMetadata] | MediaBatch):
+        '''
+        Copy file metadata into a table. The rows are read straight from the
+        columns of a MediaBatch, rather than dumping each model.
+
+        Args:
+            cursor: The cursor to copy with
+            table:  The name of the table to copy into
+            media:  The list (or batch) of media to copy
+        '''
+        batch = media if isinstance(media, MediaBatch) else MediaBatch(media)
+        logger.debug(f'Inserting {len(batch)} rows into {table}')
+        with cursor.copy(f'COPY {table} ({",".join(FILE_FIELDS)}) FROM STDIN') as copy:
+            for row in batch.rows():
+                copy.write_row(row)
+
     def bulk_insert_media(self, media: List[FileMetadata]):
         '''
         Insert the file metadata into the database
@@ -116,12 +165,199 @@ class Database:
         assert self.db is not None
         if not media:
             return
-        header = FileMetadata.__annotations__.keys()
+        batch = MediaBatch(media)
+        with self.db.connection.transaction():
+            self.copy_media(self.db, 'media', batch)
+            self.update_summaries('''
+                SELECT * FROM UNNEST(%(timestamp)s::INT8[], %(type)s::TEXT[], %(make)s::TEXT[], %(model)s::TEXT[]) AS t(timestamp, type, make, model)
+            ''', {k: batch.columns[k] for k in ('timestamp', 'type', 'make', 'model')})
+
+    def update_summaries(self, source: str, params: Dict, sign: int = 1):
+        '''
+        Add (or remove) media from the summary tables: the number of media on
+        each day in TIMEZONE, and for each type, make and model. This must be
+        called in the same transaction as the change to the media table.
+
+        Args:
+            source: A query for the timestamp, type, make and model of the media
+            params: The parameters of the query
+            sign:   1 to add the media, or -1 to remove it
+        '''
+        assert self.db is not None and self.timezone is not None
+        params = params | {'timezone': self.timezone, 'sign': sign}
+        self.db.execute(f'''
+            INSERT INTO media_day (day, count)
+            SELECT (TO_TIMESTAMP(timestamp) AT TIME ZONE %(timezone)s)::DATE AS day, %(sign)s * COUNT(*) FROM ({source}) AS src GROUP BY day
+            ON CONFLICT (day) DO UPDATE SET count = media_day.count + EXCLUDED.count
+        ''', params)
+        self.db.execute(f'''
+            INSERT INTO media_facet (type, make, model, count)
+            SELECT type, COALESCE(make, ''), COALESCE(model, ''), %(sign)s * COUNT(*) FROM ({source}) AS src GROUP BY 1, 2, 3
+            ON CONFLICT (type, make, model) DO UPDATE SET count = media_facet.count + EXCLUDED.count
+        ''', params)
+        if sign < 0:
+            self.db.execute('DELETE FROM media_day WHERE count <= 0')
+            self.db.execute('DELETE FROM media_facet WHERE count <= 0')
+
+    def recompute_summaries(self):
+        '''
+        Rebuild the summary tables from scratch
+        '''
+        assert self.db is not None
+        with self.db.connection.transaction():
+            self.db.execute('DELETE FROM media_day')
+            self.db.execute('DELETE FROM media_facet')
+            self.update_summaries('SELECT timestamp, type, make, model FROM media', {})
+
+    def create_staging_table(self):
+        '''
+        Create an empty, unlogged staging table with the same columns as the
+        media table, but without any indexes. Any staging table left over
+        from a failed rebuild is dropped first.
+        '''
+        assert self.db is not None
+        with self.db.connection.transaction():
+            self.db.execute(f'DROP TABLE IF EXISTS {STAGING_TABLE}')
+            self.db.execute(f'CREATE UNLOGGED TABLE {STAGING_TABLE} (LIKE media INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+
+    def drop_staging_table(self):
+        '''
+        Drop the staging table, if it exists
+        '''
+        assert self.db is not None
+        self.db.execute(f'DROP TABLE IF EXISTS {STAGING_TABLE}')
+
+    def copy_to_staging_table(self, media: List[FileMetadata], streams: int = 4):
+        '''
+        Load file metadata into the staging table, split across parallel COPY
+        streams on separate connections
+
+        Args:
+            media:   The list of media to load
+            streams: The maximum number of parallel streams
+        '''
+        if not media:
+            return
+        streams = max(1, min(streams, len(media)))
+
+        def copy_chunk(chunk: List[FileMetadata]):
+            with psycopg.connect() as connection:
+                with connection.cursor() as cursor:
+                    self.copy_media(cursor, STAGING_TABLE, chunk)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=streams) as executor:
+            for future in [executor.submit(copy_chunk, media[i::streams]) for i in range(streams)]:
+                future.result()
+
+    def copy_other_media_to_staging_table(self, paths: List[Path]):
+        '''
+        Copy the media that isn't under any of the paths from the media table
+        to the staging table, so rebuilding some paths keeps the rest of the
+        media when the staging table replaces the media table
+
+        Args:
+            paths: The files and directories being rebuilt
+        '''
+        assert self.db is not None
+        roots = [path.as_posix().rstrip('/') for path in paths]
+        self.db.execute(f'''
+            INSERT INTO {STAGING_TABLE}
+            SELECT * FROM media
+            WHERE NOT EXISTS (
+                SELECT 1 FROM UNNEST(%s::text[]) AS r(root)
+                WHERE media.path = r.root OR starts_with(media.path, r.root || '/')
+            )
+        ''', [roots])
+
+    def get_media_dependents(self) -> List[str]:
+        '''
+        Get the views and foreign keys that depend on the media table, which
+        would stop it being dropped when the staging table is swapped in
+
+        Returns:
+            The names of the dependent objects
+        '''
+        assert self.db is not None
+        self.db.execute('''
+            SELECT DISTINCT c.oid::regclass::text
+            FROM pg_depend d
+            JOIN pg_rewrite r ON r.oid = d.objid
+            JOIN pg_class c ON c.oid = r.ev_class
+            WHERE d.classid = 'pg_rewrite'::regclass AND d.refobjid = 'media'::regclass AND c.relname <> 'media'
+            UNION
+            SELECT conname || ' on ' || conrelid::regclass::text
+            FROM pg_constraint
+            WHERE contype = 'f' AND confrelid = 'media'::regclass
+        ''')
+        return [row[0] for row in self.db.fetchall()]
+
+    def get_media_indexes(self) -> List[Tuple[str, str, bool]]:
+        '''
+        Get the definitions of the indexes on the media table
+
+        Returns:
+            A list of (name, definition, is_constraint) tuples. Constraint
+            definitions are suitable for ALTER TABLE ADD CONSTRAINT, and the
+            rest are CREATE INDEX statements
+        '''
+        assert self.db is not None
+        self.db.execute('''
+            SELECT i.relname, COALESCE(pg_get_constraintdef(c.oid), pg_get_indexdef(i.oid)), c.oid IS NOT NULL
+            FROM pg_index x
+            JOIN pg_class i ON i.oid = x.indexrelid
+            LEFT JOIN pg_constraint c ON c.conindid = x.indexrelid AND c.conrelid = x.indrelid
+            WHERE x.indrelid = 'media'::regclass
+            ORDER BY i.relname
+        ''')
+        return [tuple(row) for row in self.db.fetchall()]
+
+    def index_staging_table(self):
+        '''
+        Make the staging table durable, then build the same indexes and
+        constraints as the media table on it and update its statistics. The
+        indexes are given a _staging suffix until the table is swapped in.
+        '''
+        assert self.db is not None
+        self.db.execute(f'ALTER TABLE {STAGING_TABLE} SET LOGGED')
+        for name, definition, is_constraint in self.get_media_indexes():
+            logger.info(f'Building index {name}')
+            if is_constraint:
+                self.db.execute(f'ALTER TABLE {STAGING_TABLE} ADD CONSTRAINT {name}_staging {definition}')
+            else:
+                unique = 'UNIQUE ' if definition.startswith('CREATE UNIQUE') else ''
+                self.db.execute(f'CREATE {unique}INDEX {name}_staging ON {STAGING_TABLE} USING {definition.split(" USING ", 1)[1]}')
+        self.db.execute(f'ANALYZE {STAGING_TABLE}')
+
+    def swap_staging_table(self):
+        '''
+        Atomically replace the media table with the staging table. The id
+        sequence is moved to the staging table, so new ids carry on from the
+        old table, and the indexes are renamed to their usual names. The
+        summary tables are recomputed from the new table in the same
+        transaction.
+
+        Raises:
+            RuntimeError: If other objects depend on the media table
+        '''
+        assert self.db is not None
+        indexes = self.get_media_indexes()
         with self.db.connection.transaction():
-            with self.db.copy(f'COPY media ({",".join(header)}) FROM STDIN') as copy:
-                for file in media:
-                    logger.debug(f'Inserting: {file.model_dump()}')
-                    copy.write_row(list(file.model_dump().values()))
+            self.db.execute("SET LOCAL lock_timeout = '30s'")
+            self.db.execute('LOCK TABLE media IN ACCESS EXCLUSIVE MODE')
+            row = self.db.execute("SELECT pg_get_serial_sequence('media', 'id')").fetchone()
+            if row is not None and row[0] is not None:
+                self.db.execute(f'ALTER SEQUENCE {row[0]} OWNED BY {STAGING_TABLE}.id')
+            try:
+                self.db.execute('DROP TABLE media')
+            except psycopg.errors.DependentObjectsStillExist as e:
+                raise RuntimeError(f'Unable to replace the media table, other objects depend on it: {e.diag.message_detail or e}') from e
+            self.db.execute(f'ALTER TABLE {STAGING_TABLE} RENAME TO media')
+            for name, _, is_constraint in indexes:
+                if is_constraint:
+                    self.db.execute(f'ALTER TABLE media RENAME CONSTRAINT {name}_staging TO {name}')
+                else:
+                    self.db.execute(f'ALTER INDEX {name}_staging RENAME TO {name}')
+            self.recompute_summaries()
 
     def strip_existing_paths(self, paths: Set[Path]) -> Set[Path]:
         '''
@@ -146,6 +382,250 @@ class Database:
         existing_paths = {Path(row[0]) for row in self.db.fetchall()}
         return paths - existing_paths
 
+    def find_media_by_sha256(self, hashes: Set[str]) -> List[FileMetadata]:
+        '''
+        Find existing media that has one of the provided checksums. Only one
+        row is returned for each distinct (sha256, size) pair.
+
+        Args:
+            hashes: A set of sha256 checksums to look for
+
+        Returns:
+            The metadata of the matching media
+        '''
+        assert self.db is not None
+        if len(hashes) == 0:
+            return []
+
+        self.db.execute(f'SELECT DISTINCT ON (sha256, size) {",".join(FILE_FIELDS)} FROM media WHERE sha256 = ANY(%s)', [list(hashes)])
+        return [FileMetadata(**dict(zip(FILE_FIELDS, row))) for row in self.db.fetchall()]
+
+    def find_fingerprints(self, fingerprints: Set[str]) -> Set[str]:
+        '''
+        Find which of the provided fingerprints belong to existing media
+
+        Args:
+            fingerprints: A set of fingerprints to look for
+
+        Returns:
+            The subset of fingerprints that are already in the database
+        '''
+        assert self.db is not None
+        if len(fingerprints) == 0:
+            return set()
+
+        self.db.execute('SELECT DISTINCT fingerprint FROM media WHERE fingerprint = ANY(%s)', [list(fingerprints)])
+        return {row[0] for row in self.db.fetchall()}
+
+    def quarantine_file(self, path: Path, size: int, reason: str):
+        '''
+        Add a file to the quarantine, so it is skipped until it changes
+
+        Args:
+            path:   The file
+            size:   The size of the file
+            reason: Why the file was quarantined
+        '''
+        assert self.db is not None
+        self.db.execute('''
+            INSERT INTO quarantine (path, size, reason) VALUES (%s, %s, %s)
+            ON CONFLICT (path) DO UPDATE SET size = EXCLUDED.size, reason = EXCLUDED.reason, time = now()
+        ''', [path.as_posix(), size, reason])
+
+    def get_quarantined(self, paths: Set[Path]) -> Dict[Path, Tuple[int, str]]:
+        '''
+        Find which of the provided paths are quarantined
+
+        Args:
+            paths: A set of paths to check
+
+        Returns:
+            A map of each quarantined path to its (size, reason) when it was quarantined
+        '''
+        assert self.db is not None
+        if len(paths) == 0:
+            return {}
+
+        self.db.execute('SELECT path, size, reason FROM quarantine WHERE path = ANY(%s)', [[p.as_posix() for p in paths]])
+        return {Path(row[0]): (row[1], row[2]) for row in self.db.fetchall()}
+
+    def get_media_paths(self, root: Path) -> Dict[str, int]:
+        '''
+        Get the paths of all media under a directory
+
+        Args:
+            root: The directory
+
+        Returns:
+            A map of each path to the id of its media
+        '''
+        assert self.db is not None
+        prefix = root.as_posix()
+        if not prefix.endswith('/'):
+            prefix += '/'
+        self.db.execute('SELECT path, id FROM media WHERE starts_with(path, %s)', [prefix])
+        return {row[0]: row[1] for row in self.db.fetchall()}
+
+    def get_media_hashes(self, ids: List[int]) -> List[Tuple[int, int, Optional[str], Optional[str]]]:
+        '''
+        Get the size, checksum and fingerprint of media
+
+        Args:
+            ids: The ids of the media
+
+        Returns:
+            A list of (id, size, sha256, fingerprint) tuples
+        '''
+        assert self.db is not None
+        if not ids:
+            return []
+        self.db.execute('SELECT id, size, sha256, fingerprint FROM media WHERE id = ANY(%s)', [ids])
+        return [tuple(row) for row in self.db.fetchall()]
+
+    def move_media(self, moves: List[Tuple[int, Path]]):
+        '''
+        Change the path of existing media, keeping the rest of its metadata
+
+        Args:
+            moves: A list of (id, new path) tuples
+        '''
+        assert self.db is not None
+        if not moves:
+            return
+        with self.db.connection.transaction():
+            self.db.executemany('UPDATE media SET path = %s WHERE id = %s', [(str(path), id) for id, path in moves])
+
+    def delete_media(self, ids: List[int]):
+        '''
+        Delete media
+
+        Args:
+            ids: The ids of the media to delete
+        '''
+        assert self.db is not None
+        if not ids:
+            return
+        with self.db.connection.transaction():
+            self.update_summaries('SELECT timestamp, type, make, model FROM media WHERE id = ANY(%(ids)s)', {'ids': ids}, -1)
+            self.db.execute('DELETE FROM media WHERE id = ANY(%s)', [ids])
+
+    def get_unhashed_media(self, after_id: int, limit: int) -> List[Tuple[int, str, Optional[str], Optional[str]]]:
+        '''
+        Get media that is missing a sha256 checksum or fingerprint
+
+        Args:
+            after_id: Only return media with an id greater than this
+            limit:    The maximum number of rows to return
+
+        Returns:
+            A list of (id, path, sha256, fingerprint) tuples, ordered by id
+        '''
+        assert self.db is not None
+        self.db.execute('SELECT id, path, sha256, fingerprint FROM media WHERE id > %s AND (sha256 IS NULL OR fingerprint IS NULL) ORDER BY id LIMIT %s', [after_id, limit])
+        return [tuple(row) for row in self.db.fetchall()]
+
+    def update_hashes(self, hashes: List[Tuple[int, str, str]]):
+        '''
+        Set the sha256 checksum and fingerprint of existing media
+
+        Args:
+            hashes: A list of (id, sha256, fingerprint) tuples to update
+        '''
+        assert self.db is not None
+        if not hashes:
+            return
+        with self.db.connection.transaction():
+            self.db.executemany('UPDATE media SET sha256 = %s, fingerprint = %s WHERE id = %s', [(sha256, fingerprint, id) for id, sha256, fingerprint in hashes])
+
+    def get_unkeyed_locations(self, after_id: int, limit: int) -> List[Tuple[int, float, float]]:
+        '''
+        Get media that has a location, but no quadkey
+
+        Args:
+            after_id: Only return media with an id greater than this
+            limit:    The maximum number of rows to return
+
+        Returns:
+            A list of (id, latitude, longitude) tuples, ordered by id
+        '''
+        assert self.db is not None
+        self.db.execute('SELECT id, latitude, longitude FROM media WHERE id > %s AND latitude IS NOT NULL AND longitude IS NOT NULL AND quadkey IS NULL ORDER BY id LIMIT %s', [after_id, limit])
+        return [tuple(row) for row in self.db.fetchall()]
+
+    def update_quadkeys(self, quadkeys: List[Tuple[int, int]]):
+        '''
+        Set the quadkeys of existing media, in a single statement
+
+        Args:
+            quadkeys: A list of (id, quadkey) tuples
+        '''
+        assert self.db is not None
+        if not quadkeys:
+            return
+        ids, keys = zip(*quadkeys)
+        self.db.execute('UPDATE media SET quadkey = v.quadkey FROM UNNEST(%s::INT8[], %s::INT8[]) AS v(id, quadkey) WHERE media.id = v.id', [list(ids), list(keys)])
+
+    def get_phashes(self) -> List[Tuple[int, str, int]]:
+        '''
+        Get the perceptual hashes of all media
+
+        Returns:
+            A list of (id, path, phash) tuples for media that has a phash
+        '''
+        assert self.db is not None
+        self.db.execute('SELECT id, path, phash FROM media WHERE phash IS NOT NULL')
+        return [tuple(row) for row in self.db.fetchall()]
+
+    def stream_media(self, after_id: int = 0, itersize: int = 1000) -> Iterator[Tuple[int, str, str]]:
+        '''
+        Stream all media through a server-side cursor, so the rows don't all
+        have to be held in memory. The cursor is held over commits, so the
+        connection can be used for updates while streaming.
+
+        Args:
+            after_id: Only return media with an id greater than this
+            itersize: The number of rows to fetch from the server at a time
+
+        Yields:
+            (id, path, type) tuples, ordered by id
+        '''
+        assert self.db is not None
+        with self.db.connection.cursor(name='media_stream', withhold=True) as cursor:
+            cursor.itersize = itersize
+            cursor.execute('SELECT id, path, type FROM media WHERE id > %s ORDER BY id', [after_id])
+            for row in cursor:
+                yield tuple(row)
+
+    def update_thumbnails(self, media: List[Tuple[int, FileMetadata]]):
+        '''
+        Set the thumbnails (and the perceptual hash derived from them) of
+        existing media. No other columns are changed.
+
+        Args:
+            media: A list of (id, metadata) tuples, with the new thumbnails in the metadata
+        '''
+        assert self.db is not None
+        if not media:
+            return
+        with self.db.connection.transaction():
+            self.db.executemany('''
+                UPDATE media SET thumbnail = %s, phash = %s, thumbnail_format = %s, thumbnail_sizes = %s, thumbnails = %s WHERE id = %s
+            ''', [(f.thumbnail, f.phash, f.thumbnail_format, f.thumbnail_sizes, f.thumbnails, id) for id, f in media])
+
+    def get_progress(self, name: str) -> Optional[Dict]:
+        '''
+        Get the last progress update of a process
+
+        Args:
+            name: The name of the process
+
+        Returns:
+            The progress message, or None if the process has never run
+        '''
+        assert self.db is not None
+        row = self.db.execute('SELECT message FROM progress WHERE name = %s', [name]).fetchone()
+        return None if row is None else row[0]
+
     def update_progress(self, name: str, state: str, progress: int = 0, total: int = 0, extra: Optional[Dict] = None):
         '''
         Update a process progress
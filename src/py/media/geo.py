@@ -0,0 +1,122 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Quadkey tiles for media locations
+#
+
+'''
+Quadkey tiles for media locations. Each location is stored with the quadkey
+of the web mercator tile that contains it at QUADKEY_ZOOM, as an integer.
+The quadkey of a tile is the quadkey of its parent with two more bits (the
+quadrant) on the end, so the tile at any lower zoom is a right shift:
+
+    SELECT quadkey >> 2 * (24 - zoom) AS tile, COUNT(*) FROM media GROUP BY tile
+
+which lets the map cluster points with an indexed column, rather than
+scanning the coordinates. There is a scalar version for ingest, and a
+vectorized version (with numpy) for backfilling existing media.
+'''
+
+# System Imports
+import math
+from typing import List, Optional, Sequence
+
+# Local Imports
+from media.lazy import LazyModule
+
+# Lazily imported, since numpy is only needed for backfills
+np = LazyModule('numpy')
+
+
+# The zoom level of the stored quadkeys (about 2.4 m tiles at the equator)
+QUADKEY_ZOOM = 24
+
+# The latitude limit of the web mercator projection
+MAX_LATITUDE = 85.05112878
+
+
+def interleave(x, y):
+    '''
+    Interleave the bits of the tile coordinates into a quadkey, with the y
+    bit above the x bit at each level. This works on ints and numpy uint64
+    arrays alike.
+
+    Args:
+        x: The tile column (up to 32 bits)
+        y: The tile row (up to 32 bits)
+
+    Returns:
+        The quadkey
+    '''
+    def spread(v):
+        v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+        v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+        v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+        v = (v | (v << 2)) & 0x3333333333333333
+        return (v | (v << 1)) & 0x5555555555555555
+    return spread(x) | (spread(y) << 1)
+
+
+def quadkey(latitude: Optional[float], longitude: Optional[float], zoom: int = QUADKEY_ZOOM) -> Optional[int]:
+    '''
+    Get the quadkey of a location
+
+    Args:
+        latitude:  Latitude in degrees. Locations past the poles of the projection are clamped
+        longitude: Longitude in degrees
+        zoom:      The zoom level of the tile
+
+    Returns:
+        The quadkey as an integer, or None if the location isn't known
+    '''
+    if latitude is None or longitude is None or not math.isfinite(latitude) or not math.isfinite(longitude):
+        return None
+    n = 1 << zoom
+    sin_lat = math.sin(math.radians(max(-MAX_LATITUDE, min(latitude, MAX_LATITUDE))))
+    x = (longitude + 180) / 360
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return interleave(max(0, min(int(x * n), n - 1)), max(0, min(int(y * n), n - 1)))
+
+
+def quadkeys(latitudes: Sequence[Optional[float]], longitudes: Sequence[Optional[float]], zoom: int = QUADKEY_ZOOM) -> List[Optional[int]]:
+    '''
+    Get the quadkeys of many locations at once
+
+    Args:
+        latitudes:  Latitudes in degrees
+        longitudes: Longitudes in degrees, in the same order
+        zoom:       The zoom level of the tiles
+
+    Returns:
+        The quadkey of each location, or None where the location isn't known
+    '''
+    lat = np.array(latitudes, dtype=np.float64)
+    lon = np.array(longitudes, dtype=np.float64)
+    valid = np.isfinite(lat) & np.isfinite(lon)
+    lat = np.clip(np.where(valid, lat, 0), -MAX_LATITUDE, MAX_LATITUDE)
+    lon = np.where(valid, lon, 0)
+
+    n = 1 << zoom
+    sin_lat = np.sin(np.radians(lat))
+    x = (lon + 180) / 360
+    y = 0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)
+    tx = np.clip(np.floor(x * n), 0, n - 1).astype(np.uint64)
+    ty = np.clip(np.floor(y * n), 0, n - 1).astype(np.uint64)
+    keys = interleave(tx, ty)
+    return [int(k) if v else None for k, v in zip(keys.tolist(), valid.tolist())]
+
+
+def tile(key: int, zoom: int) -> int:
+    '''
+    Get the tile at a lower zoom level that contains a quadkey
+
+    Args:
+        key:  A quadkey at QUADKEY_ZOOM
+        zoom: The zoom level of the tile (up to QUADKEY_ZOOM)
+
+    Returns:
+        The quadkey of the tile at that zoom
+    '''
+    return key >> 2 * (QUADKEY_ZOOM - zoom)
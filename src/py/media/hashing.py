@@ -0,0 +1,240 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# High throughput file hashing
+#
+
+'''
+High throughput file hashing. The engine picks a buffer size based on the
+size of the file and the type of device it is on, hashes large files
+through mmap rather than copying into a buffer, and gives the kernel
+readahead hints for the files that are next in the queue. Once a file has
+been hashed its pages can be dropped from the page cache so that a large
+backfill doesn't evict the pages that the web server relies on. This is
+opt-in, since it also drops the pages of files that were already cached.
+
+Reading a mapped page past the end of a file that was truncated after it
+was mapped kills the process with SIGBUS, so only files that haven't been
+modified for `stable_age` seconds are mapped. The rest are read into a
+buffer. Either way, a file whose size or mtime changed while it was being
+hashed raises an OSError rather than returning a checksum of mixed contents.
+'''
+
+# System Imports
+import os
+import mmap
+import queue
+import time
+import hashlib
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+# Local Imports
+from media.logger import logger
+
+
+class HashEngine:
+    '''
+    Calculates SHA256 checksums of files
+    '''
+
+    def __init__(self, min_buffer=64 * 1024, max_buffer=4 * 1024 * 1024, mmap_threshold=16 * 1024 * 1024, readahead=2, drop_cache=False, stable_age=60.0):
+        '''
+        Constructor
+
+        Args:
+            min_buffer:     The smallest read buffer to use, in bytes
+            max_buffer:     The largest read buffer to use, in bytes
+            mmap_threshold: Files at least this big are hashed via mmap. Set to 0 to disable mmap
+            readahead:      The number of queued files to ask the kernel to prefetch
+            drop_cache:     Drop hashed files from the page cache once they are done, by default
+            stable_age:     Only mmap files that haven't been modified for this many seconds
+        '''
+        self.min_buffer = min_buffer
+        self.max_buffer = max_buffer
+        self.mmap_threshold = mmap_threshold
+        self.readahead = readahead
+        self.drop_cache = drop_cache
+        self.stable_age = stable_age
+        self.rotational: Dict[int, bool] = {}
+
+    def is_rotational(self, dev: int) -> bool:
+        '''
+        Check if a device is a spinning disk
+
+        Args:
+            dev: The device number (st_dev) to check
+
+        Returns:
+            True if the device is rotational, False if not or unknown
+        '''
+        if dev not in self.rotational:
+            base = Path(f'/sys/dev/block/{os.major(dev)}:{os.minor(dev)}')
+            self.rotational[dev] = False
+            for path in [base / 'queue' / 'rotational', base / '..' / 'queue' / 'rotational']:
+                try:
+                    self.rotational[dev] = path.read_text().strip() == '1'
+                    break
+                except OSError:
+                    pass
+        return self.rotational[dev]
+
+    def buffer_size(self, size: int, dev: int) -> int:
+        '''
+        Pick a read buffer size for a file. Larger files get larger buffers to
+        reduce the number of syscalls, and spinning disks get the largest
+        buffer to reduce seeking when several files are read at once.
+
+        Args:
+            size: The size of the file in bytes
+            dev:  The device number (st_dev) of the file
+
+        Returns:
+            The buffer size in bytes
+        '''
+        if self.is_rotational(dev):
+            return self.max_buffer
+        buf = self.min_buffer
+        while buf < self.max_buffer and buf * 64 < size:
+            buf *= 2
+        return buf
+
+    def advise(self, fd: int, advice: int):
+        '''
+        Give the kernel a hint about how a file will be accessed. Hints are
+        best effort, so any failure is ignored.
+
+        Args:
+            fd:     The open file descriptor
+            advice: One of the os.POSIX_FADV_* constants
+        '''
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        try:
+            os.posix_fadvise(fd, 0, 0, advice)
+        except OSError:
+            pass
+
+    def prefetch(self, path: Path | str):
+        '''
+        Ask the kernel to start reading a file into the page cache
+
+        Args:
+            path: The file that will be hashed soon
+        '''
+        if not hasattr(os, 'POSIX_FADV_WILLNEED'):
+            return
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            self.advise(fd, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+    def is_stable(self, stats: os.stat_result) -> bool:
+        '''
+        Check if a file is safe to mmap, ie. it hasn't been modified recently,
+        so it is unlikely to be truncated while it is mapped
+
+        Args:
+            stats: The stats of the file
+
+        Returns:
+            True if the file hasn't been modified for stable_age seconds
+        '''
+        return time.time() - max(stats.st_mtime, stats.st_ctime) >= self.stable_age
+
+    def sha256(self, path: Path | str, drop_cache: Optional[bool] = None) -> str:
+        '''
+        Calculate a SHA256 checksum of a file
+
+        Args:
+            path:       The path of the file to create the checksum
+            drop_cache: Drop the file from the page cache once it is done, or None for the engine default
+
+        Raises:
+            OSError: If the file couldn't be read, or changed while it was being hashed
+
+        Returns:
+            The hex encoded sha256 digest
+        '''
+        sha = hashlib.sha256()
+        with open(path, 'rb', buffering=0) as fp:
+            fd = fp.fileno()
+            stats = os.fstat(fd)
+            if hasattr(os, 'POSIX_FADV_SEQUENTIAL'):
+                self.advise(fd, os.POSIX_FADV_SEQUENTIAL)
+            bufsize = self.buffer_size(stats.st_size, stats.st_dev)
+            if self.mmap_threshold and stats.st_size >= self.mmap_threshold and self.is_stable(stats):
+                with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+                    if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    with memoryview(mm) as mv:
+                        for offset in range(0, stats.st_size, bufsize):
+                            sha.update(mv[offset:offset + bufsize])
+            else:
+                mv = memoryview(bytearray(bufsize))
+                while nbytes := fp.readinto(mv):
+                    sha.update(mv[:nbytes])
+            after = os.fstat(fd)
+            if (after.st_size, after.st_mtime_ns) != (stats.st_size, stats.st_mtime_ns):
+                raise OSError(f'{path} changed while it was being hashed')
+            if (self.drop_cache if drop_cache is None else drop_cache) and hasattr(os, 'POSIX_FADV_DONTNEED'):
+                self.advise(fd, os.POSIX_FADV_DONTNEED)
+        return sha.hexdigest()
+
+    def hash_files(self, paths: Iterable[Path], workers: int, drop_cache: Optional[bool] = None) -> Dict[Path, str]:
+        '''
+        Calculate the SHA256 checksum of many files in parallel. Whenever a
+        worker starts on a file, the kernel is asked to prefetch the file that
+        is `readahead` places further along the queue.
+
+        Args:
+            paths:      The files to checksum
+            workers:    The number of files to hash at once
+            drop_cache: Drop the files from the page cache once they are done, or None for the engine default
+
+        Returns:
+            A map of path to checksum. Files that could not be read are omitted
+        '''
+        ordered: List[Path] = list(paths)
+        todo: queue.Queue[int] = queue.Queue()
+        for i in range(len(ordered)):
+            todo.put(i)
+        for path in ordered[:self.readahead]:
+            self.prefetch(path)
+
+        results: Dict[Path, str] = {}
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                try:
+                    i = todo.get_nowait()
+                except queue.Empty:
+                    return
+                if i + self.readahead < len(ordered):
+                    self.prefetch(ordered[i + self.readahead])
+                try:
+                    digest = self.sha256(ordered[i], drop_cache)
+                except Exception as e:
+                    logger.warning('Unable to calculate checksum of %s: %s', ordered[i], e)
+                    continue
+                with lock:
+                    results[ordered[i]] = digest
+
+        threads = [threading.Thread(target=worker) for _ in range(max(1, min(workers, len(ordered))))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+
+# The global hash engine instance
+hash_engine = HashEngine()
@@ -0,0 +1,280 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Supervised worker processes for decoding
+#
+
+'''
+Supervised worker processes for decoding. The decoders are C libraries, and a
+corrupt or hostile file can hang them or crash the whole process. With an
+IsolatedPool, each file is decoded in a separate worker process with a wall
+clock timeout. A worker that takes too long is killed (along with any ffmpeg
+it started), and a worker that dies is replaced, so one bad file only fails
+itself rather than the processor. The errors raised for these cases are
+IsolationErrors, so the processor can quarantine the file, and skip it in
+later runs. Anything the worker logs is sent back over its connection, and
+handled by the logger of the supervisor, so it ends up in the same log.
+'''
+
+# System Imports
+import os
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+import multiprocessing.connection
+from typing import Any, Callable, List, Optional
+
+# Local Imports
+from media.logger import logger, QueueHandler
+
+
+class IsolationError(Exception):
+    '''
+    A file killed or hung the worker process decoding it
+    '''
+
+
+class DecodeTimeout(IsolationError):
+    '''
+    A worker took longer than the timeout to decode a file
+    '''
+
+
+class WorkerCrashed(IsolationError):
+    '''
+    A worker process died while decoding a file
+    '''
+
+
+class WorkerError(Exception):
+    '''
+    The function raised an exception in the worker process
+    '''
+
+
+class ConnectionHandler(QueueHandler):
+    '''
+    Sends log records to the supervisor over the worker's connection, as
+    ('log', record) messages ahead of the result
+    '''
+
+    def __init__(self, conn: multiprocessing.connection.Connection, lock: threading.Lock):
+        '''
+        Constructor
+
+        Args:
+            conn: The connection to the supervisor
+            lock: The lock that serialises sends on the connection
+        '''
+        super().__init__(None)  # type: ignore[arg-type]
+        self.conn = conn
+        self.send_lock = lock
+
+    def enqueue(self, record: logging.LogRecord):
+        '''
+        Send a prepared record
+
+        Args:
+            record: The record to send
+        '''
+        with self.send_lock:
+            self.conn.send(('log', record))
+
+
+def worker_main(conn: multiprocessing.connection.Connection, level: int = logging.INFO):
+    '''
+    The main loop of a worker process. It calls each function sent on the
+    connection, and sends back the result, until the connection is closed.
+
+    Args:
+        conn:  The connection to the supervisor
+        level: The log level of the supervisor
+    '''
+    # Run in a process group of its own, so any subprocesses can be killed with it
+    os.setpgrp()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    lock = threading.Lock()
+    logger.handlers.clear()
+    logger.addHandler(ConnectionHandler(conn, lock))
+    logger.setLevel(level)
+    logger.propagate = False
+    while True:
+        try:
+            func, args, kwargs = conn.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            result = (True, func(*args, **kwargs))
+        except Exception as e:
+            result = (False, str(e))
+        with lock:
+            try:
+                conn.send(result)
+            except Exception as e:
+                conn.send((False, f'Unable to return the result: {e}'))
+
+
+class Worker:
+    '''
+    A worker process, and the connection to it
+    '''
+
+    def __init__(self, context: multiprocessing.context.BaseContext):
+        '''
+        Constructor
+
+        Args:
+            context: The multiprocessing context to start the process with
+        '''
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child, logger.getEffectiveLevel()), name='media-decoder', daemon=True)  # type: ignore[attr-defined]
+        self.process.start()
+        child.close()
+
+    def call(self, func: Callable, args: tuple, kwargs: dict, timeout: Optional[float]) -> Any:
+        '''
+        Call a function in the worker process. Records the worker logs in the
+        meantime are handled by the logger on the calling thread.
+
+        Args:
+            func:    The function to call. It must be importable by the worker
+            args:    The positional arguments
+            kwargs:  The keyword arguments
+            timeout: The maximum time to wait for the result in seconds, or None to wait forever
+
+        Raises:
+            DecodeTimeout: If the result didn't arrive in time
+            WorkerCrashed: If the worker died
+            WorkerError:   If the function raised an exception
+
+        Returns:
+            The result of the function
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            self.conn.send((func, args, kwargs))
+            while True:
+                if not self.conn.poll(None if deadline is None else max(0.0, deadline - time.monotonic())):
+                    raise DecodeTimeout(f'Timed out after {timeout:g} seconds')
+                ok, value = self.conn.recv()
+                if ok != 'log':
+                    break
+                logger.handle(value)
+        except (EOFError, OSError):
+            self.process.join(1)
+            code = self.process.exitcode
+            if code is not None and code < 0:
+                raise WorkerCrashed(f'Worker killed by {signal.Signals(-code).name}')
+            raise WorkerCrashed(f'Worker exited with code {code}')
+        if not ok:
+            raise WorkerError(value)
+        return value
+
+    def stop(self, kill=False):
+        '''
+        Stop the worker process
+
+        Args:
+            kill: Kill the process (and any subprocesses it started) rather than asking it to exit
+        '''
+        if kill and self.process.pid is not None:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self.conn.close()
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+
+class IsolatedPool:
+    '''
+    A pool of supervised worker processes. Each thread that calls the pool
+    uses a worker of its own for the call, so there are never more workers
+    than threads decoding. Workers are started as they are needed, and a
+    worker that is killed is replaced on the next call.
+    '''
+
+    def __init__(self, timeout: Optional[float] = 300.0):
+        '''
+        Constructor
+
+        Args:
+            timeout: The maximum time for each call in seconds, or None for no limit
+        '''
+        self.timeout = timeout
+        self.context = multiprocessing.get_context('spawn')
+        self.idle: List[Worker] = []
+        self.lock = threading.Lock()
+        self.replaced = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def call(self, func: Callable, *args, **kwargs) -> Any:
+        '''
+        Call a function in a worker process
+
+        Args:
+            func:   The function to call. It must be importable by the worker
+            args:   The positional arguments
+            kwargs: The keyword arguments
+
+        Raises:
+            DecodeTimeout: If the call took longer than the timeout
+            WorkerCrashed: If the worker died during the call
+            WorkerError:   If the function raised an exception
+
+        Returns:
+            The result of the function
+        '''
+        with self.lock:
+            worker = self.idle.pop() if self.idle else None
+        if worker is None:
+            worker = Worker(self.context)
+
+        try:
+            result = worker.call(func, args, kwargs, self.timeout)
+        except WorkerError:
+            self.release(worker)
+            raise
+        except IsolationError as e:
+            logger.warning('Replacing worker %d: %s', worker.process.pid, e)
+            worker.stop(kill=True)
+            with self.lock:
+                self.replaced += 1
+            raise
+        except BaseException:
+            # The state of the worker is unknown, so don't reuse it
+            worker.stop(kill=True)
+            raise
+        self.release(worker)
+        return result
+
+    def release(self, worker: Worker):
+        '''
+        Return a worker to the pool
+
+        Args:
+            worker: The worker
+        '''
+        with self.lock:
+            self.idle.append(worker)
+
+    def close(self):
+        '''
+        Stop the idle workers
+        '''
+        with self.lock:
+            workers, self.idle = self.idle, []
+        for worker in workers:
+            worker.stop()
@@ -0,0 +1,233 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Jobs submitted to the processor daemon
+#
+
+'''
+Jobs submitted to the processor daemon. A job is a batch of paths with a
+priority. Jobs are queued by priority (then in the order they were
+submitted), and record the result of every file they process, so callers
+can wait for a job to complete, or stream the results as they happen.
+'''
+
+# System Imports
+import uuid
+import queue
+import itertools
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional
+
+# 3rd Party Imports
+from pydantic import BaseModel
+
+
+# The job priorities, from highest to lowest
+PRIORITIES = ['interactive', 'sync', 'backfill']
+
+
+class FileResult(BaseModel):
+    '''
+    The result of processing a file in a job
+    '''
+    path: str                   # The path of the file
+    status: str                 # processed, existing, skipped or failed
+    error: Optional[str] = None # The reason the file failed
+
+
+class Job:
+    '''
+    A batch of paths to process
+    '''
+
+    def __init__(self, paths: List[Path], priority: str = 'interactive'):
+        '''
+        Constructor
+
+        Args:
+            paths:    The files and directories to process
+            priority: The priority of the job (one of PRIORITIES)
+
+        Raises:
+            ValueError: If the priority is invalid
+        '''
+        if priority not in PRIORITIES:
+            raise ValueError(f'Invalid priority: {priority}')
+        self.id = uuid.uuid4().hex
+        self.paths = paths
+        self.priority = priority
+        self.state = 'queued'
+        self.error: Optional[str] = None
+        self.results: List[FileResult] = []
+        self.condition = threading.Condition()
+
+    def start(self):
+        '''
+        Mark the job as running
+        '''
+        with self.condition:
+            self.state = 'running'
+            self.condition.notify_all()
+
+    def report(self, path: Path, status: str, error: Optional[str] = None):
+        '''
+        Record the result of a file
+
+        Args:
+            path:   The file
+            status: processed, existing, skipped or failed
+            error:  The reason the file failed
+        '''
+        with self.condition:
+            self.results.append(FileResult(path=str(path), status=status, error=error))
+            self.condition.notify_all()
+
+    def finish(self, error: Optional[str] = None):
+        '''
+        Mark the job as complete
+
+        Args:
+            error: The reason the whole job failed, if it did
+        '''
+        with self.condition:
+            self.state = 'failed' if error else 'complete'
+            self.error = error
+            self.condition.notify_all()
+
+    def is_done(self) -> bool:
+        '''
+        Check if the job has finished
+
+        Returns:
+            True if the job is complete or failed
+        '''
+        return self.state in ('complete', 'failed')
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        '''
+        Wait for the job to finish
+
+        Args:
+            timeout: The maximum time to wait in seconds, or None to wait forever
+
+        Returns:
+            True if the job finished
+        '''
+        with self.condition:
+            return self.condition.wait_for(self.is_done, timeout)
+
+    def stream(self, timeout: Optional[float] = None) -> Iterator[FileResult]:
+        '''
+        Iterate over the file results as they are recorded, until the job
+        finishes
+
+        Args:
+            timeout: The maximum time to wait for each result, or None to wait forever
+
+        Yields:
+            Each file result
+        '''
+        sent = 0
+        while True:
+            with self.condition:
+                if not self.condition.wait_for(lambda: len(self.results) > sent or self.is_done(), timeout):
+                    return
+                results = self.results[sent:]
+                done = self.is_done()
+            yield from results
+            sent += len(results)
+            if done:
+                return
+
+    def summary(self, results=False) -> Dict:
+        '''
+        Summarise the job
+
+        Args:
+            results: Include the result of every file
+
+        Returns:
+            The job id, priority, state, error and a count of each file status
+        '''
+        with self.condition:
+            counts: Dict[str, int] = {}
+            for result in self.results:
+                counts[result.status] = counts.get(result.status, 0) + 1
+            res = {'job': self.id, 'priority': self.priority, 'state': self.state, 'error': self.error, 'counts': counts}
+            if results:
+                res['results'] = [r.model_dump() for r in self.results]
+            return res
+
+
+class JobQueue:
+    '''
+    A queue of jobs ordered by priority, which also keeps the most recent
+    jobs so their results can be fetched after they finish
+    '''
+
+    def __init__(self, history=1000):
+        '''
+        Constructor
+
+        Args:
+            history: The number of jobs to keep
+        '''
+        self.queue: queue.PriorityQueue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.jobs: OrderedDict[str, Job] = OrderedDict()
+        self.history = history
+        self.lock = threading.Lock()
+
+    def submit(self, paths: List[Path], priority: str = 'interactive') -> Job:
+        '''
+        Queue a new job
+
+        Args:
+            paths:    The files and directories to process
+            priority: The priority of the job (one of PRIORITIES)
+
+        Raises:
+            ValueError: If the priority is invalid
+
+        Returns:
+            The job
+        '''
+        job = Job(paths, priority)
+        with self.lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.history:
+                self.jobs.popitem(last=False)
+        self.queue.put((PRIORITIES.index(priority), next(self.counter), job))
+        return job
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Job]:
+        '''
+        Get the next job to run
+
+        Args:
+            timeout: The maximum time to wait for a job, or None to wait forever
+
+        Returns:
+            The highest priority job, or None if there wasn't one before the timeout
+        '''
+        try:
+            return self.queue.get(timeout=timeout)[2]
+        except queue.Empty:
+            return None
+
+    def find(self, id: str) -> Optional[Job]:
+        '''
+        Find a job by id
+
+        Args:
+            id: The job id
+
+        Returns:
+            The job, or None if it isn't known
+        '''
+        with self.lock:
+            return self.jobs.get(id)
@@ -0,0 +1,98 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Deferred imports of heavy modules
+#
+
+'''
+Deferred imports of heavy modules. Decoding libraries like av, Pillow and
+numpy take a large part of the startup time of the scripts, but many runs
+never decode a file of the type they handle (eg. a dry run, or a run that
+only finds known files). A LazyModule stands in for a module at import time,
+and only imports it on the first attribute access.
+'''
+
+# System Imports
+import importlib
+import threading
+from types import ModuleType
+from typing import Callable, Optional
+
+
+class LazyModule:
+    '''
+    A proxy for a module that is imported on first use. Getting, setting and
+    deleting attributes are all passed through to the real module, so it can
+    be used (and patched in tests) like the module itself.
+    '''
+
+    def __init__(self, name: str, optional: bool = False, on_load: Optional[Callable[[ModuleType], None]] = None):
+        '''
+        Constructor
+
+        Args:
+            name:     The full name of the module to import
+            optional: The module may not be installed. Use bool() on the proxy to check if it is
+            on_load:  A function to call with the module once it has been imported
+        '''
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_optional', optional)
+        object.__setattr__(self, '_on_load', on_load)
+        object.__setattr__(self, '_module', None)
+        object.__setattr__(self, '_missing', False)
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    def _load(self) -> Optional[ModuleType]:
+        '''
+        Import the module, if it hasn't been already
+
+        Returns:
+            The module, or None if it is optional and not installed
+        '''
+        if self._module is not None or self._missing:
+            return self._module
+        with self._lock:
+            if self._module is None and not self._missing:
+                try:
+                    module = importlib.import_module(self._name)
+                except ImportError:
+                    if not self._optional:
+                        raise
+                    object.__setattr__(self, '_missing', True)
+                    return None
+                if self._on_load is not None:
+                    self._on_load(module)
+                object.__setattr__(self, '_module', module)
+        return self._module
+
+    def _require(self) -> ModuleType:
+        '''
+        Import the module, and fail if it isn't installed
+
+        Raises:
+            ImportError: If the module isn't installed
+
+        Returns:
+            The module
+        '''
+        module = self._load()
+        if module is None:
+            raise ImportError(f'No module named {self._name!r}')
+        return module
+
+    def __bool__(self) -> bool:
+        return self._load() is not None
+
+    def __getattr__(self, attr: str):
+        return getattr(self._require(), attr)
+
+    def __setattr__(self, attr: str, value):
+        setattr(self._require(), attr, value)
+
+    def __delattr__(self, attr: str):
+        delattr(self._require(), attr)
+
+    def __repr__(self) -> str:
+        return f'<LazyModule {self._name!r} ({"loaded" if self._module is not None else "not loaded"})>'
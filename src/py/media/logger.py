@@ -7,13 +7,21 @@
 #
 
 '''
-Global app logger
+Global app logger. By default, records are put on a queue by the thread that
+logs them, and written out by a single listener thread, so the processing
+threads never wait on the handler lock or a disk write. Records can also be
+written as JSON lines, for log shipping.
 '''
 
 # System Imports
 import sys
+import copy
+import json
+import queue
+import atexit
 import signal
 import logging
+import logging.handlers
 from pathlib import Path
 from typing import Optional
 
@@ -21,6 +29,66 @@ from typing import Optional
 # The global app logger instance
 logger = logging.getLogger('media')
 
+# The listener that writes out queued records, if the logger is in queue mode
+listener: Optional[logging.handlers.QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    Formats each record as a single line JSON object
+    '''
+
+    def format(self, record: logging.LogRecord) -> str:
+        '''
+        Format a record
+
+        Args:
+            record: The record to format
+
+        Returns:
+            The JSON encoded record
+        '''
+        data = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    '''
+    Puts records on a queue for a QueueListener. Unlike the standard
+    QueueHandler, the record isn't formatted before it is queued. Only its
+    message is merged with its args (in case they change before the listener
+    gets to it), and any exception is rendered to text, so the listener's
+    formatter still sees the parts of the record separately.
+    '''
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        '''
+        Prepare a record for queuing
+
+        Args:
+            record: The record to prepare
+
+        Returns:
+            A copy of the record, safe to format on another thread
+        '''
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
 
 def set_log_level(level: int):  # pragma: no cover
     '''
@@ -32,19 +100,32 @@ def set_log_level(level: int):  # pragma: no cover
     '''
     level = max(logging.DEBUG, min(level, logging.CRITICAL))
     logger.setLevel(logging.INFO)
-    logger.info(f'Setting log level to %s', logging.getLevelName(level))
+    logger.info('Setting log level to %s', logging.getLevelName(level))
     logger.setLevel(level)
 
 
-def init_logger(path: Optional[Path] = None, debug: bool = False):  # pragma: no cover
+def stop_logger():  # pragma: no cover
+    '''
+    Write out any queued records and stop the listener thread
+    '''
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+def init_logger(path: Optional[Path] = None, debug: bool = False, json_format: bool = False, use_queue: bool = True):  # pragma: no cover
     '''
     Setup the logging
 
     Args:
-        logger: The logger object to setup
-        path:   Path to the desired logfile
-        debug:  Whether to enable debug logging
+        logger:      The logger object to setup
+        path:        Path to the desired logfile
+        debug:       Whether to enable debug logging
+        json_format: Write each record as a line of JSON, rather than plain text
+        use_queue:   Write records from a listener thread, so logging never blocks the caller
     '''
+    global listener
     set_log_level(logging.DEBUG if debug else logging.INFO)
     signal.signal(signal.SIGUSR1, lambda *_: set_log_level(logger.level - 10))
     signal.signal(signal.SIGUSR2, lambda *_: set_log_level(logger.level + 10))
@@ -52,13 +133,13 @@ def init_logger(path: Optional[Path] = None, debug: bool = False):  # pragma: no
     fmt = '%(asctime)s.%(msecs)03d | %(levelname)-8s | %(message)s'
     timefmt = '%Y/%m/%d %H:%M:%S'
 
-    if path is not None:
-        handler = logging.FileHandler(path)
-        formatter = logging.Formatter(fmt, timefmt)
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
-    else:
-        stderr_handler = logging.StreamHandler(sys.stderr)
-        formatter = logging.Formatter(fmt, timefmt)
-        stderr_handler.setFormatter(formatter)
-        logger.addHandler(stderr_handler)
+    handler: logging.Handler = logging.FileHandler(path) if path is not None else logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(fmt, timefmt))
+
+    if use_queue:
+        records: queue.SimpleQueue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(records, handler)
+        listener.start()
+        atexit.register(stop_logger)
+        handler = QueueHandler(records)
+    logger.addHandler(handler)
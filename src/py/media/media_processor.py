@@ -11,25 +11,82 @@ The processor class
 '''
 
 # System Imports
+import os
 import sys
 import json
+import time
+import logging
+import multiprocessing
 import concurrent.futures
 from pathlib import Path
-from typing import List, Set
+from typing import Callable, Dict, List, Optional, Set, Tuple, TypeVar
 
 # Local Imports
-from media.model import FileMetadata
-from media.util import load_file_metadata
+from media.model import FileMetadata, MediaBatch
+from media.util import load_file_metadata, load_thumbnails, clone_file_metadata, calculate_fingerprint, get_file_stats, estimate_decode_size
+from media.hashing import hash_engine
+from media.cache import ExtractionCache, read_sha256_xattr, write_sha256_xattr
+from media.copier import CopiedFile
+from media.jobs import Job, JobQueue
+from media.scheduler import Scheduler
+from media.concurrency import ConcurrencyController
+from media.admission import DecodeBudget
+from media.geo import quadkeys
+from media.isolation import IsolatedPool, IsolationError
 from media.logger import logger
 from media.database import db
 
 
+T = TypeVar('T')
+
+# A function to record the result of processing a file: (path, status, error)
+Reporter = Callable[[Path, str, Optional[str]], None]
+
+
+def regenerate_thumbnails(row: Tuple[int, str, str]) -> Tuple[int, Optional[FileMetadata]]:
+    '''
+    Regenerate the thumbnails of an indexed file. This runs in a worker
+    process, so it only returns the new thumbnails rather than writing them.
+
+    Args:
+        row: The (id, path, type) of the file
+
+    Returns:
+        A tuple of the id, and the file with its new thumbnails (or None if it failed)
+    '''
+    id, path, type = row
+    file = FileMetadata(path=path, type=type, timestamp=0, size=0)
+    try:
+        load_thumbnails(file)
+    except Exception as e:
+        logger.error('Unable to regenerate thumbnails for %s: %s', path, e)
+        return id, None
+    return id, file
+
+
+def walk_files(root: Path) -> Set[str]:
+    '''
+    List every file under a directory. This uses the file types from the
+    directory listing, so the files aren't stat'd.
+
+    Args:
+        root: The directory
+
+    Returns:
+        The paths of the files, in the same form as they are stored in the database
+    '''
+    files: Set[str] = set()
+    for dirpath, _, filenames in os.walk(root.as_posix()):
+        files.update(os.path.join(dirpath, name) for name in filenames)
+    return files
+
+
 class MediaProcessor:
     '''
     The class to process and insert media files into the database
     '''
 
-    def __init__(self, ncpu=2, dry_run=False, use_file_mtime=False):
+    def __init__(self, ncpu=2, dry_run=False, use_file_mtime=False, dedup=False, defer_sha256=False, cache: Optional[ExtractionCache] = None, use_xattr=False, controller: Optional[ConcurrencyController] = None, budget: Optional[DecodeBudget] = None, isolation: Optional[IsolatedPool] = None):
         '''
         Constructor
 
@@ -37,56 +94,68 @@ class MediaProcessor:
             ncpu:            Number of CPUs to parallelise processing
             dry_run:         Don't make changes, just log what would be done
             use_file_mtime:  Use the filesystem mtime rather than exit timestamp
+            dedup:           Reuse the metadata of already indexed files with the same contents
+            defer_sha256:    Only calculate checksums needed for dedup, and leave the rest for backfill_hashes()
+            cache:           A local cache of extracted metadata to use and fill
+            use_xattr:       Read and store file checksums in extended attributes
+            controller:      Sets the number of workers for each stage, instead of ncpu
+            budget:          Limits the memory of the images being decoded at once
+            isolation:       Decode the files in supervised worker processes, and quarantine the ones that hang or crash them
         '''
         self.ncpu = ncpu
         self.dry_run = dry_run
         self.use_file_mtime = use_file_mtime
+        self.dedup = dedup
+        self.defer_sha256 = defer_sha256
+        self.cache = cache
+        self.use_xattr = use_xattr
+        self.controller = controller
+        self.budget = budget
+        self.isolation = isolation
 
-    def validate_file(self, file: FileMetadata):
+    def workers(self, stage: str) -> int:
         '''
-        Validate that a file has all the necessary fields set
+        Get the number of workers to use for a stage
 
-        Raises:
-            ValueError: If the validation fails
-
-        Args:
-            file: The file to validate
-        '''
-        if not Path(file.path).exists():
-            raise ValueError('Validation failed: file does not exist')
-        if file.type not in ['video', 'image']:
-            raise ValueError(f'Validation failed: Invalid type of {file.type}')
-        if not isinstance(file.timestamp, int) or file.timestamp == 0:
-            raise ValueError(f'Validation failed: invalid timestamp of {file.timestamp}')
-        if not isinstance(file.size, int) or file.size == 0:
-            raise ValueError(f'Validation failed: invalid size of {file.size}')
-        if not isinstance(file.width, int) or file.width == 0:
-            raise ValueError(f'Validation failed: invalid width of {file.width}')
-        if not isinstance(file.height, int) or file.height == 0:
-            raise ValueError(f'Validation failed: invalid length of {file.height}')
-        if file.type == 'video' and (not isinstance(file.duration, int) or file.duration == 0):
-            raise ValueError(f'Validation failed: Invalid video duration of {file.duration}')
-        if file.type == 'image' and file.duration is not None:
-            raise ValueError(f'Validation failed: Duration must not be set for images: {file.duration}')
-        if not (file.latitude is None or ((isinstance(file.latitude, int) or isinstance(file.latitude, float)))):
-            raise ValueError(f'Validation failed: Invalid latitude of {file.latitude}')
-        if not (file.longitude is None or ((isinstance(file.longitude, int) or isinstance(file.longitude, float)))):
-            raise ValueError(f'Validation failed: Invalid longitude of {file.longitude}')
-        if file.make is not None and (not isinstance(file.make, str) or file.make == ''):
-            raise ValueError(f'Validation failed: Invalid make of {file.make}')
-        if file.model is not None and (not isinstance(file.model, str) or file.model == ''):
-            raise ValueError(f'Validation failed: Invalid model of {file.model}')
-        if not isinstance(file.sha256, str) or len(file.sha256) != 64:
-            raise ValueError(f'Validation failed: Invalid sha256 of {file.sha256}')
-        if not isinstance(file.thumbnail, bytes) or len(file.thumbnail) == 0:
-            raise ValueError(f'Validation failed: Invalid thumbnail of {file.thumbnail!r}')
-
-    def get_file_list(self, paths: List[Path]) -> Set[Path]:
+        Args:
+            stage: io (fingerprints and checksums) or decode (metadata and thumbnails)
+
+        Returns:
+            The number of workers
+        '''
+        return self.controller.get(stage) if self.controller is not None else self.ncpu
+
+    def validate_batch(self, files: List[FileMetadata], counts: Dict[str, int], report: Optional[Reporter] = None) -> List[FileMetadata]:
+        '''
+        Validate a batch of freshly loaded files at once. The files were
+        stat'd as they were loaded, so they aren't checked for existence again.
+
+        Args:
+            files:  The files to validate
+            counts: The running counts of processed and failed files, updated in place
+            report: A function to call with the result of each file that fails
+
+        Returns:
+            The files that are valid
+        '''
+        batch = MediaBatch(files)
+        errors = batch.validate(require_sha256=not self.defer_sha256)
+        for i, error in errors.items():
+            logger.error('Unable to process %s: %s', batch.columns['path'][i], error)
+            if report is not None:
+                report(Path(batch.columns['path'][i]), 'failed', error)
+        counts['processed'] -= len(errors)
+        counts['failed'] += len(errors)
+        return [f for i, f in enumerate(files) if i not in errors]
+
+    def get_file_list(self, paths: List[Path], strip_existing=True, report: Optional[Reporter] = None) -> Set[Path]:
         '''
         Get the list of files that need to be processed
 
         Args:
-            paths: List of paths to search
+            paths:          List of paths to search
+            strip_existing: Leave out files that are already in the database
+            report:         A function to call with each file that is already in the database
 
         Returns:
             List of files that need to be processed
@@ -98,54 +167,686 @@ class MediaProcessor:
             else:
                 files |= {f for f in path.rglob('*') if f.is_file()}
         logger.info(f'Found {len(files)} files to process')
+        if not strip_existing:
+            return files
 
         to_process = db.strip_existing_paths(files)
-        skip_count = len(files - to_process)
+        existing = files - to_process
+        skip_count = len(existing)
+        if report is not None:
+            for path in existing:
+                report(path, 'existing', None)
         if skip_count:
             logger.info(f'Ignoring {skip_count} file{"s" if skip_count > 1 else ""} that are already processed')
 
-        return to_process
+        return self.strip_quarantined(to_process, report)
+
+    def strip_quarantined(self, paths: Set[Path], report: Optional[Reporter] = None) -> Set[Path]:
+        '''
+        Leave out the files that are quarantined. A quarantined file is tried
+        again once its size changes.
+
+        Args:
+            paths:  The files to check
+            report: A function to call with each file that is left out
+
+        Returns:
+            The files that aren't quarantined
+        '''
+        quarantined = set()
+        for path, (size, reason) in db.get_quarantined(paths).items():
+            try:
+                if get_file_stats(path)[1] != size:
+                    continue
+            except OSError:
+                continue
+            quarantined.add(path)
+            if report is not None:
+                report(path, 'skipped', f'Quarantined: {reason}')
+        if quarantined:
+            logger.info(f'Ignoring {len(quarantined)} quarantined file{"s" if len(quarantined) > 1 else ""}')
+        return paths - quarantined
+
+    def quarantine(self, paths: List[Path], reason: str):
+        '''
+        Quarantine files that hung or crashed a worker, so later runs skip them
+
+        Args:
+            paths:  The files (which all have the same contents)
+            reason: Why the files are quarantined
+        '''
+        for path in paths:
+            logger.warning('Quarantining %s: %s', path, reason)
+            if self.dry_run:
+                continue
+            try:
+                db.quarantine_file(path, get_file_stats(path)[1], reason)
+            except OSError as e:
+                logger.warning('Unable to quarantine %s: %s', path, e)
+
+    def map_files(self, func: Callable[[Path], T], paths: Set[Path]) -> Dict[Path, T]:
+        '''
+        Call a function on a set of files in parallel
+
+        Args:
+            func:  The function to call on each file
+            paths: The files to call the function on
+
+        Returns:
+            A map of path to result. Files that the function fails on are omitted
+        '''
+        results: Dict[Path, T] = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers('io')) as executor:
+            futures = {executor.submit(func, p): p for p in paths}
+            for future in concurrent.futures.as_completed(futures):
+                path = futures[future]
+                try:
+                    results[path] = future.result()
+                except Exception as e:
+                    logger.warning('Unable to read %s: %s', path, e)
+        return results
+
+    def find_fingerprint_matches(self, fingerprints: Dict[Path, str]) -> Set[Path]:
+        '''
+        Find the files that may have the same contents as already indexed
+        media, or as another file in the same batch. All other files are
+        guaranteed to be unique.
+
+        Args:
+            fingerprints: A map of path to fingerprint for the files to check
+
+        Returns:
+            The set of files that need a full checksum to rule out duplicates
+        '''
+        counts: Dict[str, int] = {}
+        for fingerprint in fingerprints.values():
+            counts[fingerprint] = counts.get(fingerprint, 0) + 1
+        existing = db.find_fingerprints(set(fingerprints.values()))
+        return {p for p, f in fingerprints.items() if f in existing or counts[f] > 1}
 
-    def run(self, paths: List[Path]):
+    def find_duplicates(self, hashes: Dict[Path, str], fingerprints: Dict[Path, str]) -> Tuple[Dict[Path, FileMetadata], Dict[Path, List[Path]], Dict[Path, str]]:
+        '''
+        Find files that have the same contents as already indexed media, or
+        as another file in the same batch
+
+        Args:
+            hashes:       A map of path to checksum for the files to check
+            fingerprints: A map of path to fingerprint, to give the cloned metadata
+
+        Returns:
+            A tuple of a map of path to the metadata cloned from already indexed
+            media, a map of a file to process to the other files in the batch
+            that have the same contents, and a map of path to the error for the
+            files that could no longer be read
+        '''
+        if not hashes:
+            return {}, {}, {}
+
+        failed: Dict[Path, str] = {}
+        groups: Dict[Tuple[str, int], List[Path]] = {}
+        for path, sha256 in hashes.items():
+            try:
+                _, size = get_file_stats(path)
+            except OSError as e:
+                failed[path] = str(e)
+                continue
+            groups.setdefault((sha256, size), []).append(path)
+
+        existing = {(f.sha256, f.size): f for f in db.find_media_by_sha256({hashes[p] for group in groups.values() for p in group})}
+        cloned: Dict[Path, FileMetadata] = {}
+        duplicates: Dict[Path, List[Path]] = {}
+        for key, group in groups.items():
+            group.sort()
+            if key in existing:
+                for path in group:
+                    try:
+                        cloned[path] = clone_file_metadata(path, existing[key], self.use_file_mtime, fingerprints.get(path))
+                    except OSError as e:
+                        failed[path] = str(e)
+            else:
+                duplicates[group[0]] = group[1:]
+
+        return cloned, duplicates, failed
+
+    def hash_files(self, paths: Set[Path], drop_cache=False) -> Dict[Path, str]:
+        '''
+        Calculate the sha256 checksum of a set of files in parallel, using the
+        checksums stored in extended attributes where possible
+
+        Args:
+            paths:      The files to checksum
+            drop_cache: Drop the files from the page cache once they are hashed
+
+        Returns:
+            A map of path to checksum. Files that could not be read are omitted
+        '''
+        hashes: Dict[Path, str] = {}
+        if self.use_xattr:
+            hashes = {p: h for p in paths if (h := read_sha256_xattr(p)) is not None}
+        calculated = hash_engine.hash_files([p for p in paths if p not in hashes], self.workers('io'), drop_cache)
+        if self.use_xattr and not self.dry_run:
+            for path, sha256 in calculated.items():
+                write_sha256_xattr(path, sha256)
+        return hashes | calculated
+
+    def load_file(self, path: Path, sha256: Optional[str] = None, fingerprint: Optional[str] = None) -> Optional[FileMetadata]:
+        '''
+        Load the metadata for a file, using the local cache if possible
+
+        Args:
+            path:        Path of the file to load
+            sha256:      The checksum of the file, if it is already known
+            fingerprint: The fingerprint of the file, if it is already known
+
+        Returns:
+            The file metadata, or None if it couldn't be loaded
+        '''
+        if self.cache is not None:
+            file = self.cache.get(path, self.use_file_mtime)
+            if file is not None:
+                logger.debug('Loaded %s from cache', path)
+                if file.sha256 is None and not self.defer_sha256:
+                    file.sha256 = sha256 or hash_engine.sha256(path)
+                    if not self.dry_run:
+                        self.cache.put(file, self.use_file_mtime)
+                return file
+
+        if sha256 is None and self.use_xattr:
+            sha256 = read_sha256_xattr(path)
+
+        if self.budget is None:
+            file = self.decode_file(path, sha256, fingerprint)
+        else:
+            with self.budget.admit(estimate_decode_size(path)) as alone:
+                file = self.decode_file(path, sha256, fingerprint, reduce=alone)
+        if file is None or self.dry_run:
+            return file
+
+        if self.cache is not None:
+            self.cache.put(file, self.use_file_mtime)
+        if self.use_xattr and file.sha256 is not None and file.sha256 != sha256:
+            write_sha256_xattr(path, file.sha256)
+        return file
+
+    def decode_file(self, path: Path, sha256: Optional[str], fingerprint: Optional[str], reduce=False) -> Optional[FileMetadata]:
+        '''
+        Extract the metadata of a file, in a worker process if isolation is enabled
+
+        Args:
+            path:        Path of the file to load
+            sha256:      The checksum of the file, if it is already known
+            fingerprint: The fingerprint of the file, if it is already known
+            reduce:      Decode images at a reduced size where possible
+
+        Raises:
+            IsolationError: If the file hung or crashed the worker
+
+        Returns:
+            The file metadata, or None if it isn't a media file
+        '''
+        if self.isolation is not None:
+            return self.isolation.call(load_file_metadata, path, self.use_file_mtime, sha256=sha256, fingerprint=fingerprint, defer_sha256=self.defer_sha256, reduce=reduce)
+        return load_file_metadata(path, self.use_file_mtime, sha256=sha256, fingerprint=fingerprint, defer_sha256=self.defer_sha256, reduce=reduce)
+
+    def process_files(self, to_process: Set[Path], counts: Dict[str, int], total: int, copied: Optional[Dict[Path, CopiedFile]] = None, report: Optional[Reporter] = None) -> List[FileMetadata]:
+        '''
+        Extract and validate the metadata of a set of files
+
+        Args:
+            to_process: The files to process
+            counts:     The running counts of processed, skipped, failed and deduplicated files, updated in place
+            total:      The total number of files being processed, for progress updates
+            copied:     Files that were just copied into place, with checksums calculated during the copy
+            report:     A function to call with the result of each file that is skipped or fails
+
+        Returns:
+            The metadata of the files that were processed successfully
+        '''
+        processed: List[FileMetadata] = []
+        # Only trust a checksum from a copy if the file hasn't changed since
+        hashes: Dict[Path, str] = {p: c.sha256 for p, c in (copied or {}).items() if p in to_process and c.sha256 is not None and c.is_current()}
+        duplicates: Dict[Path, List[Path]] = {}
+        clones: Set[str] = set()
+        to_decode = to_process
+        db.update_progress('processor', 'fingerprinting', counts['processed'], total)
+        fingerprints = self.map_files(calculate_fingerprint, to_process)
+        if self.dedup:
+            to_hash = self.find_fingerprint_matches(fingerprints)
+            db.update_progress('processor', 'hashing', counts['processed'], total)
+            hashes |= self.hash_files({p for p in to_hash if p not in hashes})
+            cloned, duplicates, failed = self.find_duplicates(hashes, fingerprints)
+            processed += cloned.values()
+            counts['processed'] += len(cloned)
+            clones |= {str(p) for p in cloned}
+            counts['failed'] += len(failed)
+            for path, error in failed.items():
+                logger.error('Unable to process %s: %s', path, error)
+                if report is not None:
+                    report(path, 'failed', error)
+            skip = set(cloned) | set(failed) | {p for group in duplicates.values() for p in group}
+            to_decode = {p for p in to_process if p not in skip}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers('decode')) as executor:
+            futures = {executor.submit(self.load_file, p, hashes.get(p), fingerprints.get(p)): p for p in to_decode}
+            for future in concurrent.futures.as_completed(futures):
+                path = futures.get(future)
+                dups = duplicates.get(path, [])
+                try:
+                    file = future.result()
+                    if file is not None:
+                        processed.append(file)
+                        processed += [clone_file_metadata(p, file, self.use_file_mtime, fingerprints.get(p)) for p in dups]
+                        counts['processed'] += 1 + len(dups)
+                        clones |= {str(p) for p in dups}
+                    else:
+                        counts['skipped'] += 1 + len(dups)
+                        if report is not None:
+                            for p in [path] + dups:
+                                report(p, 'skipped', None)
+                except Exception as e:
+                    logger.error('Unable to process %s: %s', path, e)
+                    if isinstance(e, IsolationError):
+                        self.quarantine([path] + dups, str(e))
+                    counts['failed'] += 1 + len(dups)
+                    if report is not None:
+                        for p in [path] + dups:
+                            report(p, 'failed', str(e))
+
+                db.update_progress('processor', 'processing', counts['processed'], total, {k: v for k, v in counts.items() if k != 'processed'})
+
+        valid = self.validate_batch(processed, counts, report)
+        # Only count the clones that passed validation, so the hit rate is of the files inserted
+        counts['deduplicated'] += sum(1 for f in valid if f.path in clones)
+        return valid
+
+    def log_summary(self, counts: Dict[str, int], total: int):
+        '''
+        Log the final counts of a run and mark it complete
+
+        Args:
+            counts: The counts of processed, skipped, failed and deduplicated files
+            total:  The total number of files that were processed
+        '''
+        logger.info(f'Processed: {counts["processed"]}, skipped: {counts["skipped"]}, failed: {counts["failed"]}')
+        if self.dedup and total:
+            logger.info(f'Deduplicated: {counts["deduplicated"]} of {total} files ({100 * counts["deduplicated"] / total:.1f}% hit rate)')
+        db.update_progress('processor', 'complete', counts['processed'], total, {k: v for k, v in counts.items() if k != 'processed'})
+
+    def insert_files(self, processed: List[FileMetadata]):
+        '''
+        Insert processed files into the database, or log them on a dry run
+
+        Args:
+            processed: The files to insert
+        '''
+        if self.dry_run:
+            if logger.isEnabledFor(logging.INFO):
+                logger.info('%s', json.dumps(MediaBatch(processed).records(exclude=frozenset({'thumbnail', 'thumbnails', 'storyboard'}))))
+        else:
+            db.bulk_insert_media(processed)
+
+    def run(self, paths: List[Path], copied: Optional[Dict[Path, CopiedFile]] = None, report: Optional[Reporter] = None):
         '''
         Process all the files in the provided directory
 
         Args:
-            paths: The list of paths to process
+            paths:  The list of paths to process
+            copied: Files that were just copied into place, with checksums calculated during the copy
+            report: A function to call with the result of each file, once it is known
 
         Returns:
             The counts of processed, skipped and failed files in the directory
         '''
         with db.lock():
-            logger.info(f'Processing {paths}')
+            logger.info('Processing %s', paths)
             db.update_progress('processor', 'starting')
-            to_process = self.get_file_list(paths)
+            to_process = self.get_file_list(paths, report=report)
             logger.info(f'Processing {len(to_process)} files')
 
-            processed: List[FileMetadata] = []
-            skipped_count = 0
+            counts = {'processed': 0, 'skipped': 0, 'failed': 0, 'deduplicated': 0}
+            processed = self.process_files(to_process, counts, len(to_process), copied, report)
+            self.insert_files(processed)
+            if report is not None:
+                for file in processed:
+                    report(Path(file.path), 'processed', None)
+            self.log_summary(counts, len(to_process))
+
+    def schedule_job(self, job: Job, scheduler: Scheduler):
+        '''
+        Find the files of a job that need to be processed, and schedule them
+
+        Args:
+            job:       The job
+            scheduler: The scheduler to add the files to
+        '''
+        job.start()
+        try:
+            files: Dict[Path, float] = {}
+            for path in self.get_file_list(job.paths, report=job.report):
+                try:
+                    files[path] = get_file_stats(path)[0]
+                except OSError as e:
+                    job.report(path, 'failed', str(e))
+        except Exception as e:
+            logger.error('Unable to schedule job %s: %s', job.id, e)
+            job.finish(str(e))
+            return
+        logger.info('Scheduled %d files for job %s at %s priority', len(files), job.id, job.priority)
+        scheduler.add(job, files)
+
+    def run_jobs(self, job: Job, jobs: JobQueue, chunk_size: Optional[int] = None):
+        '''
+        Run a job, along with any jobs that are submitted while it runs. The
+        files of every job are processed a few at a time in priority order
+        (see media/scheduler.py), and each chunk is inserted before the next
+        is started, so the files of a new high priority job are picked up as
+        soon as the files in progress are done.
+
+        Args:
+            job:        The first job to run
+            jobs:       The queue to take any new jobs from
+            chunk_size: The number of files to process at a time (defaults to twice the decode workers)
+        '''
+        scheduler = Scheduler()
+        with db.lock():
+            db.update_progress('processor', 'starting')
+            counts = {'processed': 0, 'skipped': 0, 'failed': 0, 'deduplicated': 0}
+            next_job: Optional[Job] = job
+            while True:
+                # Schedule any new jobs, so their files can jump ahead of the ones already waiting
+                while next_job is not None:
+                    self.schedule_job(next_job, scheduler)
+                    next_job = jobs.get(0)
+
+                chunk = scheduler.take(chunk_size or 2 * self.workers('decode'))
+                if not chunk:
+                    break
+                total = counts['processed'] + counts['skipped'] + counts['failed'] + len(scheduler)
+                try:
+                    start = time.monotonic()
+                    processed = self.process_files(set(chunk), counts, total, report=scheduler.report)
+                    insert_start = time.monotonic()
+                    self.insert_files(processed)
+                    if self.controller is not None:
+                        self.controller.record(len(chunk), time.monotonic() - start, time.monotonic() - insert_start)
+                except Exception as e:
+                    logger.error('Unable to process %d files: %s', len(chunk), e)
+                    processed = []
+                    for path in chunk:
+                        scheduler.report(path, 'failed', str(e))
+                for file in processed:
+                    scheduler.report(Path(file.path), 'processed')
+                next_job = jobs.get(0)
+
+            self.log_summary(counts, counts['processed'] + counts['skipped'] + counts['failed'])
+
+    def find_moves(self, missing: List[Tuple[int, int, Optional[str], Optional[str]]], new: Set[Path]) -> List[Tuple[int, Path]]:
+        '''
+        Match new files to indexed media whose files are gone. Candidates must
+        have the same size, then the same fingerprint, and then the same
+        checksum. Only the files that pass each step are read for the next, so
+        most new files are never read at all.
+
+        Args:
+            missing: The (id, size, sha256, fingerprint) of the media whose files are gone
+            new:     The files that aren't indexed
+
+        Returns:
+            A list of (id, new path) tuples for the media that was moved
+        '''
+        by_size: Dict[int, List[Tuple[int, int, Optional[str], Optional[str]]]] = {}
+        for row in missing:
+            by_size.setdefault(row[1], []).append(row)
+
+        sizes: Dict[Path, int] = {}
+        for path in new:
+            try:
+                size = get_file_stats(path)[1]
+            except OSError:
+                continue
+            if size in by_size:
+                sizes[path] = size
+
+        fingerprints = self.map_files(calculate_fingerprint, set(sizes))
+        candidates = {p: [r for r in by_size[s] if r[3] is None or r[3] == fingerprints.get(p)] for p, s in sizes.items()}
+        hashes = self.hash_files({p for p, rows in candidates.items() if any(r[2] is not None for r in rows)})
+
+        moves: List[Tuple[int, Path]] = []
+        matched: Set[int] = set()
+        for path in sorted(candidates):
+            for id, _, sha256, fingerprint in candidates[path]:
+                if id in matched:
+                    continue
+                # A fingerprint is enough when the checksum was deferred, but one of them must match
+                if (sha256 is not None and hashes.get(path) != sha256) or (sha256 is None and fingerprint is None):
+                    continue
+                moves.append((id, path))
+                matched.add(id)
+                break
+        return moves
+
+    def reconcile(self, paths: List[Path], batch_size=1000):
+        '''
+        Bring the index of a set of directories up to date with files that
+        were moved, renamed or deleted. The files on disk are diffed against
+        the indexed paths, indexed media whose file is gone is matched to a
+        new file with the same contents (see find_moves) and has its path
+        updated in place, and the rest of it is deleted. New files that
+        aren't moves are left for run() to process.
+
+        Args:
+            paths:      The directories to reconcile
+            batch_size: The number of rows to delete in each statement
+
+        Raises:
+            ValueError: If a path isn't a directory, eg. an unmounted drive
+        '''
+        with db.lock():
+            logger.info('Reconciling %s', paths)
+            db.update_progress('reconcile', 'scanning')
+            on_disk: Set[str] = set()
+            indexed: Dict[str, int] = {}
+            for root in paths:
+                # An empty listing would delete everything under it
+                if not root.is_dir():
+                    raise ValueError(f'{root} is not a directory')
+                on_disk |= walk_files(root)
+                indexed |= db.get_media_paths(root)
+
+            gone = [id for path, id in indexed.items() if path not in on_disk]
+            new = {Path(p) for p in on_disk if p not in indexed}
+            logger.info(f'Found {len(gone)} indexed files that are gone, and {len(new)} new files')
+
+            moves: List[Tuple[int, Path]] = []
+            if gone and new:
+                db.update_progress('reconcile', 'matching', 0, len(gone))
+                moves = self.find_moves(db.get_media_hashes(gone), new)
+            moved = {id for id, _ in moves}
+            deleted = [id for id in gone if id not in moved]
+            if not self.dry_run:
+                db.move_media(moves)
+                for i in range(0, len(deleted), batch_size):
+                    db.delete_media(deleted[i:i + batch_size])
+            elif logger.isEnabledFor(logging.INFO):
+                logger.info('%s', json.dumps({'moved': {id: str(p) for id, p in moves}, 'deleted': deleted}))
+
+            logger.info(f'Moved: {len(moves)}, deleted: {len(deleted)}')
+            db.update_progress('reconcile', 'complete', len(gone), len(gone), {'moved': len(moves), 'deleted': len(deleted)})
+
+    def rebuild(self, paths: List[Path], streams=4, batch_size=10000):
+        '''
+        Re-index all the files in the provided directories from scratch. The
+        media is bulk loaded into an unlogged staging table without indexes,
+        which is indexed, analyzed and swapped in place of the media table
+        once every file has been loaded. The media outside the paths is
+        copied over from the media table before indexing. The live table is
+        untouched until the swap.
+
+        Args:
+            paths:      The list of paths to process
+            streams:    The number of parallel COPY streams to load each batch with
+            batch_size: The number of files to process before loading them into the staging table
+
+        Raises:
+            RuntimeError: If other objects depend on the media table, so it can't be replaced
+        '''
+        with db.lock():
+            dependents = db.get_media_dependents()
+            if dependents:
+                raise RuntimeError(f'Unable to rebuild, the media table can\'t be replaced while these depend on it: {", ".join(dependents)}')
+            logger.info('Rebuilding from %s', paths)
+            db.update_progress('processor', 'starting')
+            to_process = sorted(self.get_file_list(paths, strip_existing=False))
+            logger.info(f'Rebuilding with {len(to_process)} files')
+
+            counts = {'processed': 0, 'skipped': 0, 'failed': 0, 'deduplicated': 0}
+            if not self.dry_run:
+                db.create_staging_table()
+            try:
+                for i in range(0, len(to_process), batch_size):
+                    processed = self.process_files(set(to_process[i:i + batch_size]), counts, len(to_process))
+                    if not self.dry_run:
+                        db.copy_to_staging_table(processed, streams)
+
+                if not self.dry_run:
+                    db.copy_other_media_to_staging_table(paths)
+                    db.update_progress('processor', 'indexing', counts['processed'], len(to_process))
+                    db.index_staging_table()
+                    db.swap_staging_table()
+            except BaseException:
+                if not self.dry_run:
+                    db.drop_staging_table()
+                raise
+
+            self.log_summary(counts, len(to_process))
+
+    def recompute_summaries(self):
+        '''
+        Rebuild the per-day counts and the type and camera facets from the
+        media table, eg. to repair them, or after changing TIMEZONE
+        '''
+        with db.lock():
+            logger.info('Recomputing summaries')
+            if not self.dry_run:
+                db.recompute_summaries()
+
+    def backfill_hashes(self, batch_size=100):
+        '''
+        Calculate the checksums and fingerprints of media that was inserted
+        without them. The files are read once and not again soon, so they are
+        dropped from the page cache as they are hashed.
+
+        Args:
+            batch_size: The number of files to update in each transaction
+        '''
+        with db.lock():
+            last_id = 0
+            updated_count = 0
             failed_count = 0
-            with concurrent.futures.ThreadPoolExecutor(max_workers=self.ncpu) as executor:
-                futures = {executor.submit(load_file_metadata, p, self.use_file_mtime): p for p in to_process}
-                for future in concurrent.futures.as_completed(futures):
-                    path = futures.get(future)
-                    try:
-                        file = future.result()
-                        if file is not None:
-                            self.validate_file(file)
-                            processed.append(file)
-                        else:
-                            skipped_count += 1
-                    except Exception as e:
-                        logger.error(f'Unable to process {path}: {e}')
+            while rows := db.get_unhashed_media(last_id, batch_size):
+                last_id = rows[-1][0]
+                hashes = self.hash_files({Path(r[1]) for r in rows if r[2] is None}, drop_cache=True)
+                fingerprints = self.map_files(calculate_fingerprint, {Path(r[1]) for r in rows if r[3] is None})
+                updates = []
+                for id, path, sha256, fingerprint in rows:
+                    sha256 = sha256 or hashes.get(Path(path))
+                    fingerprint = fingerprint or fingerprints.get(Path(path))
+                    if sha256 is None or fingerprint is None:
                         failed_count += 1
+                        continue
+                    updates.append((id, sha256, fingerprint))
+                if not self.dry_run:
+                    db.update_hashes(updates)
+                updated_count += len(updates)
+                db.update_progress('backfill', 'hashing', updated_count, 0, {'failed': failed_count})
 
-                    db.update_progress('processor', 'processing', len(processed), len(to_process), {'skipped': skipped_count, 'failed': failed_count})
+            logger.info(f'Backfilled hashes: {updated_count}, failed: {failed_count}')
+            db.update_progress('backfill', 'complete', updated_count, 0, {'failed': failed_count})
 
-            if self.dry_run:
-                logger.info(json.dumps([f.model_dump(exclude={'thumbnail'}) for f in processed]))
+    def backfill_quadkeys(self, batch_size=10000):
+        '''
+        Calculate the quadkeys of media that was inserted with a location but
+        without one. Each batch is converted at once (see media/geo.py) and
+        written with a single update.
+
+        Args:
+            batch_size: The number of rows to update in each statement
+        '''
+        with db.lock():
+            last_id = 0
+            updated_count = 0
+            while rows := db.get_unkeyed_locations(last_id, batch_size):
+                last_id = rows[-1][0]
+                ids, latitudes, longitudes = zip(*rows)
+                updates = [(id, key) for id, key in zip(ids, quadkeys(latitudes, longitudes)) if key is not None]
+                if not self.dry_run:
+                    db.update_quadkeys(updates)
+                updated_count += len(updates)
+                db.update_progress('quadkeys', 'updating', updated_count)
+
+            logger.info(f'Backfilled quadkeys: {updated_count}')
+            db.update_progress('quadkeys', 'complete', updated_count)
+
+    def regenerate_file(self, row: Tuple[int, str, str]) -> Tuple[int, Optional[FileMetadata]]:
+        '''
+        Regenerate the thumbnails of an indexed file in a supervised worker
+
+        Args:
+            row: The (id, path, type) of the file
+
+        Returns:
+            A tuple of the id, and the file with its new thumbnails (or None if it failed)
+        '''
+        assert self.isolation is not None
+        try:
+            return self.isolation.call(regenerate_thumbnails, row)
+        except IsolationError as e:
+            logger.error('Unable to regenerate thumbnails for %s: %s', row[1], e)
+            return row[0], None
+
+    def regenerate_thumbnails(self, batch_size=100, max_rate=0.0):
+        '''
+        Rebuild the thumbnails of all indexed media with the current thumbnail
+        settings, without touching any other metadata. The files are decoded
+        on a pool of processes and written back in batches. The last id
+        written is saved with the progress, so an interrupted run carries on
+        where it left off.
+
+        Args:
+            batch_size: The number of files to update in each transaction
+            max_rate:   The maximum number of files to process per second (0 for no limit)
+        '''
+        with db.lock():
+            last = db.get_progress('thumbnails') or {}
+            last_id = last.get('last_id', 0) if last.get('state') != 'complete' else 0
+            if last_id:
+                logger.info(f'Resuming thumbnail regeneration after id {last_id}')
+
+            updated_count = 0
+            failed_count = 0
+            start = time.monotonic()
+            rows = db.stream_media(last_id)
+            executor: concurrent.futures.Executor
+            if self.isolation is not None:
+                # Each thread waits on a supervised worker, so a bad file can't break the pool
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.ncpu)
             else:
-                db.bulk_insert_media(processed)
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.ncpu, mp_context=multiprocessing.get_context('spawn'))
+            with executor:
+                while batch := [row for _, row in zip(range(batch_size), rows)]:
+                    results = list(executor.map(self.regenerate_file if self.isolation is not None else regenerate_thumbnails, batch))
+                    updates = [(id, file) for id, file in results if file is not None]
+                    failed_count += len(results) - len(updates)
+                    updated_count += len(updates)
+                    last_id = batch[-1][0]
+                    if not self.dry_run:
+                        db.update_thumbnails(updates)
+                        db.update_progress('thumbnails', 'regenerating', updated_count, 0, {'failed': failed_count, 'last_id': last_id})
+
+                    # Throttle to the maximum rate
+                    if max_rate > 0:
+                        time.sleep(max(0.0, (updated_count + failed_count) / max_rate - (time.monotonic() - start)))
 
-            logger.info(f'Processed: {len(processed)}, skipped: {skipped_count}, failed: {failed_count}')
-            db.update_progress('processor', 'complete', len(processed), len(to_process), {'skipped': skipped_count, 'failed': failed_count})
+            logger.info(f'Regenerated thumbnails: {updated_count}, failed: {failed_count}')
+            if not self.dry_run:
+                db.update_progress('thumbnails', 'complete', updated_count, 0, {'failed': failed_count, 'last_id': last_id})
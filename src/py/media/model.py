@@ -10,6 +10,10 @@
 Models chared across the app
 '''
 
+# System Imports
+import itertools
+from typing import Any, Callable, Dict, FrozenSet, Iterable, Iterator, List, Tuple
+
 # 3rd Party Imports
 from pydantic import BaseModel
 
@@ -29,5 +33,132 @@ class FileMetadata(BaseModel):
     longitude: float | None = None  # Longitude in degrees (-180 -> 180)
     make: str | None = None         # Make of the device that created the file
     model: str | None = None        # Model of the device that created the file
-    sha256: str = ''                # SHA256 checksum of the file
+    sha256: str | None = None       # SHA256 checksum of the file (None until calculated)
+    fingerprint: str | None = None  # Fingerprint of the size, first, middle and last blocks of the file
     thumbnail: bytes = b''          # Thumbnail of the file
+    phash: int | None = None        # Perceptual hash of the thumbnail (signed 64 bit dHash)
+    thumbnail_format: str = 'jpeg'  # Image format of all the thumbnails (jpeg or webp)
+    thumbnail_sizes: List[int] = []  # Sizes of the thumbnail pyramid, smallest first (empty if only one size)
+    thumbnails: List[bytes | None] = []  # Thumbnail for each size (None for the size stored in thumbnail)
+    storyboard: bytes | None = None  # Sprite sheet of evenly spaced video keyframes (None if not generated)
+    storyboard_columns: int | None = None  # Number of frames in each row of the storyboard
+    storyboard_times: List[int] = []  # Time of each storyboard frame in milliseconds
+    quadkey: int | None = None      # Quadkey of the location's tile at QUADKEY_ZOOM (see media/geo.py)
+
+
+# The fields of FileMetadata, in the order of the media table columns
+FILE_FIELDS: Tuple[str, ...] = tuple(FileMetadata.model_fields)
+
+
+# The validation rules for a batch of media, in the order they are checked.
+# Each is a tuple of the column(s) to check, a function that is True for a
+# valid value, and a function to build the error message for an invalid value.
+# A column can also be one of the options of MediaBatch.validate, which is
+# passed to the functions for every file.
+VALIDATION_RULES: List[Tuple[Tuple[str, ...], Callable[..., bool], Callable[..., str]]] = [
+    (('type',), lambda t: t in ('video', 'image'), lambda t: f'Invalid type of {t}'),
+    (('timestamp',), lambda t: isinstance(t, int) and t != 0, lambda t: f'invalid timestamp of {t}'),
+    (('size',), lambda s: isinstance(s, int) and s != 0, lambda s: f'invalid size of {s}'),
+    (('width',), lambda w: isinstance(w, int) and w != 0, lambda w: f'invalid width of {w}'),
+    (('height',), lambda h: isinstance(h, int) and h != 0, lambda h: f'invalid length of {h}'),
+    (('type', 'duration'), lambda t, d: t != 'video' or (isinstance(d, int) and d != 0), lambda t, d: f'Invalid video duration of {d}'),
+    (('type', 'duration'), lambda t, d: t != 'image' or d is None, lambda t, d: f'Duration must not be set for images: {d}'),
+    (('latitude',), lambda v: v is None or isinstance(v, (int, float)), lambda v: f'Invalid latitude of {v}'),
+    (('longitude',), lambda v: v is None or isinstance(v, (int, float)), lambda v: f'Invalid longitude of {v}'),
+    (('make',), lambda v: v is None or (isinstance(v, str) and v != ''), lambda v: f'Invalid make of {v}'),
+    (('model',), lambda v: v is None or (isinstance(v, str) and v != ''), lambda v: f'Invalid model of {v}'),
+    (('sha256', 'require_sha256'), lambda v, required: (v is None and not required) or (isinstance(v, str) and len(v) == 64), lambda v, _: f'Invalid sha256 of {v}'),
+    (('fingerprint',), lambda v: isinstance(v, str) and len(v) == 32, lambda v: f'Invalid fingerprint of {v}'),
+    (('thumbnail',), lambda v: isinstance(v, bytes) and len(v) > 0, lambda v: f'Invalid thumbnail of {v!r}'),
+    (('thumbnails', 'thumbnail_sizes'), lambda t, s: len(t) == len(s), lambda t, s: f'{len(t)} thumbnails for sizes {s}'),
+]
+
+
+class MediaBatch:
+    '''
+    A columnar batch of file metadata. The processor still loads each file
+    into a FileMetadata, and builds one of these from a batch of them to
+    validate and insert, rather than dumping and validating each file on its
+    own. Each column is a plain list, so a whole batch is validated with one
+    pass over each column, and the rows for COPY are built by zipping the
+    columns.
+    '''
+    __slots__ = ('columns',)
+
+    def __init__(self, files: Iterable[Any] = ()):
+        '''
+        Constructor
+
+        Args:
+            files: The files in the batch. Any object with the FileMetadata fields as attributes will do
+        '''
+        files = list(files)
+        self.columns: Dict[str, List[Any]] = {f: [getattr(file, f, None) for file in files] for f in FILE_FIELDS}
+
+    def __len__(self) -> int:
+        return len(self.columns['path'])
+
+    def rows(self) -> Iterator[Tuple[Any, ...]]:
+        '''
+        Iterate over the rows of the batch
+
+        Returns:
+            An iterator of tuples of the fields of each file, in FILE_FIELDS order
+        '''
+        return zip(*self.columns.values())
+
+    def records(self, exclude: FrozenSet[str] = frozenset()) -> List[Dict[str, Any]]:
+        '''
+        Get the batch as a list of dicts, eg. for JSON output
+
+        Args:
+            exclude: The fields to leave out
+
+        Returns:
+            A dict of field to value for each file
+        '''
+        fields = [f for f in FILE_FIELDS if f not in exclude]
+        return [dict(zip(fields, row)) for row in zip(*(self.columns[f] for f in fields))]
+
+    def select(self, indexes: Iterable[int]) -> 'MediaBatch':
+        '''
+        Get a subset of the batch
+
+        Args:
+            indexes: The indexes of the files to keep
+
+        Returns:
+            A new batch with only those files
+        '''
+        indexes = list(indexes)
+        batch = MediaBatch()
+        batch.columns = {f: [column[i] for i in indexes] for f, column in self.columns.items()}
+        return batch
+
+    def validate(self, require_sha256: bool = True) -> Dict[int, str]:
+        '''
+        Validate that every file in the batch has all the necessary fields set
+
+        Args:
+            require_sha256: Whether a file must have a sha256. If False, it may be None
+
+        Returns:
+            A map of the index of each invalid file to the reason it is invalid
+        '''
+        options = {'require_sha256': require_sha256}
+        errors: Dict[int, str] = {}
+        for fields, valid, message in VALIDATION_RULES:
+            columns = [self.columns[f] if f in self.columns else itertools.repeat(options[f], len(self)) for f in fields]
+            for i, values in enumerate(zip(*columns)):
+                if i not in errors and not valid(*values):
+                    errors[i] = f'Validation failed: {message(*values)}'
+        return errors
+
+    def to_metadata(self) -> List[FileMetadata]:
+        '''
+        Convert the batch back to FileMetadata, without validating it again
+
+        Returns:
+            The list of file metadata
+        '''
+        return [FileMetadata.model_construct(**dict(zip(FILE_FIELDS, row))) for row in self.rows()]
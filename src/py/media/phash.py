@@ -0,0 +1,199 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Near duplicate search on perceptual hashes
+#
+
+'''
+Near duplicate search on 64 bit perceptual hashes using multi-index hashing.
+
+Each hash is split into max_distance + 1 chunks. If two hashes differ in at
+most max_distance bits, then by the pigeonhole principle at least one of
+their chunks must be identical. The index keeps a sorted array of each chunk,
+so candidates are found with a binary search per chunk and then verified
+with a vectorised hamming distance. Memory use is a few bytes per hash per
+chunk, which keeps millions of hashes in memory comfortably.
+
+The chunks get narrower as max_distance grows, and a chunk of w bits matches
+about 1 in 2^w unrelated hashes (more in practice, since perceptual hashes
+cluster), so the candidates to verify grow quickly, and finding every pair
+tends towards comparing every hash with every other. max_distance is capped
+at MAX_DISTANCE, which keeps each chunk at least 12 bits wide.
+'''
+
+# System Imports
+from typing import Dict, Iterable, List, Tuple
+
+# 3rd Party Imports
+import numpy as np
+
+
+# The largest max_distance of an index (5 chunks of 12 or 13 bits)
+MAX_DISTANCE = 4
+
+# The number of set bits in each possible byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def hamming_distance(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    '''
+    Calculate the number of differing bits between 64 bit hashes. The
+    arrays are broadcast against each other.
+
+    Args:
+        a: An array of hashes
+        b: An array of hashes (or a single hash) to compare against
+
+    Returns:
+        The hamming distances
+    '''
+    diff = np.ascontiguousarray(np.bitwise_xor(np.asarray(a, dtype=np.int64), np.asarray(b, dtype=np.int64)))
+    return POPCOUNT[diff.view(np.uint8)].reshape(diff.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+class PhashIndex:
+    '''
+    A multi-index hash table of perceptual hashes
+    '''
+
+    def __init__(self, ids: Iterable[int], hashes: Iterable[int], max_distance: int = 4):
+        '''
+        Constructor
+
+        Args:
+            ids:          The ids of the hashed items
+            hashes:       The signed 64 bit hashes of the items
+            max_distance: The largest hamming distance that can be searched for (up to MAX_DISTANCE)
+
+        Raises:
+            ValueError: If max_distance is out of range
+        '''
+        if not 0 <= max_distance <= MAX_DISTANCE:
+            raise ValueError(f'Invalid maximum distance: {max_distance} (must be 0-{MAX_DISTANCE})')
+        self.max_distance = max_distance
+        self.ids = np.fromiter(ids, dtype=np.int64)
+        self.hashes = np.fromiter(hashes, dtype=np.int64)
+        assert len(self.ids) == len(self.hashes)
+
+        # Split the 64 bits into (max_distance + 1) chunks of near equal width
+        nchunks = max_distance + 1
+        self.chunks: List[Tuple[int, int]] = []
+        shift = 0
+        for i in range(nchunks):
+            width = 64 // nchunks + (1 if i < 64 % nchunks else 0)
+            self.chunks.append((shift, width))
+            shift += width
+
+        self.keys: List[np.ndarray] = []
+        self.order: List[np.ndarray] = []
+        for shift, width in self.chunks:
+            keys = self.chunk(self.hashes, shift, width)
+            order = np.argsort(keys, kind='stable').astype(np.int32 if len(keys) < 2**31 else np.int64)
+            self.keys.append(keys[order])
+            self.order.append(order)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def chunk(hashes: np.ndarray, shift: int, width: int) -> np.ndarray:
+        '''
+        Extract a chunk of bits from hashes
+
+        Args:
+            hashes: The hashes
+            shift:  The position of the lowest bit of the chunk
+            width:  The number of bits in the chunk
+
+        Returns:
+            The chunk values
+        '''
+        return ((hashes.view(np.uint64) >> np.uint64(shift)) & np.uint64((1 << width) - 1)).astype(np.uint32)
+
+    def query(self, phash: int, max_distance: int | None = None) -> List[Tuple[int, int]]:
+        '''
+        Find the items near a hash
+
+        Args:
+            phash:        The hash to search for
+            max_distance: The largest hamming distance to return. Defaults to the index maximum
+
+        Returns:
+            A list of (id, distance) tuples sorted by distance
+        '''
+        max_distance = self.max_distance if max_distance is None else max_distance
+        assert max_distance <= self.max_distance
+        target = np.array([phash], dtype=np.int64)
+        candidates = []
+        for (shift, width), keys, order in zip(self.chunks, self.keys, self.order):
+            key = self.chunk(target, shift, width)[0]
+            lo, hi = np.searchsorted(keys, key, 'left'), np.searchsorted(keys, key, 'right')
+            candidates.append(order[lo:hi])
+        idx = np.unique(np.concatenate(candidates))
+        dist = hamming_distance(self.hashes[idx], target[0])
+        matches = sorted(zip(dist.tolist(), self.ids[idx].tolist()))
+        return [(id, d) for d, id in matches if d <= max_distance]
+
+    def pairs(self, max_distance: int | None = None, tile: int = 1024) -> Iterable[Tuple[int, int]]:
+        '''
+        Find all pairs of items within a distance of each other. Items that
+        share a chunk are compared in bulk. Large buckets (eg. lots of blank
+        images) are compared in tiles to bound memory.
+
+        Args:
+            max_distance: The largest hamming distance to return. Defaults to the index maximum
+            tile:         The number of items to compare against each other at once
+
+        Yields:
+            Pairs of (id, id). A pair may be yielded more than once
+        '''
+        max_distance = self.max_distance if max_distance is None else max_distance
+        assert max_distance <= self.max_distance
+        for keys, order in zip(self.keys, self.order):
+            # Find the boundaries of runs of equal chunk values
+            bounds = np.flatnonzero(np.diff(keys)) + 1
+            starts = np.concatenate(([0], bounds))
+            ends = np.concatenate((bounds, [len(keys)]))
+            for start, end in zip(starts[ends - starts > 1], ends[ends - starts > 1]):
+                bucket = order[start:end]
+                for i in range(0, len(bucket), tile):
+                    rows = bucket[i:i + tile]
+                    for j in range(i, len(bucket), tile):
+                        cols = bucket[j:j + tile]
+                        dist = hamming_distance(self.hashes[rows][:, None], self.hashes[cols][None, :])
+                        r, c = np.nonzero(dist <= max_distance)
+                        keep = (c + j) > (r + i)
+                        yield from zip(self.ids[rows[r[keep]]].tolist(), self.ids[cols[c[keep]]].tolist())
+
+    def clusters(self, max_distance: int | None = None) -> List[List[int]]:
+        '''
+        Group items into clusters of near duplicates. Items are in the same
+        cluster if there is a chain of near duplicates between them.
+
+        Args:
+            max_distance: The largest hamming distance between neighbours
+
+        Returns:
+            A list of clusters of ids, largest first. Items without any near
+            duplicates are not included
+        '''
+        parent: Dict[int, int] = {}
+
+        def find(x: int) -> int:
+            parent.setdefault(x, x)
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        for a, b in self.pairs(max_distance):
+            ra, rb = find(a), find(b)
+            if ra != rb:
+                parent[max(ra, rb)] = min(ra, rb)
+
+        groups: Dict[int, List[int]] = {}
+        for x in parent:
+            groups.setdefault(find(x), []).append(x)
+        return sorted((sorted(g) for g in groups.values()), key=lambda g: (-len(g), g[0]))
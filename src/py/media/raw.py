@@ -0,0 +1,489 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Metadata and embedded preview extraction for camera RAW files
+#
+
+'''
+Metadata and embedded preview extraction for camera RAW files.
+
+Decoding the sensor data of a RAW file is slow and needs a dedicated
+library, but almost every RAW format embeds at least one JPEG preview
+rendered by the camera. Most formats (DNG, CR2, NEF, ARW, PEF, SRW, RW2,
+ORF, ...) are TIFF structures, where the previews are images in the IFD
+chain or sub IFDs. Fujifilm RAF files have a JPEG at a fixed offset in their
+header, and Canon CR3 files keep a preview and TIFF structured metadata in
+ISO media boxes near the start of the file.
+
+Only the structure of the file is read, along with the tags needed for the
+dimensions and the EXIF subset used by the metadata loaders, and the
+largest preview that Pillow can decode.
+'''
+
+# System Imports
+import struct
+import mimetypes
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Set, Tuple
+
+# 3rd Party Imports
+from pydantic import BaseModel
+
+# Local Imports
+from media.util import EXIF_TAGS, EXIF_OFFSET_TAG, EXIF_OFFSET_TAGS, EXIF_GPS_TAG, EXIF_GPS_TAGS
+
+
+# The mime types of supported RAW formats, by extension. These are
+# registered with mimetypes, since most systems don't know them.
+RAW_MIME_TYPES = {
+    '.3fr': 'image/x-hasselblad-3fr',
+    '.arw': 'image/x-sony-arw',
+    '.cr2': 'image/x-canon-cr2',
+    '.cr3': 'image/x-canon-cr3',
+    '.dng': 'image/x-adobe-dng',
+    '.erf': 'image/x-epson-erf',
+    '.kdc': 'image/x-kodak-kdc',
+    '.nef': 'image/x-nikon-nef',
+    '.nrw': 'image/x-nikon-nrw',
+    '.orf': 'image/x-olympus-orf',
+    '.pef': 'image/x-pentax-pef',
+    '.raf': 'image/x-fuji-raf',
+    '.rw2': 'image/x-panasonic-rw2',
+    '.rwl': 'image/x-leica-rwl',
+    '.sr2': 'image/x-sony-sr2',
+    '.srf': 'image/x-sony-srf',
+    '.srw': 'image/x-samsung-srw',
+}
+for ext, mime_type in RAW_MIME_TYPES.items():
+    mimetypes.add_type(mime_type, ext)
+
+# The size in bytes of each TIFF field type
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4}
+
+# The struct format of each numeric TIFF field type
+TIFF_TYPE_FORMATS = {1: 'B', 3: 'H', 4: 'I', 6: 'b', 8: 'h', 9: 'i', 11: 'f', 12: 'd', 13: 'I'}
+
+# TIFF tags used to find images
+TAG_NEW_SUBFILE_TYPE = 0x00FE
+TAG_WIDTH = 0x0100
+TAG_HEIGHT = 0x0101
+TAG_COMPRESSION = 0x0103
+TAG_ORIENTATION = 0x0112
+TAG_STRIP_OFFSETS = 0x0111
+TAG_STRIP_BYTE_COUNTS = 0x0117
+TAG_SUB_IFDS = 0x014A
+TAG_JPEG_OFFSET = 0x0201
+TAG_JPEG_LENGTH = 0x0202
+TAG_PIXEL_X_DIMENSION = 0xA002
+TAG_PIXEL_Y_DIMENSION = 0xA003
+TAG_RW2_JPEG = 0x002E
+TAG_RW2_WIDTH = 0x0002
+TAG_RW2_HEIGHT = 0x0003
+
+# The JPEG start of frame markers that Pillow can decode (baseline, extended and progressive)
+JPEG_DECODABLE_SOF = {0xC0, 0xC1, 0xC2}
+
+# The maximum number of IFDs to read, to guard against loops in corrupt files
+MAX_IFDS = 64
+
+
+class RawMetadata(BaseModel):
+    '''
+    The metadata extracted from a RAW file
+    '''
+    width: int = 0                 # Width of the sensor image in pixels
+    height: int = 0                # Height of the sensor image in pixels
+    orientation: int = 1           # EXIF orientation of the image
+    exif: Dict = {}                # EXIF subset, in the same structure as util.extract_exif()
+    preview: bytes | None = None   # The largest decodable embedded JPEG preview
+
+
+def is_raw(path: Path | str) -> bool:
+    '''
+    Check if a file is a supported RAW format, by its extension
+
+    Args:
+        path: The path of the file
+
+    Returns:
+        True if the file is a RAW file
+    '''
+    return Path(path).suffix.lower() in RAW_MIME_TYPES
+
+
+def jpeg_info(fp: BinaryIO, offset: int, length: int) -> Optional[Tuple[int, int]]:
+    '''
+    Read the frame header of an embedded JPEG
+
+    Args:
+        fp:     The open file
+        offset: The offset of the JPEG in the file
+        length: The length of the JPEG in bytes
+
+    Returns:
+        The (width, height) of the JPEG, or None if it isn't a JPEG that can be decoded
+    '''
+    end = offset + length
+    fp.seek(offset)
+    if fp.read(2) != b'\xff\xd8':
+        return None
+    pos = offset + 2
+    while pos + 4 <= end:
+        fp.seek(pos)
+        marker = fp.read(4)
+        if len(marker) < 4 or marker[0] != 0xFF:
+            return None
+        if marker[1] in (0xD8, 0x01) or 0xD0 <= marker[1] <= 0xD7:
+            pos += 2
+            continue
+        segment_length = struct.unpack('>H', marker[2:])[0]
+        if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+            if marker[1] not in JPEG_DECODABLE_SOF:
+                return None
+            header = fp.read(5)
+            if len(header) < 5:
+                return None
+            height, width = struct.unpack('>HH', header[1:])
+            return width, height
+        pos += 2 + segment_length
+    return None
+
+
+class TiffReader:
+    '''
+    A minimal reader of TIFF structures, that only reads the parts of the
+    file that are asked for
+    '''
+
+    def __init__(self, fp: BinaryIO, base: int = 0):
+        '''
+        Constructor
+
+        Args:
+            fp:   The open file
+            base: The offset of the TIFF header in the file. All offsets in the structure are relative to this
+
+        Raises:
+            ValueError: If there isn't a TIFF header at the base offset
+        '''
+        self.fp = fp
+        self.base = base
+        fp.seek(base)
+        header = fp.read(8)
+        if header[:2] == b'II':
+            self.order = '<'
+        elif header[:2] == b'MM':
+            self.order = '>'
+        else:
+            raise ValueError('Not a TIFF file')
+        # 42 is standard TIFF. Olympus (ORF) and Panasonic (RW2) use their own magic numbers
+        magic, self.first_ifd = struct.unpack(self.order + 'HI', header[2:8])
+        if magic not in (42, 0x4F52, 0x5352, 0x55):
+            raise ValueError(f'Unknown TIFF magic number {magic:#x}')
+
+    def read_ifd(self, offset: int) -> Tuple[Dict[int, Tuple[int, int, bytes]], int]:
+        '''
+        Read the entries of an IFD, without reading their values
+
+        Args:
+            offset: The offset of the IFD
+
+        Returns:
+            A tuple of a map of tag to (type, count, value field), and the
+            offset of the next IFD (0 if there isn't one)
+        '''
+        self.fp.seek(self.base + offset)
+        data = self.fp.read(2)
+        if len(data) < 2:
+            raise ValueError(f'IFD offset {offset} is past the end of the file')
+        count = struct.unpack(self.order + 'H', data)[0]
+        data = self.fp.read(count * 12 + 4)
+        if len(data) < count * 12 + 4:
+            raise ValueError(f'IFD at offset {offset} is truncated')
+        entries = {}
+        for i in range(count):
+            tag, type, n = struct.unpack(self.order + 'HHI', data[i * 12:i * 12 + 8])
+            entries[tag] = (type, n, data[i * 12 + 8:i * 12 + 12])
+        return entries, struct.unpack(self.order + 'I', data[-4:])[0]
+
+    def value(self, entry: Tuple[int, int, bytes]):
+        '''
+        Read the value of an IFD entry
+
+        Args:
+            entry: The (type, count, value field) of the entry
+
+        Returns:
+            A string for ASCII values, bytes for undefined values, or a number
+            (or tuple of numbers if there is more than one) for numeric values.
+            Rationals are converted to floats
+        '''
+        type, count, field = entry
+        size = TIFF_TYPE_SIZES.get(type, 1) * count
+        if size <= 4:
+            data = field[:size]
+        else:
+            self.fp.seek(self.base + struct.unpack(self.order + 'I', field)[0])
+            data = self.fp.read(size)
+        if type == 2:
+            return data.split(b'\x00', 1)[0].decode(errors='replace').strip()
+        if type == 7:
+            return data
+        if type in (5, 10):
+            parts = struct.unpack(self.order + ('I' if type == 5 else 'i') * (2 * count), data)
+            values = tuple(float(parts[i] / parts[i + 1]) if parts[i + 1] else 0.0 for i in range(0, len(parts), 2))
+        else:
+            values = struct.unpack(self.order + TIFF_TYPE_FORMATS.get(type, 'B') * count, data)
+        return values[0] if count == 1 else values
+
+    def values(self, entries: Dict[int, Tuple[int, int, bytes]], tags: Dict[int, str]) -> Dict:
+        '''
+        Read the values of a set of tags from an IFD
+
+        Args:
+            entries: The entries of the IFD
+            tags:    A map of tag to the name to give it in the result
+
+        Returns:
+            A map of name to value for the tags that are in the IFD
+        '''
+        return {name: self.value(entries[tag]) for tag, name in tags.items() if tag in entries}
+
+    def ifds(self) -> List[Dict[int, Tuple[int, int, bytes]]]:
+        '''
+        Read the main IFD chain and all sub IFDs
+
+        Returns:
+            The entries of each IFD, starting with IFD0
+        '''
+        result = []
+        pending = [self.first_ifd]
+        seen: Set[int] = set()
+        while pending and len(result) < MAX_IFDS:
+            offset = pending.pop(0)
+            if offset == 0 or offset in seen:
+                continue
+            seen.add(offset)
+            entries, next_offset = self.read_ifd(offset)
+            result.append(entries)
+            if TAG_SUB_IFDS in entries:
+                sub_ifds = self.value(entries[TAG_SUB_IFDS])
+                pending += list(sub_ifds) if isinstance(sub_ifds, tuple) else [sub_ifds]
+            pending.append(next_offset)
+        return result
+
+    def exif(self, ifd0: Dict[int, Tuple[int, int, bytes]]) -> Dict:
+        '''
+        Read the EXIF subset used by the metadata loaders
+
+        Args:
+            ifd0: The entries of IFD0
+
+        Returns:
+            The EXIF data, in the same structure as util.extract_exif()
+        '''
+        res = self.values(ifd0, EXIF_TAGS)
+        if EXIF_OFFSET_TAG in ifd0:
+            entries, _ = self.read_ifd(self.value(ifd0[EXIF_OFFSET_TAG]))
+            res['ExifOffset'] = self.values(entries, EXIF_OFFSET_TAGS | {TAG_PIXEL_X_DIMENSION: 'ExifImageWidth', TAG_PIXEL_Y_DIMENSION: 'ExifImageHeight'})
+        if EXIF_GPS_TAG in ifd0:
+            entries, _ = self.read_ifd(self.value(ifd0[EXIF_GPS_TAG]))
+            res['GPSInfo'] = self.values(entries, EXIF_GPS_TAGS)
+        return res
+
+    def previews(self, ifds: List[Dict[int, Tuple[int, int, bytes]]]) -> List[Tuple[int, int, int, int]]:
+        '''
+        Find the embedded JPEG images that Pillow can decode
+
+        Args:
+            ifds: The IFDs to search
+
+        Returns:
+            A list of (offset, length, width, height) of each image, with
+            offsets from the start of the file
+        '''
+        candidates = []
+        for entries in ifds:
+            if TAG_JPEG_OFFSET in entries and TAG_JPEG_LENGTH in entries:
+                candidates.append((self.base + self.value(entries[TAG_JPEG_OFFSET]), self.value(entries[TAG_JPEG_LENGTH])))
+            if entries.get(TAG_COMPRESSION) and self.value(entries[TAG_COMPRESSION]) in (6, 7) and TAG_STRIP_OFFSETS in entries and TAG_STRIP_BYTE_COUNTS in entries:
+                offsets, lengths = self.value(entries[TAG_STRIP_OFFSETS]), self.value(entries[TAG_STRIP_BYTE_COUNTS])
+                if isinstance(offsets, int) and isinstance(lengths, int):
+                    candidates.append((self.base + offsets, lengths))
+            if TAG_RW2_JPEG in entries:
+                type, count, field = entries[TAG_RW2_JPEG]
+                candidates.append((self.base + struct.unpack(self.order + 'I', field)[0], count))
+
+        previews = []
+        for offset, length in candidates:
+            info = jpeg_info(self.fp, offset, length)
+            if info is not None:
+                previews.append((offset, length) + info)
+        return previews
+
+
+def find_box(data: bytes, box_type: bytes) -> Optional[Tuple[int, int]]:
+    '''
+    Find an ISO media box in a block of data
+
+    Args:
+        data:     The data to search
+        box_type: The four character type of the box
+
+    Returns:
+        The (offset, size) of the box contents, or None if it isn't found
+    '''
+    pos = data.find(box_type)
+    if pos < 4:
+        return None
+    size = struct.unpack('>I', data[pos - 4:pos])[0]
+    return pos + 4, size - 8
+
+
+def read_cr3(fp: BinaryIO) -> RawMetadata:
+    '''
+    Read the metadata and preview of a Canon CR3 file. The metadata is in
+    CMT1 (IFD0), CMT2 (EXIF) and CMT4 (GPS) boxes, each a complete TIFF
+    structure, and the preview is a JPEG in a PRVW box.
+
+    Args:
+        fp: The open file
+
+    Returns:
+        The metadata
+    '''
+    data = fp.read(4 * 1024 * 1024)
+    raw = RawMetadata()
+    if (cmt1 := find_box(data, b'CMT1')) is not None:
+        tiff = TiffReader(fp, cmt1[0])
+        ifd0, _ = tiff.read_ifd(tiff.first_ifd)
+        raw.exif = tiff.values(ifd0, EXIF_TAGS)
+        if TAG_ORIENTATION in ifd0:
+            raw.orientation = tiff.value(ifd0[TAG_ORIENTATION])
+    if (cmt2 := find_box(data, b'CMT2')) is not None:
+        tiff = TiffReader(fp, cmt2[0])
+        entries, _ = tiff.read_ifd(tiff.first_ifd)
+        raw.exif['ExifOffset'] = tiff.values(entries, EXIF_OFFSET_TAGS | {TAG_PIXEL_X_DIMENSION: 'ExifImageWidth', TAG_PIXEL_Y_DIMENSION: 'ExifImageHeight'})
+    if (cmt4 := find_box(data, b'CMT4')) is not None:
+        tiff = TiffReader(fp, cmt4[0])
+        entries, _ = tiff.read_ifd(tiff.first_ifd)
+        raw.exif['GPSInfo'] = tiff.values(entries, EXIF_GPS_TAGS)
+
+    # PRVW: 4 unknown bytes, then 2 unknown, width, height and 2 unknown shorts, then the JPEG length and data
+    if (prvw := find_box(data, b'PRVW')) is not None:
+        offset = prvw[0] + 16
+        if offset <= len(data):
+            length = struct.unpack('>I', data[offset - 4:offset])[0]
+            info = jpeg_info(fp, offset, length)
+            if info is not None:
+                fp.seek(offset)
+                raw.preview = fp.read(length)
+                raw.width, raw.height = info
+
+    exif = raw.exif.get('ExifOffset', {})
+    if exif.get('ExifImageWidth', 0) * exif.get('ExifImageHeight', 0) > raw.width * raw.height:
+        raw.width, raw.height = exif['ExifImageWidth'], exif['ExifImageHeight']
+    return raw
+
+
+def read_raf(fp: BinaryIO) -> RawMetadata:
+    '''
+    Read the metadata and preview of a Fujifilm RAF file. The header has the
+    offset and length of a JPEG preview, which also holds the EXIF data.
+
+    Args:
+        fp: The open file
+
+    Returns:
+        The metadata
+    '''
+    fp.seek(84)
+    offset, length = struct.unpack('>II', fp.read(8))
+    raw = RawMetadata()
+    info = jpeg_info(fp, offset, length)
+    if info is None:
+        return raw
+    raw.width, raw.height = info
+
+    # The EXIF data is a TIFF structure in the APP1 segment, which is one of the first segments of the JPEG
+    pos = offset + 2
+    fp.seek(pos)
+    segment = fp.read(10)
+    while len(segment) == 10 and segment[0] == 0xFF and 0xE0 <= segment[1] <= 0xEF and segment[4:10] != b'Exif\x00\x00':
+        pos += 2 + struct.unpack('>H', segment[2:4])[0]
+        fp.seek(pos)
+        segment = fp.read(10)
+    if segment[:2] == b'\xff\xe1' and segment[4:10] == b'Exif\x00\x00':
+        tiff = TiffReader(fp, pos + 10)
+        ifd0, _ = tiff.read_ifd(tiff.first_ifd)
+        raw.exif = tiff.exif(ifd0)
+        if TAG_ORIENTATION in ifd0:
+            raw.orientation = tiff.value(ifd0[TAG_ORIENTATION])
+        exif = raw.exif.get('ExifOffset', {})
+        if exif.get('ExifImageWidth', 0) * exif.get('ExifImageHeight', 0) > raw.width * raw.height:
+            raw.width, raw.height = exif['ExifImageWidth'], exif['ExifImageHeight']
+
+    fp.seek(offset)
+    raw.preview = fp.read(length)
+    return raw
+
+
+def read_tiff_raw(fp: BinaryIO) -> RawMetadata:
+    '''
+    Read the metadata and preview of a TIFF based RAW file
+
+    Args:
+        fp: The open file
+
+    Returns:
+        The metadata
+    '''
+    tiff = TiffReader(fp)
+    ifds = tiff.ifds()
+    raw = RawMetadata(exif=tiff.exif(ifds[0]))
+    if TAG_ORIENTATION in ifds[0]:
+        raw.orientation = tiff.value(ifds[0][TAG_ORIENTATION])
+
+    # The sensor size is the largest image in the file (RW2 stores it in its own tags)
+    sizes = [(tiff.value(e[TAG_WIDTH]), tiff.value(e[TAG_HEIGHT])) for e in ifds if TAG_WIDTH in e and TAG_HEIGHT in e]
+    if TAG_RW2_WIDTH in ifds[0] and TAG_RW2_HEIGHT in ifds[0] and tiff.order == '<' and TAG_RW2_JPEG in ifds[0]:
+        sizes.append((tiff.value(ifds[0][TAG_RW2_WIDTH]), tiff.value(ifds[0][TAG_RW2_HEIGHT])))
+    exif = raw.exif.get('ExifOffset', {})
+    sizes.append((int(exif.get('ExifImageWidth', 0)), int(exif.get('ExifImageHeight', 0))))
+
+    previews = tiff.previews(ifds)
+    sizes += [(w, h) for _, _, w, h in previews]
+    raw.width, raw.height = max(sizes, key=lambda s: s[0] * s[1])
+    if previews:
+        offset, length, _, _ = max(previews, key=lambda p: p[2] * p[3])
+        fp.seek(offset)
+        raw.preview = fp.read(length)
+    return raw
+
+
+def read_raw(path: Path | str) -> RawMetadata:
+    '''
+    Read the dimensions, EXIF data and largest embedded preview of a RAW file
+
+    Args:
+        path: The path of the file
+
+    Raises:
+        ValueError: If the file structure can't be read
+
+    Returns:
+        The metadata
+    '''
+    with open(path, 'rb') as fp:
+        header = fp.read(16)
+        fp.seek(0)
+        try:
+            if header.startswith(b'FUJIFILMCCD-RAW'):
+                return read_raf(fp)
+            if header[4:12] == b'ftypcrx ':
+                return read_cr3(fp)
+            return read_tiff_raw(fp)
+        except struct.error as e:
+            raise ValueError(f'Corrupt RAW file: {e}')
@@ -0,0 +1,115 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# A priority scheduler for the files of submitted jobs
+#
+
+'''
+A priority scheduler for the files of submitted jobs. Jobs are broken down
+into their files, and the files from every job are ordered by the priority
+of their job, and then newest first (by mtime), so freshly synced and
+interactively submitted files are processed ahead of a long backfill. The
+processor takes a few files at a time, so a new job only ever waits for the
+files that are already in progress.
+'''
+
+# System Imports
+import heapq
+import itertools
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+# Local Imports
+from media.jobs import Job, PRIORITIES
+
+
+class Scheduler:
+    '''
+    Orders the files of jobs by priority, then by newest mtime
+    '''
+
+    def __init__(self):
+        '''
+        Constructor
+        '''
+        self.heap: List[Tuple[int, float, int, Path]] = []
+        self.files: Dict[Path, Tuple[int, List[Job]]] = {}
+        self.running: Set[Path] = set()
+        self.remaining: Dict[str, int] = {}
+        self.counter = itertools.count()
+
+    def __len__(self) -> int:
+        '''
+        Get the number of files that are waiting or running
+
+        Returns:
+            The number of files
+        '''
+        return len(self.files)
+
+    def add(self, job: Job, files: Dict[Path, float]):
+        '''
+        Schedule the files of a job. A file that is already scheduled by
+        another job is shared, and moved up to the higher of the two
+        priorities.
+
+        Args:
+            job:   The job
+            files: A map of each file to process to its mtime
+        '''
+        if not files:
+            job.finish()
+            return
+
+        rank = PRIORITIES.index(job.priority)
+        self.remaining[job.id] = len(files)
+        for path, mtime in files.items():
+            current, jobs = self.files.get(path, (len(PRIORITIES), []))
+            jobs.append(job)
+            self.files[path] = (min(rank, current), jobs)
+            if rank < current and path not in self.running:
+                heapq.heappush(self.heap, (rank, -mtime, next(self.counter), path))
+
+    def take(self, count: int) -> List[Path]:
+        '''
+        Take the next files to process
+
+        Args:
+            count: The maximum number of files to take
+
+        Returns:
+            The highest priority files, which are marked as running
+        '''
+        paths: List[Path] = []
+        while self.heap and len(paths) < count:
+            rank, _, _, path = heapq.heappop(self.heap)
+            entry = self.files.get(path)
+            if entry is None or entry[0] != rank or path in self.running:
+                # The file was already processed, or moved to a higher priority
+                continue
+            self.running.add(path)
+            paths.append(path)
+        return paths
+
+    def report(self, path: Path, status: str, error: Optional[str] = None):
+        '''
+        Record the result of a file with every job that scheduled it, and
+        finish any jobs that have no files left
+
+        Args:
+            path:   The file
+            status: processed, existing, skipped or failed
+            error:  The reason the file failed
+        '''
+        entry = self.files.pop(path, None)
+        self.running.discard(path)
+        if entry is None:
+            return
+        for job in entry[1]:
+            job.report(path, status, error)
+            self.remaining[job.id] -= 1
+            if self.remaining[job.id] == 0:
+                del self.remaining[job.id]
+                job.finish()
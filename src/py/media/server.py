@@ -0,0 +1,313 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# A local socket API to submit jobs to the processor daemon
+#
+
+'''
+A local UNIX socket API to submit jobs to the processor daemon. Requests and
+responses are JSON objects, one per line. Each request has an "op":
+
+submit - {"op": "submit", "paths": [...], "priority": "sync"}
+         Queue the paths and respond with {"job": id}
+status - {"op": "status", "job": id}
+         Respond with the job summary
+wait   - {"op": "wait", "job": id, "timeout": 60, "results": true}
+         Wait for the job to finish, and respond with the job summary (and
+         the result of every file if "results" is set)
+stream - {"op": "stream", "job": id}
+         Respond with a line for each file result as it happens, then the
+         job summary once it finishes
+concurrency - {"op": "concurrency", "workers": {"decode": 4}, "max_load": 2}
+         Change any of the concurrency settings (workers, max_workers,
+         max_load or adaptive, which must be true or false), and respond with
+         the current settings
+
+Errors are returned as {"error": message}, with no other keys. A connection
+can be used for any number of requests.
+'''
+
+# System Imports
+import os
+import json
+import socket
+import threading
+import socketserver
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+# Local Imports
+from media.jobs import Job, JobQueue
+from media.concurrency import ConcurrencyController
+from media.logger import logger
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    '''
+    Handle the requests on a connection
+    '''
+    server: 'JobServer'
+
+    def send(self, msg: Dict):
+        '''
+        Send a response
+
+        Args:
+            msg: The response to send
+        '''
+        self.wfile.write(json.dumps(msg).encode() + b'\n')
+        self.wfile.flush()
+
+    def find_job(self, request: Dict) -> Job:
+        '''
+        Find the job in a request
+
+        Args:
+            request: The request
+
+        Raises:
+            ValueError: If the job isn't known
+
+        Returns:
+            The job
+        '''
+        job = self.server.jobs.find(str(request.get('job')))
+        if job is None:
+            raise ValueError(f'Unknown job: {request.get("job")}')
+        return job
+
+    def handle_request(self, request: Dict):
+        '''
+        Handle a single request
+
+        Args:
+            request: The request
+
+        Raises:
+            ValueError: If the request is invalid
+        '''
+        op = request.get('op')
+        if op == 'submit':
+            paths = request.get('paths')
+            if not isinstance(paths, list) or not paths or not all(isinstance(p, str) for p in paths):
+                raise ValueError('paths must be a list of strings')
+            job = self.server.jobs.submit([Path(p) for p in paths], request.get('priority', 'interactive'))
+            logger.info('Job %s submitted with %d paths at %s priority', job.id, len(paths), job.priority)
+            self.send({'job': job.id})
+        elif op == 'status':
+            self.send(self.find_job(request).summary())
+        elif op == 'wait':
+            job = self.find_job(request)
+            job.wait(request.get('timeout'))
+            self.send(job.summary(results=bool(request.get('results'))))
+        elif op == 'stream':
+            job = self.find_job(request)
+            for result in job.stream():
+                self.send(result.model_dump())
+            self.send(job.summary())
+        elif op == 'concurrency':
+            controller = self.server.controller
+            if controller is None:
+                raise ValueError('Concurrency control is not enabled')
+            settings = {k: request[k] for k in ('workers', 'max_workers', 'max_load', 'adaptive') if k in request}
+            if settings:
+                controller.set(**settings)
+            self.send(controller.state())
+        else:
+            raise ValueError(f'Unknown op: {op}')
+
+    def handle(self):
+        '''
+        Handle the requests on the connection until it is closed
+        '''
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('Request must be a JSON object')
+                self.handle_request(request)
+            except (ValueError, TypeError) as e:
+                self.send({'error': str(e)})
+            except OSError:
+                return
+            except Exception as e:
+                logger.exception('Unable to handle request %s', line.strip()[:200])
+                self.send({'error': f'Internal error: {e}'})
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    A UNIX socket server that queues jobs for the processor
+    '''
+    daemon_threads = True
+
+    def __init__(self, path: Path | str, jobs: JobQueue, controller: Optional[ConcurrencyController] = None):
+        '''
+        Constructor
+
+        Args:
+            path:       The path of the socket. Any existing socket there is replaced
+            jobs:       The queue to submit jobs to
+            controller: The processor's concurrency controller, to change at runtime
+        '''
+        self.path = Path(path)
+        self.jobs = jobs
+        self.controller = controller
+        self.path.unlink(missing_ok=True)
+        super().__init__(str(self.path), RequestHandler)
+        os.chmod(self.path, 0o660)
+
+    def start(self) -> threading.Thread:
+        '''
+        Serve requests in a background thread
+
+        Returns:
+            The thread
+        '''
+        thread = threading.Thread(target=self.serve_forever, name='job-server', daemon=True)
+        thread.start()
+        return thread
+
+    def server_close(self):
+        '''
+        Close the server and remove the socket
+        '''
+        super().server_close()
+        self.path.unlink(missing_ok=True)
+
+
+class JobClient:
+    '''
+    A client for the job server
+    '''
+
+    def __init__(self, path: Path | str, timeout: Optional[float] = None):
+        '''
+        Constructor
+
+        Args:
+            path:    The path of the server socket
+            timeout: The socket timeout in seconds, or None for no timeout
+        '''
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(str(path))
+        self.rfile = self.sock.makefile('rb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        '''
+        Close the connection
+        '''
+        self.rfile.close()
+        self.sock.close()
+
+    def request(self, request: Dict) -> Dict:
+        '''
+        Send a request and read the response
+
+        Args:
+            request: The request
+
+        Raises:
+            ValueError: If the server returned an error
+
+        Returns:
+            The response
+        '''
+        self.sock.sendall(json.dumps(request).encode() + b'\n')
+        return self.read()
+
+    def read(self) -> Dict:
+        '''
+        Read a response
+
+        Raises:
+            ConnectionError: If the server closed the connection
+            ValueError:      If the server returned an error
+
+        Returns:
+            The response
+        '''
+        line = self.rfile.readline()
+        if not line:
+            raise ConnectionError('Connection closed by the server')
+        response = json.loads(line)
+        if list(response) == ['error']:
+            raise ValueError(response['error'])
+        return response
+
+    def submit(self, paths: List[Path | str], priority: str = 'interactive') -> str:
+        '''
+        Submit a job
+
+        Args:
+            paths:    The files and directories to process
+            priority: The priority of the job
+
+        Returns:
+            The job id
+        '''
+        return self.request({'op': 'submit', 'paths': [str(p) for p in paths], 'priority': priority})['job']
+
+    def status(self, job: str) -> Dict:
+        '''
+        Get the summary of a job
+
+        Args:
+            job: The job id
+
+        Returns:
+            The job summary
+        '''
+        return self.request({'op': 'status', 'job': job})
+
+    def wait(self, job: str, timeout: Optional[float] = None, results=False) -> Dict:
+        '''
+        Wait for a job to finish
+
+        Args:
+            job:     The job id
+            timeout: The maximum time to wait in seconds, or None to wait forever
+            results: Include the result of every file
+
+        Returns:
+            The job summary
+        '''
+        return self.request({'op': 'wait', 'job': job, 'timeout': timeout, 'results': results})
+
+    def concurrency(self, **settings) -> Dict:
+        '''
+        Get or change the concurrency settings of the processor
+
+        Args:
+            settings: Any of workers, max_workers, max_load or adaptive
+
+        Returns:
+            The current settings
+        '''
+        return self.request({'op': 'concurrency', **settings})
+
+    def stream(self, job: str) -> Iterator[Dict]:
+        '''
+        Stream the file results of a job, until it finishes
+
+        Args:
+            job: The job id
+
+        Yields:
+            Each file result, and then the job summary
+        '''
+        self.sock.sendall(json.dumps({'op': 'stream', 'job': job}).encode() + b'\n')
+        while True:
+            response = self.read()
+            yield response
+            if 'job' in response:
+                return
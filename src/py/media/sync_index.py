@@ -0,0 +1,111 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# A persistent index of the files copied from syncthing shares
+#
+
+'''
+A persistent index of the files in each destination of the syncthing copy
+paths. Checking whether a file from a sync event has already been copied is
+then a lookup, rather than a walk of the whole destination tree. The index
+is a SQLite database, keyed by the destination directory and the path of
+each file relative to it.
+'''
+
+# System Imports
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Iterable, Set
+
+
+class SyncIndex:
+    '''
+    A SQLite index of the files in each copy destination
+    '''
+
+    def __init__(self, path: Path | str):
+        '''
+        Constructor
+
+        Args:
+            path: The path of the SQLite database file. It is created if it doesn't exist
+        '''
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+                dst TEXT NOT NULL,
+                path TEXT NOT NULL,
+                PRIMARY KEY (dst, path)
+            ) WITHOUT ROWID
+        ''')
+
+    def close(self):
+        '''
+        Close the index
+        '''
+        with self.lock:
+            self.db.close()
+
+    def contains(self, dst: Path, path: Path) -> bool:
+        '''
+        Check if a file is in a destination
+
+        Args:
+            dst:  The destination directory
+            path: The path of the file, relative to dst
+
+        Returns:
+            True if the file is in the index
+        '''
+        with self.lock:
+            row = self.db.execute('SELECT 1 FROM files WHERE dst = ? AND path = ?', (str(dst), path.as_posix())).fetchone()
+        return row is not None
+
+    def get(self, dst: Path) -> Set[Path]:
+        '''
+        Get all the files in a destination
+
+        Args:
+            dst: The destination directory
+
+        Returns:
+            The paths of the files, relative to dst
+        '''
+        with self.lock:
+            rows = self.db.execute('SELECT path FROM files WHERE dst = ?', (str(dst),)).fetchall()
+        return {Path(row[0]) for row in rows}
+
+    def add(self, dst: Path, paths: Iterable[Path]):
+        '''
+        Add files to a destination
+
+        Args:
+            dst:   The destination directory
+            paths: The paths of the files, relative to dst
+        '''
+        with self.lock:
+            self.db.executemany('INSERT OR IGNORE INTO files VALUES (?, ?)', ((str(dst), p.as_posix()) for p in paths))
+
+    def replace(self, dst: Path, paths: Iterable[Path]):
+        '''
+        Replace all the files in a destination, eg. after a full scan of it
+
+        Args:
+            dst:   The destination directory
+            paths: The paths of the files, relative to dst
+        '''
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                self.db.execute('DELETE FROM files WHERE dst = ?', (str(dst),))
+                self.db.executemany('INSERT OR IGNORE INTO files VALUES (?, ?)', ((str(dst), p.as_posix()) for p in paths))
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
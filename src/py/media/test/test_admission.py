@@ -0,0 +1,78 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Unit tests for the admission module
+#
+
+'''
+Unit tests for the admission module
+'''
+
+# System Imports
+import time
+import threading
+import unittest
+
+# Local imports
+from media.admission import DecodeBudget
+
+
+class TestDecodeBudget(unittest.TestCase):
+    def test_admits_files_within_budget(self):
+        budget = DecodeBudget(100)
+        with budget.admit(40) as alone1, budget.admit(60) as alone2:
+            self.assertFalse(alone1 or alone2)
+            self.assertEqual(budget.used, 100)
+        self.assertEqual(budget.used, 0)
+
+    def test_waits_for_room_in_budget(self):
+        budget = DecodeBudget(100)
+        events = []
+
+        def decode(name, size, hold):
+            with budget.admit(size):
+                events.append(f'start {name}')
+                time.sleep(hold)
+                events.append(f'end {name}')
+
+        first = threading.Thread(target=decode, args=('a', 80, 0.1))
+        first.start()
+        time.sleep(0.02)
+        second = threading.Thread(target=decode, args=('b', 40, 0))
+        second.start()
+        first.join()
+        second.join()
+        self.assertEqual(events, ['start a', 'end a', 'start b', 'end b'])
+
+    def test_decodes_oversized_file_alone(self):
+        budget = DecodeBudget(100)
+        events = []
+
+        def decode(name, size, hold):
+            with budget.admit(size) as alone:
+                events.append(f'start {name} {alone}')
+                time.sleep(hold)
+                events.append(f'end {name}')
+
+        threads = [threading.Thread(target=decode, args=('small', 10, 0.1))]
+        threads[0].start()
+        time.sleep(0.02)
+        threads.append(threading.Thread(target=decode, args=('big', 500, 0.1)))
+        threads[1].start()
+        time.sleep(0.02)
+        # This would fit in the budget, but waits for the big file
+        threads.append(threading.Thread(target=decode, args=('next', 10, 0)))
+        threads[2].start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(events, ['start small False', 'end small', 'start big True', 'end big', 'start next False', 'end next'])
+
+    def test_releases_budget_on_error(self):
+        budget = DecodeBudget(100)
+        with self.assertRaises(ValueError):
+            with budget.admit(500):
+                raise ValueError('corrupt')
+        with budget.admit(50) as alone:
+            self.assertFalse(alone)
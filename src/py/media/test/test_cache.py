@@ -0,0 +1,138 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Unit tests for the cache module
+#
+
+'''
+Unit tests for the cache module
+'''
+
+# System Imports
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from pathlib import Path
+
+# Local imports
+from media.cache import ExtractionCache, CACHE_VERSION, read_sha256_xattr, write_sha256_xattr, SHA256_XATTR
+from media.logger import logger
+from media.model import FileMetadata
+
+
+# Disable logging
+logger.disabled = True
+
+
+class TestExtractionCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmpdir.name)
+        self.path = self.dir / 'bar.jpg'
+        self.path.write_bytes(b'hello')
+        self.file = FileMetadata(path=str(self.path), type='image', timestamp=1632345600, size=5, width=640, height=480, make='Foo', sha256='a' * 64, fingerprint='b' * 32, thumbnail=b'\xff\xd8xxx', phash=-1234)
+        self.cache = ExtractionCache(self.dir / 'cache.db')
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+
+    def test_can_store_and_load_metadata(self):
+        self.assertIsNone(self.cache.get(self.path, False))
+        self.cache.put(self.file, False)
+        self.assertEqual(self.cache.get(self.path, False), self.file)
+
+    def test_can_store_and_load_thumbnail_pyramid(self):
+        self.file.thumbnail_format = 'webp'
+        self.file.thumbnail_sizes = [128, 256, 512]
+        self.file.thumbnails = [b'RIFF\x00small', None, b'RIFF\xffbig']
+        self.file.storyboard, self.file.storyboard_columns, self.file.storyboard_times = b'\xff\xd8board', 2, [0, 1000, 2000]
+        self.cache.put(self.file, False)
+        self.assertEqual(self.cache.get(self.path, False), self.file)
+
+    def test_cache_is_keyed_by_file_time_mode(self):
+        self.cache.put(self.file, False)
+        self.assertIsNone(self.cache.get(self.path, True))
+
+    @patch.dict('os.environ', {'THUMBNAIL_SIZE': '256'})
+    def test_cache_is_keyed_by_thumbnail_settings(self):
+        self.cache.put(self.file, False)
+        with patch.dict('os.environ', {'THUMBNAIL_SIZE': '512'}):
+            self.assertIsNone(self.cache.get(self.path, False))
+        with patch.dict('os.environ', {'THUMBNAIL_FORMAT': 'webp'}):
+            self.assertIsNone(self.cache.get(self.path, False))
+        self.assertEqual(self.cache.get(self.path, False), self.file)
+
+    def test_cache_from_older_version_is_cleared(self):
+        self.cache.put(self.file, False)
+        self.cache.db.execute(f'PRAGMA user_version = {CACHE_VERSION - 1}')
+        self.cache.close()
+        self.cache = ExtractionCache(self.dir / 'cache.db')
+        self.assertIsNone(self.cache.get(self.path, False))
+        self.cache.put(self.file, False)
+        self.assertEqual(self.cache.get(self.path, False), self.file)
+
+    def test_modified_file_is_not_cached(self):
+        self.cache.put(self.file, False)
+        stats = os.stat(self.path)
+        os.utime(self.path, ns=(stats.st_atime_ns, stats.st_mtime_ns + 1000))
+        self.assertIsNone(self.cache.get(self.path, False))
+
+    def test_moved_file_is_still_cached(self):
+        self.cache.put(self.file, False)
+        moved = self.dir / 'baz.jpg'
+        self.path.rename(moved)
+        file = self.cache.get(moved, False)
+        self.assertEqual(file.path, str(moved))
+        self.assertEqual(file.thumbnail, self.file.thumbnail)
+
+    def test_cache_persists(self):
+        self.cache.put(self.file, False)
+        self.cache.close()
+        self.cache = ExtractionCache(self.dir / 'cache.db')
+        self.assertEqual(self.cache.get(self.path, False), self.file)
+
+
+class TestSha256Xattr(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpdir.name) / 'bar.jpg'
+        self.path.write_bytes(b'hello')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    @patch('media.cache.os.getxattr', create=True)
+    def test_can_read_xattr(self, mock_getxattr):
+        stats = os.stat(self.path)
+        mock_getxattr.return_value = f'{"a" * 64}:{stats.st_size}:{stats.st_mtime_ns}'.encode()
+        self.assertEqual(read_sha256_xattr(self.path), 'a' * 64)
+        mock_getxattr.assert_called_with(self.path, SHA256_XATTR)
+
+    @patch('media.cache.os.getxattr', create=True)
+    def test_ignores_stale_xattr(self, mock_getxattr):
+        stats = os.stat(self.path)
+        mock_getxattr.return_value = f'{"a" * 64}:{stats.st_size}:{stats.st_mtime_ns - 1}'.encode()
+        self.assertIsNone(read_sha256_xattr(self.path))
+
+    @patch('media.cache.os.getxattr', create=True)
+    def test_ignores_missing_xattr(self, mock_getxattr):
+        mock_getxattr.side_effect = OSError('No data available')
+        self.assertIsNone(read_sha256_xattr(self.path))
+
+    @patch('media.cache.os.setxattr', create=True)
+    def test_can_write_xattr(self, mock_setxattr):
+        stats = os.stat(self.path)
+        write_sha256_xattr(self.path, 'a' * 64)
+        mock_setxattr.assert_called_with(self.path, SHA256_XATTR, f'{"a" * 64}:{stats.st_size}:{stats.st_mtime_ns}'.encode())
+
+    @patch('media.cache.os.setxattr', create=True)
+    def test_ignores_unsupported_xattr(self, mock_setxattr):
+        mock_setxattr.side_effect = OSError('Operation not supported')
+        try:
+            write_sha256_xattr(self.path, 'a' * 64)
+        except Exception as e:
+            self.fail(e)
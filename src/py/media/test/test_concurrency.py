@@ -0,0 +1,132 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Unit tests for the concurrency module
+#
+
+'''
+Unit tests for the concurrency module
+'''
+
+# System Imports
+import unittest
+from unittest.mock import patch, mock_open
+
+# Local imports
+from media.concurrency import ConcurrencyController, read_cpu_times
+from media.logger import logger
+
+
+# Disable logging
+logger.disabled = True
+
+
+class TestReadCpuTimes(unittest.TestCase):
+    @patch('builtins.open', mock_open(read_data='cpu  100 10 50 800 40 0 0 0 0 0\ncpu0 1 2 3 4 5 6 7 8 9 10\n'))
+    def test_reads_busy_iowait_and_total(self):
+        self.assertEqual(read_cpu_times(), (160, 40, 1000))
+
+    @patch('builtins.open', side_effect=FileNotFoundError)
+    def test_missing_proc_stat(self, _):
+        self.assertIsNone(read_cpu_times())
+
+
+class TestConcurrencyController(unittest.TestCase):
+    def setUp(self):
+        self.cpu_patcher = patch('media.concurrency.read_cpu_times')
+        self.mock_cpu = self.cpu_patcher.start()
+        self.ticks = 0
+        self.set_cpu(0.5, 0.0)
+        self.load_patcher = patch('media.concurrency.os.getloadavg')
+        self.mock_load = self.load_patcher.start()
+        self.mock_load.return_value = (0.0, 0.0, 0.0)
+        self.count_patcher = patch('media.concurrency.os.cpu_count', return_value=8)
+        self.count_patcher.start()
+
+    def tearDown(self):
+        self.cpu_patcher.stop()
+        self.load_patcher.stop()
+        self.count_patcher.stop()
+
+    def set_cpu(self, busy: float, iowait: float):
+        '''
+        Make the next reading of the CPU times show a utilisation since the last one
+        '''
+        self.ticks += 1000
+        self.mock_cpu.return_value = (int(busy * self.ticks), int(iowait * self.ticks), self.ticks)
+
+    def test_clamps_initial_workers(self):
+        self.assertEqual(ConcurrencyController(4).state(), {'workers': {'io': 4, 'decode': 4}, 'max_workers': 8, 'max_load': 1.5, 'adaptive': True})
+        self.assertEqual(ConcurrencyController(16).max_workers, 16)
+        self.assertEqual(ConcurrencyController(16, max_workers=2).get('decode'), 2)
+
+    def test_can_set_at_runtime(self):
+        controller = ConcurrencyController(2)
+        controller.set(workers={'decode': 6}, max_load=2, adaptive=False)
+        self.assertEqual(controller.state(), {'workers': {'io': 2, 'decode': 6}, 'max_workers': 8, 'max_load': 2.0, 'adaptive': False})
+        controller.set(max_workers=4)
+        self.assertEqual(controller.get('decode'), 4)
+        self.assertRaises(ValueError, controller.set, workers={'gpu': 2})
+        self.assertRaises(ValueError, controller.set, workers={'io': 0})
+        self.assertRaises(ValueError, controller.set, max_load=-1)
+        self.assertRaises(ValueError, controller.set, max_workers='lots')
+        self.assertRaises(ValueError, controller.set, adaptive='false')
+        self.assertFalse(controller.state()['adaptive'])
+
+    def test_can_step_workers(self):
+        controller = ConcurrencyController(1, max_workers=2)
+        controller.step(1)
+        controller.step(1)
+        self.assertEqual(controller.state()['workers'], {'io': 2, 'decode': 2})
+        controller.step(-5)
+        self.assertEqual(controller.state()['workers'], {'io': 1, 'decode': 1})
+
+    def test_waits_for_interval(self):
+        controller = ConcurrencyController(2, interval=3600)
+        controller.record(10, 1.0, 0.1)
+        self.assertEqual(controller.get('decode'), 2)
+
+    def test_fixed_when_not_adaptive(self):
+        controller = ConcurrencyController(2, adaptive=False, interval=0)
+        controller.record(10, 1.0, 0.1)
+        self.assertEqual(controller.get('decode'), 2)
+
+    def test_climbs_while_throughput_improves(self):
+        controller = ConcurrencyController(2, interval=0)
+        controller.record(10, 1.0, 0.1)
+        self.assertEqual(controller.get('decode'), 3)
+        controller.record(15, 1.0, 0.1)
+        self.assertEqual(controller.get('decode'), 4)
+        # Slower, so turn around
+        controller.record(12, 1.0, 0.1)
+        self.assertEqual(controller.get('decode'), 3)
+        # No real change, so hold
+        controller.record(12, 1.0, 0.1)
+        self.assertEqual(controller.get('decode'), 3)
+
+    def test_doesnt_climb_when_cpu_saturated(self):
+        controller = ConcurrencyController(2, interval=0)
+        self.set_cpu(0.95, 0.0)
+        controller.record(10, 1.0, 0.1)
+        self.assertEqual(controller.get('decode'), 2)
+
+    def test_backs_off_over_load_ceiling(self):
+        controller = ConcurrencyController(4, max_load=1.0, interval=0)
+        self.mock_load.return_value = (12.0, 0.0, 0.0)
+        controller.record(10, 1.0, 0.1)
+        self.assertEqual(controller.state()['workers'], {'io': 3, 'decode': 3})
+
+    def test_backs_off_reads_on_iowait(self):
+        controller = ConcurrencyController(4, interval=0)
+        self.set_cpu(0.2, 0.5)
+        controller.record(10, 1.0, 0.1)
+        self.assertEqual(controller.get('io'), 3)
+
+    def test_backs_off_decode_when_inserts_slow(self):
+        controller = ConcurrencyController(4, interval=0)
+        controller.record(10, 1.0, 0.1)
+        self.assertEqual(controller.get('decode'), 5)
+        controller.record(20, 1.0, 1.0)
+        self.assertEqual(controller.get('decode'), 4)
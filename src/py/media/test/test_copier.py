@@ -0,0 +1,186 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Unit tests for the copier module
+#
+
+'''
+Unit tests for the copier module
+'''
+
+# System Imports
+import os
+import errno
+import shutil
+import hashlib
+import tempfile
+import unittest
+from unittest.mock import patch
+from pathlib import Path
+
+# Local imports
+from media.copier import copy_file, copy_range, parallel_copy, reflink
+from media.logger import logger
+
+
+# Disable logging
+logger.disabled = True
+
+
+class CopierTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmpdir.name)
+        self.data = os.urandom(3 * 1024 * 1024 + 17)
+        self.src = self.dir / 'src.jpg'
+        self.src.write_bytes(self.data)
+        os.utime(self.src, ns=(1632345600000000000, 1632345600123456789))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+class TestReflink(unittest.TestCase):
+    @patch('media.copier.fcntl.ioctl')
+    def test_unsupported(self, mock_ioctl):
+        mock_ioctl.side_effect = OSError(errno.EOPNOTSUPP, 'Operation not supported')
+        self.assertFalse(reflink(3, 4))
+
+    @patch('media.copier.fcntl.ioctl')
+    def test_other_errors_are_raised(self, mock_ioctl):
+        mock_ioctl.side_effect = OSError(errno.ENOSPC, 'No space left on device')
+        self.assertRaises(OSError, reflink, 3, 4)
+
+
+class TestCopyRange(unittest.TestCase):
+    @patch('media.copier.os.copy_file_range')
+    def test_unsupported(self, mock_copy_file_range):
+        mock_copy_file_range.side_effect = OSError(errno.EXDEV, 'Invalid cross-device link')
+        self.assertFalse(copy_range(3, 4, 100))
+
+    @patch('media.copier.os.copy_file_range')
+    def test_copies_in_chunks(self, mock_copy_file_range):
+        mock_copy_file_range.side_effect = [60, 40]
+        self.assertTrue(copy_range(3, 4, 100))
+        self.assertEqual(mock_copy_file_range.call_args_list[1].args, (3, 4, 40))
+
+    @patch('media.copier.os.copy_file_range')
+    def test_nothing_copied(self, mock_copy_file_range):
+        mock_copy_file_range.return_value = 0
+        self.assertFalse(copy_range(3, 4, 100))
+
+    @patch('media.copier.os.copy_file_range')
+    def test_errors_after_copying_are_raised(self, mock_copy_file_range):
+        mock_copy_file_range.side_effect = [60, OSError(errno.EXDEV, 'Invalid cross-device link')]
+        self.assertRaises(OSError, copy_range, 3, 4, 100)
+
+
+class TestCopyFile(CopierTestCase):
+    def assertCopied(self, copied, dst):
+        self.assertEqual(copied.path, dst)
+        self.assertEqual(dst.read_bytes(), self.data)
+        self.assertEqual(copied.size, len(self.data))
+        self.assertEqual(copied.mtime_ns, 1632345600123456789)
+        self.assertEqual(os.stat(dst).st_mtime_ns, 1632345600123456789)
+        self.assertFalse((self.dir / f'.{dst.name}.part').exists())
+
+    @patch('media.copier.reflink', lambda *_: False)
+    @patch('media.copier.copy_range', lambda *_: False)
+    def test_userspace_copy_calculates_sha256(self):
+        dst = self.dir / 'dst.jpg'
+        copied = copy_file(self.src, dst)
+        self.assertCopied(copied, dst)
+        self.assertEqual(copied.method, 'userspace')
+        self.assertEqual(copied.sha256, hashlib.sha256(self.data).hexdigest())
+
+    @patch('media.copier.reflink', lambda *_: False)
+    def test_copy_file_range(self):
+        dst = self.dir / 'dst.jpg'
+        with patch('media.copier.os.copy_file_range', wraps=os.copy_file_range) as mock_copy_file_range:
+            copied = copy_file(self.src, dst)
+            mock_copy_file_range.assert_called()
+        self.assertCopied(copied, dst)
+        self.assertEqual(copied.method, 'copy_file_range')
+        self.assertIsNone(copied.sha256)
+
+    @patch('media.copier.fcntl.ioctl')
+    def test_reflink(self, mock_ioctl):
+        copied = copy_file(self.src, self.dir / 'dst.jpg')
+        mock_ioctl.assert_called_once()
+        self.assertEqual(copied.method, 'reflink')
+        self.assertIsNone(copied.sha256)
+
+    def test_does_not_overwrite(self):
+        dst = self.dir / 'dst.jpg'
+        dst.write_bytes(b'existing')
+        self.assertIsNone(copy_file(self.src, dst))
+        self.assertEqual(dst.read_bytes(), b'existing')
+        self.assertFalse((self.dir / '.dst.jpg.part').exists())
+
+    def test_does_not_overwrite_file_created_during_copy(self):
+        dst = self.dir / 'dst.jpg'
+        real_copystat = shutil.copystat
+
+        def copystat(src, tmp):
+            real_copystat(src, tmp)
+            dst.write_bytes(b'existing')
+
+        with patch('media.copier.shutil.copystat', side_effect=copystat):
+            self.assertIsNone(copy_file(self.src, dst))
+        self.assertEqual(dst.read_bytes(), b'existing')
+        self.assertFalse((self.dir / '.dst.jpg.part').exists())
+
+    @patch('media.copier.os.link')
+    def test_renames_without_hard_links(self, mock_link):
+        mock_link.side_effect = OSError(errno.EPERM, 'Operation not permitted')
+        dst = self.dir / 'dst.jpg'
+        self.assertCopied(copy_file(self.src, dst), dst)
+
+    @patch('media.copier.shutil.copystat')
+    def test_failed_copystat_is_removed(self, mock_copystat):
+        mock_copystat.side_effect = PermissionError(errno.EPERM, 'Operation not permitted')
+        dst = self.dir / 'dst.jpg'
+        self.assertRaises(OSError, copy_file, self.src, dst)
+        self.assertFalse(dst.exists())
+        self.assertFalse((self.dir / '.dst.jpg.part').exists())
+
+    @patch('media.copier.reflink', lambda *_: False)
+    @patch('media.copier.copy_range', lambda *_: False)
+    @patch('media.copier.copy_userspace')
+    def test_failed_copy_is_removed(self, mock_copy_userspace):
+        mock_copy_userspace.side_effect = OSError(errno.EIO, 'I/O error')
+        dst = self.dir / 'dst.jpg'
+        self.assertRaises(OSError, copy_file, self.src, dst)
+        self.assertFalse(dst.exists())
+        self.assertFalse((self.dir / '.dst.jpg.part').exists())
+
+    @patch('media.copier.reflink', lambda *_: False)
+    @patch('media.copier.copy_range', lambda *_: False)
+    def test_is_current(self):
+        dst = self.dir / 'dst.jpg'
+        copied = copy_file(self.src, dst)
+        self.assertTrue(copied.is_current())
+        dst.write_bytes(b'modified')
+        self.assertFalse(copied.is_current())
+        dst.unlink()
+        self.assertFalse(copied.is_current())
+
+
+class TestParallelCopy(CopierTestCase):
+    def test_copies_files_in_parallel(self):
+        pairs = [(self.src, self.dir / f'dst{i}.jpg') for i in range(8)]
+        copied = parallel_copy(pairs, 4)
+        self.assertEqual(set(copied), {dst for _, dst in pairs})
+        for _, dst in pairs:
+            self.assertEqual(dst.read_bytes(), self.data)
+
+    def test_skips_failures(self):
+        (self.dir / 'exists.jpg').write_bytes(b'existing')
+        pairs = [(self.dir / 'missing.jpg', self.dir / 'dst1.jpg'), (self.src, self.dir / 'exists.jpg'), (self.src, self.dir / 'dst2.jpg')]
+        self.assertEqual(set(parallel_copy(pairs, 2)), {self.dir / 'dst2.jpg'})
+
+
+if __name__ == '__main__':
+    unittest.main()
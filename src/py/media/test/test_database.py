@@ -31,10 +31,13 @@ class TestDatabase(unittest.TestCase):
         # Patch PostgreSQL
         self.psql_patcher = patch('media.database.psycopg')
         self.mock_psql = self.psql_patcher.start()
+        self.env_patcher = patch.dict('os.environ', {'TIMEZONE': 'Australia/Brisbane'})
+        self.env_patcher.start()
 
     def tearDown(self):
         # Stop the patches
         self.psql_patcher.stop()
+        self.env_patcher.stop()
 
     def test_create_a_db(self):
         db = Database()
@@ -51,6 +54,17 @@ class TestDatabase(unittest.TestCase):
         self.assertFalse(db.is_locked())
         self.assertFalse(db.is_open())
 
+    def test_open_requires_a_timezone(self):
+        db = Database()
+        for timezone in ('', 'Australia/Nowhere'):
+            with patch.dict('os.environ', {'TIMEZONE': timezone}):
+                with self.assertRaisesRegex(ValueError, 'TIMEZONE'):
+                    with db.open():
+                        pass
+        self.mock_psql.connect.assert_not_called()
+        with patch.dict('os.environ', clear=True):
+            self.assertRaisesRegex(ValueError, 'TIMEZONE', db.open().__enter__)
+
     def test_can_lock_db(self):
         db = Database()
         with db.open():
@@ -93,6 +107,31 @@ class TestDatabase(unittest.TestCase):
             db.bulk_insert_media(files)
             db.db.connection.transaction.assert_called()
             db.db.copy.assert_called()
+            write_row = db.db.copy.return_value.__enter__.return_value.write_row
+            self.assertEqual(write_row.call_args_list[0].args[0], tuple(files[0].model_dump().values()))
+            self.assertEqual(write_row.call_args_list[1].args[0], tuple(files[1].model_dump().values()))
+
+    def test_bulk_insert_updates_summaries(self):
+        db = Database()
+        with db.open():
+            files = [
+                FileMetadata(path='/foo/bar.jpg', type='image', timestamp=123456789, size=1234, make='Foo', model='Bar'),
+                FileMetadata(path='/foo/bar.mp4', type='video', timestamp=123456780, size=1235),
+            ]
+            db.bulk_insert_media(files)
+            queries = [c.args for c in db.db.execute.call_args_list]
+            self.assertEqual(len(queries), 2)
+            self.assertIn('INSERT INTO media_day', queries[0][0])
+            self.assertIn('INSERT INTO media_facet', queries[1][0])
+            for _, params in queries:
+                self.assertEqual(params, {
+                    'timestamp': [123456789, 123456780],
+                    'type': ['image', 'video'],
+                    'make': ['Foo', None],
+                    'model': ['Bar', None],
+                    'timezone': 'Australia/Brisbane',
+                    'sign': 1,
+                })
 
     def test_bulk_insert_no_media(self):
         db = Database()
@@ -102,6 +141,94 @@ class TestDatabase(unittest.TestCase):
             db.db.connection.transaction.assert_not_called()
             db.db.copy.assert_not_called()
 
+    def test_create_staging_table(self):
+        db = Database()
+        with db.open():
+            db.create_staging_table()
+            db.db.execute.assert_any_call('DROP TABLE IF EXISTS media_staging')
+            db.db.execute.assert_called_with('CREATE UNLOGGED TABLE media_staging (LIKE media INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+
+    def test_copy_to_staging_table_uses_parallel_streams(self):
+        db = Database()
+        with db.open():
+            files = [FileMetadata(path=f'/foo/bar{i}.jpg', type='image', timestamp=123456789, size=1234) for i in range(5)]
+            db.copy_to_staging_table(files, 3)
+            self.assertEqual(self.mock_psql.connect.call_count, 1 + 3)
+            cursor = self.mock_psql.connect.return_value.__enter__.return_value.cursor.return_value.__enter__.return_value
+            cursor.copy.assert_called_with(ANY)
+            self.assertIn('COPY media_staging', cursor.copy.call_args.args[0])
+            self.assertEqual(cursor.copy.return_value.__enter__.return_value.write_row.call_count, 5)
+
+    def test_copy_to_staging_table_no_media(self):
+        db = Database()
+        with db.open():
+            db.copy_to_staging_table([], 3)
+            self.mock_psql.connect.assert_called_once()
+
+    def test_index_staging_table(self):
+        db = Database()
+        with db.open():
+            db.db.fetchall.return_value = [
+                ['media_path_idx', 'CREATE INDEX media_path_idx ON public.media USING btree (path)', False],
+                ['media_pkey', 'PRIMARY KEY (id)', True],
+            ]
+            db.index_staging_table()
+            db.db.execute.assert_any_call('ALTER TABLE media_staging SET LOGGED')
+            db.db.execute.assert_any_call('CREATE INDEX media_path_idx_staging ON media_staging USING btree (path)')
+            db.db.execute.assert_any_call('ALTER TABLE media_staging ADD CONSTRAINT media_pkey_staging PRIMARY KEY (id)')
+            db.db.execute.assert_called_with('ANALYZE media_staging')
+
+    def test_swap_staging_table(self):
+        db = Database()
+        with db.open():
+            db.db.execute.return_value = db.db
+            db.db.fetchone.return_value = ['public.media_id_seq']
+            db.db.fetchall.return_value = [
+                ['media_path_idx', 'CREATE INDEX media_path_idx ON public.media USING btree (path)', False],
+                ['media_pkey', 'PRIMARY KEY (id)', True],
+            ]
+            db.swap_staging_table()
+            db.db.connection.transaction.assert_called()
+            db.db.execute.assert_any_call('ALTER SEQUENCE public.media_id_seq OWNED BY media_staging.id')
+            db.db.execute.assert_any_call('DROP TABLE media')
+            db.db.execute.assert_any_call('ALTER TABLE media_staging RENAME TO media')
+            db.db.execute.assert_any_call('ALTER INDEX media_path_idx_staging RENAME TO media_path_idx')
+            db.db.execute.assert_any_call('ALTER TABLE media RENAME CONSTRAINT media_pkey_staging TO media_pkey')
+            db.db.execute.assert_any_call('DELETE FROM media_day')
+            db.db.execute.assert_any_call('DELETE FROM media_facet')
+
+    def test_swap_staging_table_with_dependents(self):
+        class DependentObjectsStillExist(Exception):
+            diag = SimpleNamespace(message_detail='view media_view depends on table media')
+
+        def execute(query, *_):
+            if query == 'DROP TABLE media':
+                raise DependentObjectsStillExist()
+            return db.db
+
+        self.mock_psql.errors.DependentObjectsStillExist = DependentObjectsStillExist
+        db = Database()
+        with db.open():
+            db.db.execute.side_effect = execute
+            db.db.fetchone.return_value = [None]
+            db.db.fetchall.return_value = []
+            with self.assertRaisesRegex(RuntimeError, 'view media_view depends on table media'):
+                db.swap_staging_table()
+            self.assertNotIn('ALTER TABLE media_staging RENAME TO media', [c.args[0] for c in db.db.execute.call_args_list])
+
+    def test_copy_other_media_to_staging_table(self):
+        db = Database()
+        with db.open():
+            db.copy_other_media_to_staging_table([Path('/foo/'), Path('/bar/baz.jpg')])
+            db.db.execute.assert_called_with(ANY, [['/foo', '/bar/baz.jpg']])
+            self.assertIn('INSERT INTO media_staging', db.db.execute.call_args.args[0])
+
+    def test_get_media_dependents(self):
+        db = Database()
+        with db.open():
+            db.db.fetchall.return_value = [['media_view'], ['album_media_fkey on album']]
+            self.assertEqual(db.get_media_dependents(), ['media_view', 'album_media_fkey on album'])
+
     def test_existing_paths_stripped(self):
         db = Database()
         with db.open():
@@ -133,6 +260,149 @@ class TestDatabase(unittest.TestCase):
             self.assertEqual(files - stripped, {Path('/foo/bar532.jpg'), Path('/foo/bar121.jpg')})
             db.db.execute.assert_called_with('SELECT path FROM media')
 
+    def test_find_media_by_sha256(self):
+        db = Database()
+        with db.open():
+            header = list(FileMetadata.__annotations__.keys())
+            file = FileMetadata(path='/foo/bar.jpg', type='image', timestamp=123456789, size=1234, sha256='abc')
+            db.db.fetchall.return_value = [[getattr(file, k) for k in header]]
+            self.assertEqual(db.find_media_by_sha256({'abc'}), [file])
+            db.db.execute.assert_called_with(ANY, [['abc']])
+
+    def test_find_media_by_sha256_no_hashes(self):
+        db = Database()
+        with db.open():
+            self.assertEqual(db.find_media_by_sha256(set()), [])
+            db.db.execute.assert_not_called()
+
+    def test_quarantine_file(self):
+        db = Database()
+        with db.open():
+            db.quarantine_file(Path('/foo/bar.jpg'), 1234, 'Timed out')
+            db.db.execute.assert_called_with(ANY, ['/foo/bar.jpg', 1234, 'Timed out'])
+            self.assertIn('ON CONFLICT', db.db.execute.call_args.args[0])
+
+    def test_get_quarantined(self):
+        db = Database()
+        with db.open():
+            db.db.fetchall.return_value = [['/foo/bar.jpg', 1234, 'Timed out']]
+            self.assertEqual(db.get_quarantined({Path('/foo/bar.jpg'), Path('/foo/baz.jpg')}), {Path('/foo/bar.jpg'): (1234, 'Timed out')})
+            self.assertCountEqual(db.db.execute.call_args.args[1][0], ['/foo/bar.jpg', '/foo/baz.jpg'])
+
+    def test_get_quarantined_no_paths(self):
+        db = Database()
+        with db.open():
+            self.assertEqual(db.get_quarantined(set()), {})
+            db.db.execute.assert_not_called()
+
+    def test_get_media_paths(self):
+        db = Database()
+        with db.open():
+            db.db.fetchall.return_value = [['/foo/bar.jpg', 1], ['/foo/baz/qux.jpg', 2]]
+            self.assertEqual(db.get_media_paths(Path('/foo')), {'/foo/bar.jpg': 1, '/foo/baz/qux.jpg': 2})
+            db.db.execute.assert_called_with(ANY, ['/foo/'])
+            db.get_media_paths(Path('/'))
+            db.db.execute.assert_called_with(ANY, ['/'])
+
+    def test_get_media_hashes(self):
+        db = Database()
+        with db.open():
+            db.db.fetchall.return_value = [[1, 1234, 'abc', 'def']]
+            self.assertEqual(db.get_media_hashes([1]), [(1, 1234, 'abc', 'def')])
+            db.db.execute.assert_called_with(ANY, [[1]])
+            db.db.execute.reset_mock()
+            self.assertEqual(db.get_media_hashes([]), [])
+            db.db.execute.assert_not_called()
+
+    def test_move_media(self):
+        db = Database()
+        with db.open():
+            db.move_media([(1, Path('/foo/bar.jpg'))])
+            db.db.connection.transaction.assert_called()
+            db.db.executemany.assert_called_with(ANY, [('/foo/bar.jpg', 1)])
+            db.db.executemany.reset_mock()
+            db.move_media([])
+            db.db.executemany.assert_not_called()
+
+    def test_delete_media(self):
+        db = Database()
+        with db.open():
+            db.delete_media([1, 2])
+            db.db.execute.assert_called_with(ANY, [[1, 2]])
+            queries = [c.args for c in db.db.execute.call_args_list]
+            self.assertIn('INSERT INTO media_day', queries[0][0])
+            self.assertEqual(queries[0][1], {'ids': [1, 2], 'timezone': 'Australia/Brisbane', 'sign': -1})
+            self.assertIn('DELETE FROM media_day WHERE count <= 0', [q[0] for q in queries])
+            db.db.execute.reset_mock()
+            db.delete_media([])
+            db.db.execute.assert_not_called()
+
+    def test_recompute_summaries(self):
+        db = Database()
+        with db.open():
+            db.recompute_summaries()
+            db.db.connection.transaction.assert_called()
+            queries = [c.args[0] for c in db.db.execute.call_args_list]
+            self.assertEqual(queries[:2], ['DELETE FROM media_day', 'DELETE FROM media_facet'])
+            self.assertIn('FROM media)', queries[2])
+            self.assertEqual(len(queries), 4)
+
+    def test_get_unkeyed_locations(self):
+        db = Database()
+        with db.open():
+            db.db.fetchall.return_value = [[1, -33.86, 151.21]]
+            self.assertEqual(db.get_unkeyed_locations(10, 50), [(1, -33.86, 151.21)])
+            db.db.execute.assert_called_with(ANY, [10, 50])
+
+    def test_update_quadkeys(self):
+        db = Database()
+        with db.open():
+            db.update_quadkeys([(1, 123), (2, 456)])
+            db.db.execute.assert_called_once_with(ANY, [[1, 2], [123, 456]])
+            db.db.execute.reset_mock()
+            db.update_quadkeys([])
+            db.db.execute.assert_not_called()
+
+    def test_get_phashes(self):
+        db = Database()
+        with db.open():
+            db.db.fetchall.return_value = [[1, '/foo/bar.jpg', -1234]]
+            self.assertEqual(db.get_phashes(), [(1, '/foo/bar.jpg', -1234)])
+
+    def test_stream_media(self):
+        db = Database()
+        with db.open():
+            cursor = db.db.connection.cursor.return_value.__enter__.return_value
+            cursor.__iter__.return_value = iter([[1, '/foo/bar.jpg', 'image'], [2, '/foo/bar.mp4', 'video']])
+            self.assertEqual(list(db.stream_media(10, 50)), [(1, '/foo/bar.jpg', 'image'), (2, '/foo/bar.mp4', 'video')])
+            db.db.connection.cursor.assert_called_with(name='media_stream', withhold=True)
+            cursor.execute.assert_called_with(ANY, [10])
+            self.assertEqual(cursor.itersize, 50)
+
+    def test_update_thumbnails(self):
+        db = Database()
+        with db.open():
+            file = FileMetadata(path='/foo/bar.jpg', type='image', timestamp=0, size=0, thumbnail=b'abc', phash=12, thumbnail_sizes=[64, 128], thumbnails=[None, b'def'])
+            db.update_thumbnails([(3, file)])
+            db.db.connection.transaction.assert_called()
+            db.db.executemany.assert_called_with(ANY, [(b'abc', 12, 'jpeg', [64, 128], [None, b'def'], 3)])
+            self.assertNotIn('sha256', db.db.executemany.call_args.args[0])
+
+    def test_update_no_thumbnails(self):
+        db = Database()
+        with db.open():
+            db.update_thumbnails([])
+            db.db.executemany.assert_not_called()
+
+    def test_get_progress(self):
+        db = Database()
+        with db.open():
+            db.db.execute.return_value = db.db
+            db.db.fetchone.return_value = [{'state': 'complete'}]
+            self.assertEqual(db.get_progress('foo'), {'state': 'complete'})
+            db.db.fetchone.return_value = None
+            self.assertIsNone(db.get_progress('foo'))
+
     def test_can_update_progress(self):
         db = Database()
         with db.open():
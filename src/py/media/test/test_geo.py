@@ -0,0 +1,66 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Unit tests for the geo module
+#
+
+'''
+Unit tests for the geo module
+'''
+
+# System Imports
+import unittest
+
+# Local imports
+from media.geo import interleave, quadkey, quadkeys, tile, QUADKEY_ZOOM
+
+
+def to_string(key: int, zoom: int) -> str:
+    '''
+    Format a quadkey as its base 4 string
+    '''
+    return ''.join(str((key >> 2 * (zoom - level)) & 3) for level in range(1, zoom + 1))
+
+
+class TestGeo(unittest.TestCase):
+    def test_interleave(self):
+        # Tile (3, 5) at zoom 3 has the quadkey 213
+        self.assertEqual(to_string(interleave(3, 5), 3), '213')
+        self.assertEqual(interleave(0, 0), 0)
+        self.assertEqual(interleave(2**32 - 1, 2**32 - 1), 2**64 - 1)
+
+    def test_quadkey(self):
+        self.assertEqual(to_string(quadkey(47.61, -122.107, 3), 3), '021')
+        self.assertEqual(quadkey(-33.86, 151.21, 1), 3)
+        self.assertEqual(quadkey(51.5, -0.1, 1), 0)
+        self.assertEqual(quadkey(0.0, 0.0, 1), 3)
+
+    def test_quadkey_without_location(self):
+        self.assertIsNone(quadkey(None, 151.21))
+        self.assertIsNone(quadkey(-33.86, None))
+        self.assertIsNone(quadkey(float('nan'), 151.21))
+
+    def test_quadkey_clamps_to_the_map(self):
+        n = 2**QUADKEY_ZOOM - 1
+        self.assertEqual(quadkey(90.0, -180.0), interleave(0, 0))
+        self.assertEqual(quadkey(-90.0, 180.0), interleave(n, n))
+
+    def test_quadkeys_matches_quadkey(self):
+        latitudes = [47.61, None, -33.86, 90.0, 0.0, -12.5]
+        longitudes = [-122.107, 1.0, 151.21, 0.0, 0.0, None]
+        self.assertEqual(quadkeys(latitudes, longitudes), [quadkey(lat, lon) for lat, lon in zip(latitudes, longitudes)])
+        self.assertEqual(quadkeys(latitudes, longitudes, 3)[0], quadkey(47.61, -122.107, 3))
+
+    def test_quadkeys_empty(self):
+        self.assertEqual(quadkeys([], []), [])
+
+    def test_tile(self):
+        key = quadkey(47.61, -122.107)
+        for zoom in range(QUADKEY_ZOOM + 1):
+            self.assertEqual(tile(key, zoom), quadkey(47.61, -122.107, zoom))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Unit tests for the hashing module
+#
+
+'''
+Unit tests for the hashing module
+'''
+
+# System Imports
+import os
+import mmap
+import hashlib
+import tempfile
+import unittest
+from unittest.mock import patch, ANY
+from pathlib import Path
+
+# Local imports
+from media.hashing import HashEngine
+from media.logger import logger
+
+
+# Disable logging
+logger.disabled = True
+
+
+class TestHashEngine(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmpdir.name)
+        self.small = self.dir / 'small.jpg'
+        self.small.write_bytes(b'hello')
+        self.large = self.dir / 'large.mp4'
+        self.large.write_bytes(os.urandom(300 * 1024 + 7))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_can_hash_small_file(self):
+        engine = HashEngine()
+        self.assertEqual(engine.sha256(self.small), '2cf24dba5fb0a30e26e83b2ac5b9e29e1b161e5c1fa7425e73043362938b9824')
+
+    def test_can_hash_with_read_loop(self):
+        engine = HashEngine(min_buffer=4096, mmap_threshold=0)
+        self.assertEqual(engine.sha256(self.large), hashlib.sha256(self.large.read_bytes()).hexdigest())
+
+    def test_can_hash_with_mmap(self):
+        engine = HashEngine(min_buffer=4096, mmap_threshold=1024, stable_age=0)
+        with patch('media.hashing.mmap.mmap', wraps=mmap.mmap) as mock_mmap:
+            self.assertEqual(engine.sha256(self.large), hashlib.sha256(self.large.read_bytes()).hexdigest())
+            mock_mmap.assert_called_once()
+
+    def test_recently_modified_file_isnt_mapped(self):
+        engine = HashEngine(min_buffer=4096, mmap_threshold=1024, stable_age=3600)
+        with patch('media.hashing.mmap.mmap') as mock_mmap:
+            self.assertEqual(engine.sha256(self.large), hashlib.sha256(self.large.read_bytes()).hexdigest())
+            mock_mmap.assert_not_called()
+
+    def test_file_that_changes_while_hashing_fails(self):
+        engine = HashEngine()
+        stats = os.stat(self.small)
+        changed = os.stat_result((*stats[:6], stats.st_size + 1, *stats[7:]))
+        with patch('media.hashing.os.fstat', side_effect=[stats, changed]):
+            with self.assertRaisesRegex(OSError, 'changed while it was being hashed'):
+                engine.sha256(self.small)
+
+    @unittest.skipUnless(hasattr(os, 'POSIX_FADV_DONTNEED'), 'posix_fadvise is not supported')
+    def test_drop_cache_is_opt_in(self):
+        engine = HashEngine()
+        with patch.object(engine, 'advise') as mock_advise:
+            engine.sha256(self.small)
+            self.assertNotIn(os.POSIX_FADV_DONTNEED, [c.args[1] for c in mock_advise.call_args_list])
+            engine.sha256(self.small, drop_cache=True)
+            mock_advise.assert_called_with(ANY, os.POSIX_FADV_DONTNEED)
+
+    def test_can_hash_empty_file_with_mmap_enabled(self):
+        empty = self.dir / 'empty'
+        empty.touch()
+        engine = HashEngine(mmap_threshold=1)
+        self.assertEqual(engine.sha256(empty), hashlib.sha256(b'').hexdigest())
+
+    def test_buffer_grows_with_file_size(self):
+        engine = HashEngine(min_buffer=64 * 1024, max_buffer=1024 * 1024)
+        with patch.object(engine, 'is_rotational', return_value=False):
+            self.assertEqual(engine.buffer_size(1024, 0), 64 * 1024)
+            self.assertEqual(engine.buffer_size(16 * 1024 * 1024, 0), 256 * 1024)
+            self.assertEqual(engine.buffer_size(10 * 1024 * 1024 * 1024, 0), 1024 * 1024)
+
+    def test_rotational_disks_use_largest_buffer(self):
+        engine = HashEngine(min_buffer=64 * 1024, max_buffer=1024 * 1024)
+        with patch.object(engine, 'is_rotational', return_value=True):
+            self.assertEqual(engine.buffer_size(1024, 0), 1024 * 1024)
+
+    def test_can_hash_many_files(self):
+        engine = HashEngine()
+        missing = self.dir / 'missing.jpg'
+        with patch.object(engine, 'prefetch') as mock_prefetch:
+            hashes = engine.hash_files([self.small, self.large, missing], 2)
+            self.assertEqual(mock_prefetch.call_count, 3)
+        self.assertEqual(hashes, {
+            self.small: hashlib.sha256(b'hello').hexdigest(),
+            self.large: hashlib.sha256(self.large.read_bytes()).hexdigest(),
+        })
+
+    def test_prefetch_ignores_missing_files(self):
+        engine = HashEngine()
+        try:
+            engine.prefetch(self.dir / 'missing.jpg')
+        except Exception as e:
+            self.fail(e)
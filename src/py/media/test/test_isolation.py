@@ -0,0 +1,87 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Unit tests for the isolation module
+#
+
+'''
+Unit tests for the isolation module
+'''
+
+# System Imports
+import os
+import time
+import signal
+import unittest
+from unittest.mock import patch
+
+# Local imports
+from media.isolation import IsolatedPool, DecodeTimeout, WorkerCrashed, WorkerError
+from media.logger import logger
+
+
+# Disable logging
+logger.disabled = True
+
+
+class TestIsolatedPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = IsolatedPool(timeout=2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_calls_function_in_worker(self):
+        pid = self.pool.call(os.getpid)
+        self.assertNotEqual(pid, os.getpid())
+        self.assertEqual(self.pool.call(int, '42'), 42)
+        self.assertEqual(self.pool.call(int, '2a', base=16), 42)
+
+    def test_reuses_workers(self):
+        pid = self.pool.call(os.getpid)
+        self.assertEqual(self.pool.call(os.getpid), pid)
+        self.assertEqual(len(self.pool.idle), 1)
+
+    def test_raises_function_errors(self):
+        pid = self.pool.call(os.getpid)
+        with self.assertRaisesRegex(WorkerError, 'invalid literal'):
+            self.pool.call(int, 'foo')
+        self.assertEqual(self.pool.call(os.getpid), pid)
+        self.assertEqual(self.pool.replaced, 0)
+
+    def test_replaces_worker_that_times_out(self):
+        self.pool.timeout = 0.5
+        pid = self.pool.call(os.getpid)
+        start = time.monotonic()
+        with self.assertRaises(DecodeTimeout):
+            self.pool.call(time.sleep, 30)
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertNotEqual(self.pool.call(os.getpid), pid)
+        self.assertEqual(self.pool.replaced, 1)
+
+    def test_replaces_worker_that_crashes(self):
+        pid = self.pool.call(os.getpid)
+        with self.assertRaisesRegex(WorkerCrashed, 'SIGKILL'):
+            self.pool.call(signal.raise_signal, signal.SIGKILL)
+        self.assertNotEqual(self.pool.call(os.getpid), pid)
+        self.assertEqual(self.pool.replaced, 1)
+
+    def test_forwards_worker_logs(self):
+        with patch.object(logger, 'handle') as mock_handle:
+            self.pool.call(logger.warning, 'Decoding %s', 'foo.jpg')
+        record = mock_handle.call_args.args[0]
+        self.assertEqual((record.levelname, record.getMessage()), ('WARNING', 'Decoding foo.jpg'))
+        self.assertEqual(record.processName, 'media-decoder')
+
+    def test_close_stops_workers(self):
+        self.pool.call(os.getpid)
+        worker = self.pool.idle[0]
+        self.pool.close()
+        self.assertFalse(worker.process.is_alive())
+        self.assertEqual(self.pool.idle, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
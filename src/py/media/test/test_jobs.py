@@ -0,0 +1,88 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Unit tests for the jobs module
+#
+
+'''
+Unit tests for the jobs module
+'''
+
+# System Imports
+import threading
+import unittest
+from pathlib import Path
+
+# Local imports
+from media.jobs import Job, JobQueue
+
+
+class TestJob(unittest.TestCase):
+    def test_rejects_invalid_priority(self):
+        self.assertRaises(ValueError, Job, [Path('/foo')], 'urgent')
+
+    def test_summarises_results(self):
+        job = Job([Path('/foo')], 'sync')
+        self.assertEqual(job.summary()['state'], 'queued')
+        job.start()
+        job.report(Path('/foo/a.jpg'), 'processed')
+        job.report(Path('/foo/b.jpg'), 'failed', 'corrupt')
+        job.report(Path('/foo/c.jpg'), 'processed')
+        job.finish()
+        summary = job.summary(results=True)
+        self.assertEqual(summary['state'], 'complete')
+        self.assertEqual(summary['counts'], {'processed': 2, 'failed': 1})
+        self.assertEqual(summary['results'][1], {'path': '/foo/b.jpg', 'status': 'failed', 'error': 'corrupt'})
+
+    def test_records_job_failure(self):
+        job = Job([Path('/foo')])
+        job.finish('database error')
+        self.assertEqual((job.state, job.error), ('failed', 'database error'))
+        self.assertTrue(job.is_done())
+
+    def test_wait_times_out(self):
+        job = Job([Path('/foo')])
+        self.assertFalse(job.wait(0.01))
+        job.finish()
+        self.assertTrue(job.wait(0.01))
+
+    def test_streams_results_until_finished(self):
+        job = Job([Path('/foo')])
+
+        def work():
+            for name in ['a.jpg', 'b.jpg', 'c.jpg']:
+                job.report(Path('/foo') / name, 'processed')
+            job.finish()
+
+        thread = threading.Thread(target=work)
+        thread.start()
+        self.assertEqual([r.path for r in job.stream(5)], ['/foo/a.jpg', '/foo/b.jpg', '/foo/c.jpg'])
+        thread.join()
+
+    def test_stream_stops_on_timeout(self):
+        job = Job([Path('/foo')])
+        job.report(Path('/foo/a.jpg'), 'processed')
+        self.assertEqual([r.path for r in job.stream(0.01)], ['/foo/a.jpg'])
+
+
+class TestJobQueue(unittest.TestCase):
+    def test_orders_by_priority_then_submission(self):
+        jobs = JobQueue()
+        backfill = jobs.submit([Path('/a')], 'backfill')
+        sync1 = jobs.submit([Path('/b')], 'sync')
+        interactive = jobs.submit([Path('/c')], 'interactive')
+        sync2 = jobs.submit([Path('/d')], 'sync')
+        self.assertEqual([jobs.get(0) for _ in range(4)], [interactive, sync1, sync2, backfill])
+        self.assertIsNone(jobs.get(0))
+
+    def test_can_find_jobs(self):
+        jobs = JobQueue(history=2)
+        first = jobs.submit([Path('/a')])
+        second = jobs.submit([Path('/b')])
+        self.assertIs(jobs.find(first.id), first)
+        third = jobs.submit([Path('/c')])
+        self.assertIsNone(jobs.find(first.id))
+        self.assertIs(jobs.find(second.id), second)
+        self.assertIs(jobs.find(third.id), third)
@@ -0,0 +1,72 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Unit tests for the lazy module
+#
+
+'''
+Unit tests for the lazy module
+'''
+
+# System Imports
+import sys
+import json
+import unittest
+import subprocess
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+# Local imports
+from media.lazy import LazyModule
+
+
+class TestLazyModule(unittest.TestCase):
+    def test_imports_on_first_use(self):
+        with patch('importlib.import_module') as mock_import:
+            mock_import.return_value.value = 42
+            module = LazyModule('foo')
+            mock_import.assert_not_called()
+            self.assertEqual(module.value, 42)
+            self.assertEqual(module.value, 42)
+            mock_import.assert_called_once_with('foo')
+
+    def test_calls_on_load_once(self):
+        on_load = MagicMock()
+        module = LazyModule('json', on_load=on_load)
+        self.assertIs(module.dumps, json.dumps)
+        self.assertIs(module.loads, json.loads)
+        on_load.assert_called_once_with(json)
+
+    def test_passes_through_set_and_delete(self):
+        module = LazyModule('json')
+        module.lazy_test_attr = 1
+        self.assertEqual(json.lazy_test_attr, 1)  # type: ignore
+        del module.lazy_test_attr
+        self.assertFalse(hasattr(json, 'lazy_test_attr'))
+
+    def test_can_be_patched(self):
+        module = LazyModule('json')
+        with patch.object(module, 'dumps', return_value='patched'):
+            self.assertEqual(json.dumps({}), 'patched')
+        self.assertEqual(module.dumps({}), '{}')
+
+    def test_missing_module_raises(self):
+        module = LazyModule('media_lazy_no_such_module')
+        self.assertRaises(ImportError, getattr, module, 'foo')
+
+    def test_missing_optional_module_is_false(self):
+        module = LazyModule('media_lazy_no_such_module', optional=True)
+        self.assertFalse(module)
+        self.assertRaises(ImportError, getattr, module, 'foo')
+
+    def test_installed_optional_module_is_true(self):
+        self.assertTrue(LazyModule('json', optional=True))
+
+
+class TestStartupImports(unittest.TestCase):
+    def test_processor_does_not_import_decoders(self):
+        code = 'import sys, media.media_processor; print(" ".join(m for m in ("av", "ffmpeg", "numpy", "PIL", "pillow_heif", "rawpy") if m in sys.modules))'
+        result = subprocess.run([sys.executable, '-c', code], cwd=Path(__file__).parents[2], capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), '')
@@ -0,0 +1,74 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Unit tests for the logger module
+#
+
+'''
+Unit tests for the logger module
+'''
+
+# System Imports
+import json
+import queue
+import logging
+import unittest
+
+# Local imports
+from media.logger import JsonFormatter, QueueHandler
+
+
+def make_record(msg, *args, exc_info=None):
+    return logging.LogRecord('media', logging.WARNING, __file__, 1, msg, args, exc_info)
+
+
+def raise_error():
+    try:
+        raise ValueError('Oops')
+    except ValueError as e:
+        return (type(e), e, e.__traceback__)
+
+
+class TestJsonFormatter(unittest.TestCase):
+    def test_formats_record(self):
+        data = json.loads(JsonFormatter().format(make_record('Unable to read %s: %s', '/foo/bar.jpg', 'EIO')))
+        self.assertEqual(data['level'], 'WARNING')
+        self.assertEqual(data['logger'], 'media')
+        self.assertEqual(data['message'], 'Unable to read /foo/bar.jpg: EIO')
+        self.assertRegex(data['time'], r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{3}$')
+        self.assertNotIn('exception', data)
+
+    def test_is_one_line(self):
+        self.assertNotIn('\n', JsonFormatter().format(make_record('two\nlines', exc_info=raise_error())))
+
+    def test_includes_exception(self):
+        data = json.loads(JsonFormatter().format(make_record('Failed', exc_info=raise_error())))
+        self.assertIn('ValueError: Oops', data['exception'])
+
+
+class TestQueueHandler(unittest.TestCase):
+    def setUp(self):
+        self.records = queue.SimpleQueue()
+        self.handler = QueueHandler(self.records)
+
+    def test_merges_args(self):
+        args = ['/foo/bar.jpg']
+        self.handler.handle(make_record('Unable to read %s', args))
+        args.append('changed')
+        record = self.records.get_nowait()
+        self.assertEqual(record.msg, "Unable to read ['/foo/bar.jpg']")
+        self.assertIsNone(record.args)
+
+    def test_keeps_exception_for_listener(self):
+        self.handler.handle(make_record('Failed', exc_info=raise_error()))
+        record = self.records.get_nowait()
+        self.assertIsNone(record.exc_info)
+        self.assertEqual(record.msg, 'Failed')
+        self.assertIn('ValueError: Oops', json.loads(JsonFormatter().format(record))['exception'])
+        self.assertIn('ValueError: Oops', logging.Formatter().format(record))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,14 +11,21 @@ Unit tests for the metadata module
 '''
 
 # System Imports
+import tempfile
 import unittest
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 # Local imports
-from media.media_processor import MediaProcessor
+from media.media_processor import MediaProcessor, regenerate_thumbnails, walk_files
 from media.logger import logger
 from media.model import FileMetadata
+from media.copier import CopiedFile
+from media.jobs import Job, JobQueue
+from media.admission import DecodeBudget
+from media.isolation import DecodeTimeout
+from media.geo import quadkey
 
 
 # Disable logging
@@ -40,6 +47,7 @@ class TestMediaProcessor(unittest.TestCase):
             make=None,
             model=None,
             sha256='1589a15e55fbebc6519c95d91d8f0a090618f20dc78e479858b9c27552484961',
+            fingerprint='8a2b54e36cdcc10d1ba2e4ab4c4b7a3f',
             thumbnail=b'xxxxxxx',
         )
 
@@ -52,12 +60,29 @@ class TestMediaProcessor(unittest.TestCase):
         self.load_metadata_patcher = patch('media.media_processor.load_file_metadata')
         self.mock_load_metadata = self.load_metadata_patcher.start()
         self.mock_load_metadata.return_value = self.file
+        self.fingerprint_patcher = patch('media.media_processor.calculate_fingerprint')
+        self.mock_fingerprint = self.fingerprint_patcher.start()
+        self.mock_fingerprint.return_value = self.file.fingerprint
+        self.mock_db.find_fingerprints.return_value = set()
+        self.mock_db.get_quarantined.return_value = {}
+        self.mock_db.get_media_dependents.return_value = []
 
     def tearDown(self):
         # Remove mocks
         self.db_patcher.stop()
         self.path_patcher.stop()
         self.load_metadata_patcher.stop()
+        self.fingerprint_patcher.stop()
+
+    def assertValid(self, p):
+        counts = {'processed': 1, 'failed': 0}
+        self.assertEqual(p.validate_batch([self.file], counts), [self.file])
+        self.assertEqual(counts, {'processed': 1, 'failed': 0})
+
+    def assertInvalid(self, p):
+        counts = {'processed': 1, 'failed': 0}
+        self.assertEqual(p.validate_batch([self.file], counts), [])
+        self.assertEqual(counts, {'processed': 0, 'failed': 1})
 
     def test_create_a_processor(self):
         p = MediaProcessor()
@@ -65,99 +90,105 @@ class TestMediaProcessor(unittest.TestCase):
 
     def test_can_validate_file(self):
         p = MediaProcessor()
-        try:
-            p.validate_file(self.file)
-        except Exception as e:
-            self.fail(e)
-
-    def test_validation_fails_if_no_file(self):
-        p = MediaProcessor()
-        self.mock_path.return_value.exists.return_value = False
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertValid(p)
 
     def test_validation_fails_if_bad_type(self):
         p = MediaProcessor()
         self.file.type = 'foo'
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertInvalid(p)
 
     def test_validation_fails_if_bad_timestamp(self):
         p = MediaProcessor()
         self.file.timestamp = 0
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertInvalid(p)
         self.file.timestamp = '1718338124'
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertInvalid(p)
 
     def test_validation_fails_if_bad_size(self):
         p = MediaProcessor()
         self.file.size = 0
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertInvalid(p)
         self.file.size = '1718338124'
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertInvalid(p)
 
     def test_validation_fails_if_bad_width(self):
         p = MediaProcessor()
         self.file.width = 0
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertInvalid(p)
         self.file.width = '1718338124'
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertInvalid(p)
 
     def test_validation_fails_if_bad_height(self):
         p = MediaProcessor()
         self.file.height = 0
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertInvalid(p)
         self.file.height = '1718338124'
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertInvalid(p)
 
     def test_validation_fails_if_missing_video_duration(self):
         p = MediaProcessor()
         self.file.type = 'video'
         self.file.duration = 0
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertInvalid(p)
         self.file.duration = '1234'
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertInvalid(p)
 
     def test_validation_fails_if_image_has_duration(self):
         p = MediaProcessor()
         self.file.duration = 1234
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertInvalid(p)
 
     def test_validation_fails_if_bad_latitude(self):
         p = MediaProcessor()
         self.file.latitude = '123'
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertInvalid(p)
 
     def test_validation_fails_if_bad_longitude(self):
         p = MediaProcessor()
         self.file.longitude = '123'
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertInvalid(p)
 
     def test_validation_fails_if_bad_make(self):
         p = MediaProcessor()
         self.file.make = 123
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertInvalid(p)
         self.file.make = ''
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertInvalid(p)
 
     def test_validation_fails_if_bad_model(self):
         p = MediaProcessor()
         self.file.model = 123
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertInvalid(p)
         self.file.model = ''
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertInvalid(p)
 
     def test_validation_fails_if_bad_sha256(self):
         p = MediaProcessor()
         self.file.sha256 = 1234
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertInvalid(p)
         self.file.sha256 = 'wfi73gw'
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertInvalid(p)
+
+    def test_validation_allows_missing_sha256_if_deferred(self):
+        p = MediaProcessor(defer_sha256=True)
+        self.file.sha256 = None
+        self.assertValid(p)
+        p = MediaProcessor()
+        self.assertInvalid(p)
+
+    def test_validation_fails_if_bad_fingerprint(self):
+        p = MediaProcessor()
+        self.file.fingerprint = None
+        self.assertInvalid(p)
+        self.file.fingerprint = 'abc'
+        self.assertInvalid(p)
 
     def test_validation_fails_if_bad_thumbnail(self):
         p = MediaProcessor()
         self.file.thumbnail = 1234
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertInvalid(p)
         self.file.thumbnail = b''
-        self.assertRaises(ValueError, p.validate_file, self.file)
+        self.assertInvalid(p)
 
     def test_can_get_file_list(self):
         p = MediaProcessor()
@@ -176,27 +207,561 @@ class TestMediaProcessor(unittest.TestCase):
 
     def test_can_run_processor(self):
         p = MediaProcessor()
-        p.get_file_list = lambda _: {Path('/foo/bar.jpg')}
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg')}
         p.run([Path('/foo/bar.jpg')])
         self.mock_db.bulk_insert_media.assert_called_with([self.file])
 
     @patch('json.dump')
     def test_doesnt_insert_media_on_dry_run(self, _):
         p = MediaProcessor(dry_run=True)
-        p.get_file_list = lambda _: {Path('/foo/bar.jpg')}
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg')}
         p.run([Path('/foo/bar.jpg')])
         self.mock_db.bulk_insert_media.assert_not_called()
 
+    def test_can_rebuild(self):
+        p = MediaProcessor()
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg')}
+        p.rebuild([Path('/foo/bar.jpg')], 2)
+        self.mock_db.strip_existing_paths.assert_not_called()
+        self.mock_db.bulk_insert_media.assert_not_called()
+        self.mock_db.create_staging_table.assert_called_once()
+        self.mock_db.copy_to_staging_table.assert_called_with([self.file], 2)
+        self.mock_db.copy_other_media_to_staging_table.assert_called_once_with([Path('/foo/bar.jpg')])
+        self.mock_db.index_staging_table.assert_called_once()
+        self.mock_db.swap_staging_table.assert_called_once()
+
+    def test_rebuild_refuses_when_media_table_has_dependents(self):
+        self.mock_db.get_media_dependents.return_value = ['media_view']
+        p = MediaProcessor()
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg')}
+        with self.assertRaisesRegex(RuntimeError, 'media_view'):
+            p.rebuild([Path('/foo/bar.jpg')])
+        self.mock_db.create_staging_table.assert_not_called()
+
+    def test_rebuild_drops_staging_table_on_failure(self):
+        self.mock_db.index_staging_table.side_effect = RuntimeError('Boom')
+        p = MediaProcessor()
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg')}
+        with self.assertRaises(RuntimeError):
+            p.rebuild([Path('/foo/bar.jpg')])
+        self.mock_db.swap_staging_table.assert_not_called()
+        self.mock_db.drop_staging_table.assert_called_once()
+
+    def test_doesnt_touch_database_on_dry_run_rebuild(self):
+        p = MediaProcessor(dry_run=True)
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg')}
+        p.rebuild([Path('/foo/bar.jpg')])
+        self.mock_db.create_staging_table.assert_not_called()
+        self.mock_db.copy_to_staging_table.assert_not_called()
+        self.mock_db.copy_other_media_to_staging_table.assert_not_called()
+        self.mock_db.swap_staging_table.assert_not_called()
+
     def test_skips_files_that_fail_processing(self):
         p = MediaProcessor()
-        p.get_file_list = lambda _: {Path('/foo/bar.jpg'), Path('/foo/baz.jpg')}
-        self.mock_load_metadata.side_effect = lambda f, _: self.file if f.name == 'bar.jpg' else None
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg'), Path('/foo/baz.jpg')}
+        self.mock_load_metadata.side_effect = lambda f, *_, **__: self.file if f.name == 'bar.jpg' else None
         p.run([Path('/foo')])
         self.mock_db.bulk_insert_media.assert_called_with([self.file])
 
     def test_skips_files_that_throw_exceptions(self):
         p = MediaProcessor()
-        p.get_file_list = lambda _: {Path('/foo/bar.jpg'), Path('/foo/baz.jpg')}
-        self.mock_load_metadata.side_effect = lambda f, _: self.file if f.name == 'bar.jpg' else ValueError('Failed')
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg'), Path('/foo/baz.jpg')}
+        self.mock_load_metadata.side_effect = lambda f, *_, **__: self.file if f.name == 'bar.jpg' else ValueError('Failed')
         p.run([Path('/foo')])
         self.mock_db.bulk_insert_media.assert_called_with([self.file])
+
+    @patch('media.media_processor.get_file_stats', lambda _: (1718338124, 1234))
+    @patch('media.util.get_file_stats', lambda _: (1718338124, 1234))
+    @patch('media.media_processor.hash_engine.sha256')
+    def test_dedup_clones_already_indexed_media(self, mock_sha256):
+        p = MediaProcessor(dedup=True)
+        p.get_file_list = lambda *_, **__: {Path('/foo/copy.jpg')}
+        mock_sha256.return_value = self.file.sha256
+        self.mock_db.find_fingerprints.return_value = {self.file.fingerprint}
+        self.mock_db.find_media_by_sha256.return_value = [self.file]
+        p.run([Path('/foo')])
+        self.mock_load_metadata.assert_not_called()
+        inserted = self.mock_db.bulk_insert_media.call_args.args[0]
+        self.assertEqual(len(inserted), 1)
+        self.assertEqual(inserted[0].path, '/foo/copy.jpg')
+        self.assertEqual(inserted[0].thumbnail, self.file.thumbnail)
+        self.assertEqual(inserted[0].width, self.file.width)
+
+    @patch('media.media_processor.get_file_stats', lambda _: (1718338124, 1234))
+    @patch('media.util.get_file_stats', lambda _: (1718338124, 1234))
+    @patch('media.media_processor.hash_engine.sha256')
+    def test_dedup_fingerprints_clones_of_legacy_media(self, mock_sha256):
+        p = MediaProcessor(dedup=True)
+        p.get_file_list = lambda *_, **__: {Path('/foo/copy.jpg')}
+        mock_sha256.return_value = self.file.sha256
+        self.mock_db.find_fingerprints.return_value = {self.file.fingerprint}
+        self.mock_db.find_media_by_sha256.return_value = [self.file.model_copy(update={'fingerprint': None})]
+        p.run([Path('/foo')])
+        inserted = self.mock_db.bulk_insert_media.call_args.args[0]
+        self.assertEqual([f.fingerprint for f in inserted], [self.file.fingerprint])
+        progress = self.mock_db.update_progress.call_args_list[-1]
+        self.assertEqual(progress.args[4], {'skipped': 0, 'failed': 0, 'deduplicated': 1})
+
+    @patch('media.media_processor.get_file_stats', lambda _: (1718338124, 1234))
+    @patch('media.util.get_file_stats', lambda _: (1718338124, 1234))
+    @patch('media.media_processor.hash_engine.sha256')
+    def test_dedup_doesnt_count_invalid_clones(self, mock_sha256):
+        p = MediaProcessor(dedup=True)
+        p.get_file_list = lambda *_, **__: {Path('/foo/copy.jpg')}
+        mock_sha256.return_value = self.file.sha256
+        self.mock_db.find_fingerprints.return_value = {self.file.fingerprint}
+        self.mock_db.find_media_by_sha256.return_value = [self.file.model_copy(update={'width': 0})]
+        p.run([Path('/foo')])
+        progress = self.mock_db.update_progress.call_args_list[-1]
+        self.assertEqual(progress.args[:4], ('processor', 'complete', 0, 1))
+        self.assertEqual(progress.args[4], {'skipped': 0, 'failed': 1, 'deduplicated': 0})
+
+    @patch('media.media_processor.get_file_stats')
+    @patch('media.util.get_file_stats', lambda _: (1718338124, 1234))
+    @patch('media.media_processor.hash_engine.sha256')
+    def test_dedup_fails_files_that_disappear(self, mock_sha256, mock_stats):
+        def stats(path):
+            if path == Path('/foo/gone.jpg'):
+                raise FileNotFoundError('No such file')
+            return 1718338124, 1234
+
+        mock_stats.side_effect = stats
+        report = MagicMock()
+        p = MediaProcessor(dedup=True)
+        p.get_file_list = lambda *_, **__: {Path('/foo/copy.jpg'), Path('/foo/gone.jpg')}
+        mock_sha256.return_value = self.file.sha256
+        self.mock_db.find_fingerprints.return_value = {self.file.fingerprint}
+        self.mock_db.find_media_by_sha256.return_value = [self.file]
+        p.run([Path('/foo')], report=report)
+        self.mock_load_metadata.assert_not_called()
+        inserted = self.mock_db.bulk_insert_media.call_args.args[0]
+        self.assertEqual([f.path for f in inserted], ['/foo/copy.jpg'])
+        report.assert_any_call(Path('/foo/gone.jpg'), 'failed', 'No such file')
+        progress = self.mock_db.update_progress.call_args_list[-1]
+        self.assertEqual(progress.args[4], {'skipped': 0, 'failed': 1, 'deduplicated': 1})
+
+    @patch('media.media_processor.get_file_stats', lambda _: (1718338124, 4321))
+    @patch('media.media_processor.hash_engine.sha256')
+    def test_dedup_ignores_matches_with_different_size(self, mock_sha256):
+        p = MediaProcessor(dedup=True)
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg')}
+        mock_sha256.return_value = self.file.sha256
+        self.mock_db.find_fingerprints.return_value = {self.file.fingerprint}
+        self.mock_db.find_media_by_sha256.return_value = [self.file]
+        p.run([Path('/foo')])
+        self.mock_load_metadata.assert_called_once_with(Path('/foo/bar.jpg'), False, sha256=self.file.sha256, fingerprint=self.file.fingerprint, defer_sha256=False, reduce=False)
+
+    @patch('media.media_processor.hash_engine.sha256')
+    def test_dedup_skips_checksum_of_unique_fingerprints(self, mock_sha256):
+        p = MediaProcessor(dedup=True)
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg')}
+        p.run([Path('/foo')])
+        mock_sha256.assert_not_called()
+        self.mock_db.find_media_by_sha256.assert_not_called()
+        self.mock_load_metadata.assert_called_once_with(Path('/foo/bar.jpg'), False, sha256=None, fingerprint=self.file.fingerprint, defer_sha256=False, reduce=False)
+
+    @patch('media.media_processor.get_file_stats', lambda _: (1718338124, 1234))
+    @patch('media.util.get_file_stats', lambda _: (1718338124, 1234))
+    @patch('media.media_processor.hash_engine.sha256')
+    def test_dedup_decodes_duplicates_in_batch_once(self, mock_sha256):
+        p = MediaProcessor(dedup=True)
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg'), Path('/foo/baz.jpg')}
+        mock_sha256.return_value = self.file.sha256
+        self.mock_db.find_media_by_sha256.return_value = []
+        p.run([Path('/foo')])
+        self.mock_load_metadata.assert_called_once()
+        inserted = self.mock_db.bulk_insert_media.call_args.args[0]
+        self.assertEqual(sorted(f.path for f in inserted), ['/foo/bar.jpg', '/foo/baz.jpg'])
+
+    @patch('media.media_processor.get_file_stats', lambda _: (1718338124, 1234))
+    @patch('media.media_processor.hash_engine.sha256')
+    def test_uses_checksums_from_copies(self, mock_sha256):
+        p = MediaProcessor(dedup=True)
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg')}
+        self.mock_db.find_fingerprints.return_value = {self.file.fingerprint}
+        self.mock_db.find_media_by_sha256.return_value = []
+        copied = CopiedFile(path='/foo/bar.jpg', size=1234, mtime_ns=1718338124000000000, method='userspace', sha256=self.file.sha256)
+        with patch.object(CopiedFile, 'is_current', return_value=True):
+            p.run([Path('/foo')], {Path('/foo/bar.jpg'): copied})
+        mock_sha256.assert_not_called()
+        self.mock_db.find_media_by_sha256.assert_called_once_with({self.file.sha256})
+        self.mock_load_metadata.assert_called_once_with(Path('/foo/bar.jpg'), False, sha256=self.file.sha256, fingerprint=self.file.fingerprint, defer_sha256=False, reduce=False)
+
+    def test_ignores_checksums_from_modified_copies(self):
+        p = MediaProcessor()
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg')}
+        copied = CopiedFile(path='/foo/bar.jpg', size=1234, mtime_ns=1718338124000000000, method='userspace', sha256=self.file.sha256)
+        with patch.object(CopiedFile, 'is_current', return_value=False):
+            p.run([Path('/foo')], {Path('/foo/bar.jpg'): copied})
+        self.mock_load_metadata.assert_called_once_with(Path('/foo/bar.jpg'), False, sha256=None, fingerprint=self.file.fingerprint, defer_sha256=False, reduce=False)
+
+    def test_run_validates_batch(self):
+        p = MediaProcessor()
+        invalid = self.file.model_copy(update={'path': '/foo/baz.jpg', 'width': 0})
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg'), Path('/foo/baz.jpg')}
+        self.mock_load_metadata.side_effect = lambda f, *_, **__: self.file if f.name == 'bar.jpg' else invalid
+        p.run([Path('/foo')])
+        self.mock_db.bulk_insert_media.assert_called_with([self.file])
+        self.mock_path.return_value.exists.assert_not_called()
+        progress = self.mock_db.update_progress.call_args_list[-1]
+        self.assertEqual(progress.args[:4], ('processor', 'complete', 1, 2))
+        self.assertEqual(progress.args[4]['failed'], 1)
+
+    def test_run_reports_file_results(self):
+        self.path_patcher.stop()
+        p = MediaProcessor()
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg'), Path('/foo/baz.jpg'), Path('/foo/qux.txt')}
+
+        def load(path, *_, **__):
+            if path.name == 'baz.jpg':
+                raise ValueError('corrupt')
+            return self.file if path.name == 'bar.jpg' else None
+
+        self.mock_load_metadata.side_effect = load
+        report = MagicMock()
+        p.run([Path('/foo')], report=report)
+        self.assertCountEqual(report.call_args_list, [
+            ((Path('/foo/bar.jpg'), 'processed', None),),
+            ((Path('/foo/baz.jpg'), 'failed', 'corrupt'),),
+            ((Path('/foo/qux.txt'), 'skipped', None),),
+        ])
+
+    @patch('media.media_processor.estimate_decode_size')
+    def test_admits_decodes_through_budget(self, mock_estimate):
+        budget = DecodeBudget(100)
+        p = MediaProcessor(budget=budget)
+        mock_estimate.return_value = 50
+        p.load_file(Path('/foo/bar.jpg'))
+        self.assertFalse(self.mock_load_metadata.call_args.kwargs['reduce'])
+        mock_estimate.return_value = 500
+        p.load_file(Path('/foo/bar.jpg'))
+        self.assertTrue(self.mock_load_metadata.call_args.kwargs['reduce'])
+        self.assertEqual(budget.used, 0)
+
+    def test_decodes_in_isolated_workers(self):
+        isolation = MagicMock()
+        isolation.call.return_value = self.file
+        p = MediaProcessor(isolation=isolation)
+        self.assertEqual(p.load_file(Path('/foo/bar.jpg')), self.file)
+        isolation.call.assert_called_once_with(self.mock_load_metadata, Path('/foo/bar.jpg'), False, sha256=None, fingerprint=None, defer_sha256=False, reduce=False)
+        self.mock_load_metadata.assert_not_called()
+
+    @patch('media.media_processor.get_file_stats', lambda _: (1718338124, 1234))
+    def test_quarantines_files_that_hang_workers(self):
+        self.path_patcher.stop()
+
+        def call(func, path, *_, **__):
+            if path.name == 'baz.jpg':
+                raise DecodeTimeout('Timed out after 300 seconds')
+            return self.file
+
+        isolation = MagicMock()
+        isolation.call.side_effect = call
+        p = MediaProcessor(isolation=isolation)
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg'), Path('/foo/baz.jpg')}
+        report = MagicMock()
+        p.run([Path('/foo')], report=report)
+        self.mock_db.quarantine_file.assert_called_once_with(Path('/foo/baz.jpg'), 1234, 'Timed out after 300 seconds')
+        report.assert_any_call(Path('/foo/baz.jpg'), 'failed', 'Timed out after 300 seconds')
+        self.mock_db.bulk_insert_media.assert_called_with([self.file])
+
+    def test_doesnt_quarantine_ordinary_failures(self):
+        self.mock_load_metadata.side_effect = ValueError('corrupt')
+        p = MediaProcessor()
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg')}
+        p.run([Path('/foo')])
+        self.mock_db.quarantine_file.assert_not_called()
+
+    @patch('media.media_processor.get_file_stats')
+    def test_get_file_list_skips_quarantined_files(self, mock_stats):
+        self.path_patcher.stop()
+        p = MediaProcessor()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            bad, changed, new = Path(tmpdir) / 'bad.jpg', Path(tmpdir) / 'changed.jpg', Path(tmpdir) / 'new.jpg'
+            for path in (bad, changed, new):
+                path.touch()
+            self.mock_db.strip_existing_paths.side_effect = lambda paths: paths
+            self.mock_db.get_quarantined.return_value = {bad: (1234, 'Timed out'), changed: (1234, 'Timed out')}
+            mock_stats.side_effect = lambda path: (0, 1234 if path == bad else 5678)
+            report = MagicMock()
+            self.assertEqual(p.get_file_list([Path(tmpdir)], report=report), {changed, new})
+            report.assert_called_once_with(bad, 'skipped', 'Quarantined: Timed out')
+
+    @patch('media.media_processor.get_file_stats', lambda p: (int(p.stem), 1234))
+    def test_run_jobs_processes_newest_first(self):
+        self.path_patcher.stop()
+        p = MediaProcessor(ncpu=1)
+        p.get_file_list = lambda paths, **_: set(paths)
+        self.mock_load_metadata.side_effect = lambda f, *_, **__: self.file.model_copy(update={'path': str(f)})
+        jobs = JobQueue()
+        job = Job([Path('/foo/1.jpg'), Path('/foo/3.jpg'), Path('/foo/2.jpg')], 'backfill')
+        p.run_jobs(job, jobs, chunk_size=1)
+        inserted = [c.args[0][0].path for c in self.mock_db.bulk_insert_media.call_args_list]
+        self.assertEqual(inserted, ['/foo/3.jpg', '/foo/2.jpg', '/foo/1.jpg'])
+        self.assertEqual(job.summary()['state'], 'complete')
+        self.assertEqual(job.summary()['counts'], {'processed': 3})
+
+    @patch('media.media_processor.get_file_stats', lambda p: (int(p.stem), 1234))
+    def test_run_jobs_preempts_backfill(self):
+        self.path_patcher.stop()
+        p = MediaProcessor(ncpu=1)
+        p.get_file_list = lambda paths, **_: set(paths)
+        self.mock_load_metadata.side_effect = lambda f, *_, **__: self.file.model_copy(update={'path': str(f)})
+        jobs = JobQueue()
+        backfill = Job([Path(f'/foo/{i}.jpg') for i in range(1, 5)], 'backfill')
+
+        def insert(files):
+            # A new file is submitted while the first backfill file is inserted
+            if files[0].path == '/foo/4.jpg':
+                jobs.submit([Path('/foo/0.jpg')], 'interactive')
+
+        self.mock_db.bulk_insert_media.side_effect = insert
+        p.run_jobs(backfill, jobs, chunk_size=1)
+        inserted = [c.args[0][0].path for c in self.mock_db.bulk_insert_media.call_args_list]
+        self.assertEqual(inserted, ['/foo/4.jpg', '/foo/0.jpg', '/foo/3.jpg', '/foo/2.jpg', '/foo/1.jpg'])
+
+    @patch('media.media_processor.get_file_stats', lambda _: (1718338124, 1234))
+    def test_run_jobs_uses_controller(self):
+        controller = MagicMock()
+        controller.get.return_value = 3
+        p = MediaProcessor(controller=controller)
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg')}
+        p.run_jobs(Job([Path('/foo')]), JobQueue())
+        self.assertEqual({c.args[0] for c in controller.get.call_args_list}, {'io', 'decode'})
+        controller.record.assert_called_once()
+        self.assertEqual(controller.record.call_args.args[0], 1)
+
+    @patch('media.media_processor.get_file_stats', lambda _: (1718338124, 1234))
+    def test_run_jobs_reports_insert_failure(self):
+        p = MediaProcessor()
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg')}
+        self.mock_db.bulk_insert_media.side_effect = RuntimeError('Boom')
+        job = Job([Path('/foo')])
+        p.run_jobs(job, JobQueue())
+        self.assertEqual(job.summary(results=True)['results'], [{'path': '/foo/bar.jpg', 'status': 'failed', 'error': 'Boom'}])
+        self.assertEqual(job.state, 'complete')
+
+    def test_run_jobs_fails_job_that_cant_be_scheduled(self):
+        p = MediaProcessor()
+        self.mock_db.strip_existing_paths.side_effect = RuntimeError('Boom')
+        job = Job([Path('/foo')])
+        p.run_jobs(job, JobQueue())
+        self.assertEqual((job.state, job.error), ('failed', 'Boom'))
+
+    def test_get_file_list_reports_existing_files(self):
+        self.path_patcher.stop()
+        p = MediaProcessor()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            new, old = Path(tmpdir) / 'new.jpg', Path(tmpdir) / 'old.jpg'
+            new.touch()
+            old.touch()
+            self.mock_db.strip_existing_paths.return_value = {new}
+            report = MagicMock()
+            self.assertEqual(p.get_file_list([Path(tmpdir)], report=report), {new})
+            report.assert_called_once_with(old, 'existing', None)
+
+    def test_walk_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            (Path(tmpdir) / 'sub').mkdir()
+            (Path(tmpdir) / 'bar.jpg').touch()
+            (Path(tmpdir) / 'sub' / 'baz.jpg').touch()
+            self.assertEqual(walk_files(Path(tmpdir)), {f'{tmpdir}/bar.jpg', f'{tmpdir}/sub/baz.jpg'})
+
+    @patch('media.media_processor.hash_engine.hash_files')
+    def test_reconcile_moves_and_deletes(self, mock_hash_files):
+        self.path_patcher.stop()
+        p = MediaProcessor()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            kept, moved, other = Path(tmpdir) / 'kept.jpg', Path(tmpdir) / 'new' / 'moved.jpg', Path(tmpdir) / 'other.jpg'
+            moved.parent.mkdir()
+            kept.write_bytes(b'kept')
+            moved.write_bytes(b'moved')
+            other.write_bytes(b'other file')
+            self.mock_db.get_media_paths.return_value = {str(kept): 1, f'{tmpdir}/old/moved.jpg': 2, f'{tmpdir}/deleted.jpg': 3}
+            self.mock_db.get_media_hashes.return_value = [(2, 5, 'abc', self.file.fingerprint), (3, 9, None, None)]
+            mock_hash_files.return_value = {moved: 'abc'}
+            p.reconcile([Path(tmpdir)])
+            self.mock_db.get_media_hashes.assert_called_once()
+            self.assertCountEqual(self.mock_db.get_media_hashes.call_args.args[0], [2, 3])
+            self.mock_fingerprint.assert_called_once_with(moved)
+            self.assertEqual(list(mock_hash_files.call_args.args[0]), [moved])
+            self.mock_db.move_media.assert_called_once_with([(2, moved)])
+            self.mock_db.delete_media.assert_called_once_with([3])
+
+    @patch('media.media_processor.hash_engine.hash_files')
+    def test_reconcile_requires_matching_contents(self, mock_hash_files):
+        self.path_patcher.stop()
+        p = MediaProcessor()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in ('a.jpg', 'b.jpg', 'c.jpg'):
+                (Path(tmpdir) / name).write_bytes(b'12345')
+            self.mock_db.get_media_paths.return_value = {'/old/1.jpg': 1, '/old/2.jpg': 2, '/old/3.jpg': 3}
+            self.mock_db.get_media_hashes.return_value = [
+                (1, 5, 'abc', 'other'),            # Different fingerprint
+                (2, 5, 'def', None),               # Different checksum
+                (3, 5, None, self.file.fingerprint),  # Checksum deferred, so the fingerprint is enough
+            ]
+            mock_hash_files.return_value = {Path(tmpdir) / n: 'abc' for n in ('a.jpg', 'b.jpg', 'c.jpg')}
+            p.reconcile([Path(tmpdir)])
+            self.mock_db.move_media.assert_called_once_with([(3, Path(tmpdir) / 'a.jpg')])
+            self.assertCountEqual(self.mock_db.delete_media.call_args.args[0], [1, 2])
+
+    def test_reconcile_dry_run(self):
+        self.path_patcher.stop()
+        p = MediaProcessor(dry_run=True)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.mock_db.get_media_paths.return_value = {'/old/1.jpg': 1}
+            self.mock_db.get_media_hashes.return_value = [(1, 5, 'abc', None)]
+            p.reconcile([Path(tmpdir)])
+            self.mock_db.move_media.assert_not_called()
+            self.mock_db.delete_media.assert_not_called()
+            self.mock_db.update_progress.assert_called_with('reconcile', 'complete', 1, 1, {'moved': 0, 'deleted': 1})
+
+    def test_reconcile_refuses_missing_directory(self):
+        self.path_patcher.stop()
+        p = MediaProcessor()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.assertRaises(ValueError, p.reconcile, [Path(tmpdir) / 'unmounted'])
+        self.mock_db.delete_media.assert_not_called()
+
+    def test_can_backfill_quadkeys(self):
+        p = MediaProcessor()
+        self.mock_db.get_unkeyed_locations.side_effect = [[(1, -33.86, 151.21), (2, 47.61, -122.107)], [(5, float('nan'), 0.0)], []]
+        p.backfill_quadkeys(batch_size=2)
+        self.assertEqual(self.mock_db.update_quadkeys.call_args_list[0].args[0], [(1, quadkey(-33.86, 151.21)), (2, quadkey(47.61, -122.107))])
+        self.assertEqual(self.mock_db.update_quadkeys.call_args_list[1].args[0], [])
+        self.mock_db.get_unkeyed_locations.assert_called_with(5, 2)
+        self.mock_db.update_progress.assert_called_with('quadkeys', 'complete', 2)
+
+    def test_backfill_quadkeys_dry_run(self):
+        p = MediaProcessor(dry_run=True)
+        self.mock_db.get_unkeyed_locations.side_effect = [[(1, -33.86, 151.21)], []]
+        p.backfill_quadkeys()
+        self.mock_db.update_quadkeys.assert_not_called()
+
+    def test_recompute_summaries(self):
+        p = MediaProcessor()
+        p.recompute_summaries()
+        self.mock_db.recompute_summaries.assert_called_once()
+        self.mock_db.lock.assert_called_once()
+        self.mock_db.recompute_summaries.reset_mock()
+        MediaProcessor(dry_run=True).recompute_summaries()
+        self.mock_db.recompute_summaries.assert_not_called()
+
+    @patch('media.media_processor.hash_engine.sha256')
+    def test_can_backfill_hashes(self, mock_sha256):
+        self.path_patcher.stop()
+        p = MediaProcessor()
+        mock_sha256.return_value = self.file.sha256
+        self.mock_db.get_unhashed_media.side_effect = [[(1, '/foo/bar.jpg', None, None), (2, '/foo/baz.jpg', 'abc', None)], []]
+        p.backfill_hashes()
+        mock_sha256.assert_called_once_with(Path('/foo/bar.jpg'), True)
+        self.mock_db.update_hashes.assert_called_once_with([(1, self.file.sha256, self.file.fingerprint), (2, 'abc', self.file.fingerprint)])
+        self.mock_db.get_unhashed_media.assert_called_with(2, 100)
+
+    @patch('media.media_processor.hash_engine.sha256')
+    def test_backfill_skips_unreadable_files(self, mock_sha256):
+        self.path_patcher.stop()
+        p = MediaProcessor()
+        mock_sha256.side_effect = FileNotFoundError('missing')
+        self.mock_db.get_unhashed_media.side_effect = [[(1, '/foo/bar.jpg', None, 'def')], []]
+        p.backfill_hashes()
+        self.mock_db.update_hashes.assert_called_once_with([])
+
+    @patch('media.media_processor.load_thumbnails')
+    def test_can_regenerate_a_thumbnail(self, mock_load_thumbnails):
+        id, file = regenerate_thumbnails((1, '/foo/bar.jpg', 'image'))
+        self.assertEqual(id, 1)
+        self.assertEqual((file.path, file.type), ('/foo/bar.jpg', 'image'))
+        mock_load_thumbnails.side_effect = ValueError('corrupt')
+        self.assertEqual(regenerate_thumbnails((2, '/foo/bar.jpg', 'image')), (2, None))
+
+    @patch('media.media_processor.concurrent.futures.ProcessPoolExecutor', lambda max_workers, mp_context: ThreadPoolExecutor(max_workers))
+    @patch('media.media_processor.regenerate_thumbnails')
+    def test_can_regenerate_thumbnails_in_batches(self, mock_regenerate):
+        mock_regenerate.side_effect = lambda row: (row[0], None if row[0] == 2 else self.file)
+        self.mock_db.get_progress.return_value = None
+        self.mock_db.stream_media.return_value = iter([(1, '/foo/1.jpg', 'image'), (2, '/foo/2.jpg', 'image'), (3, '/foo/3.mp4', 'video')])
+        p = MediaProcessor()
+        p.regenerate_thumbnails(batch_size=2)
+        self.mock_db.stream_media.assert_called_with(0)
+        self.mock_db.update_thumbnails.assert_any_call([(1, self.file)])
+        self.mock_db.update_thumbnails.assert_called_with([(3, self.file)])
+        self.mock_db.update_progress.assert_called_with('thumbnails', 'complete', 2, 0, {'failed': 1, 'last_id': 3})
+
+    @patch('media.media_processor.concurrent.futures.ProcessPoolExecutor', lambda max_workers, mp_context: ThreadPoolExecutor(max_workers))
+    @patch('media.media_processor.regenerate_thumbnails')
+    def test_doesnt_write_thumbnails_or_progress_on_dry_run(self, mock_regenerate):
+        mock_regenerate.side_effect = lambda row: (row[0], self.file)
+        self.mock_db.get_progress.return_value = None
+        self.mock_db.stream_media.return_value = iter([(1, '/foo/1.jpg', 'image'), (2, '/foo/2.jpg', 'image')])
+        p = MediaProcessor(dry_run=True)
+        p.regenerate_thumbnails(batch_size=1)
+        self.assertEqual(mock_regenerate.call_count, 2)
+        self.mock_db.update_thumbnails.assert_not_called()
+        self.mock_db.update_progress.assert_not_called()
+
+    def test_regenerates_thumbnails_in_isolated_workers(self):
+        def call(func, row):
+            if row[0] == 2:
+                raise DecodeTimeout('Timed out')
+            return row[0], self.file
+
+        isolation = MagicMock()
+        isolation.call.side_effect = call
+        self.mock_db.get_progress.return_value = None
+        self.mock_db.stream_media.return_value = iter([(1, '/foo/1.jpg', 'image'), (2, '/foo/2.jpg', 'image')])
+        p = MediaProcessor(isolation=isolation)
+        p.regenerate_thumbnails()
+        self.assertEqual(isolation.call.call_args_list[0].args[0], regenerate_thumbnails)
+        self.mock_db.update_thumbnails.assert_called_once_with([(1, self.file)])
+        self.mock_db.update_progress.assert_called_with('thumbnails', 'complete', 1, 0, {'failed': 1, 'last_id': 2})
+
+    @patch('media.media_processor.concurrent.futures.ProcessPoolExecutor', lambda max_workers, mp_context: ThreadPoolExecutor(max_workers))
+    def test_regenerate_thumbnails_resumes(self):
+        self.mock_db.stream_media.return_value = iter([])
+        p = MediaProcessor()
+        self.mock_db.get_progress.return_value = {'state': 'regenerating', 'last_id': 42}
+        p.regenerate_thumbnails()
+        self.mock_db.stream_media.assert_called_with(42)
+        self.mock_db.get_progress.return_value = {'state': 'complete', 'last_id': 42}
+        p.regenerate_thumbnails()
+        self.mock_db.stream_media.assert_called_with(0)
+
+    def test_loads_files_from_cache(self):
+        cache = MagicMock()
+        cache.get.return_value = self.file
+        p = MediaProcessor(cache=cache)
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg')}
+        p.run([Path('/foo')])
+        self.mock_load_metadata.assert_not_called()
+        cache.put.assert_not_called()
+        self.mock_db.bulk_insert_media.assert_called_with([self.file])
+
+    def test_fills_cache_on_miss(self):
+        cache = MagicMock()
+        cache.get.return_value = None
+        p = MediaProcessor(cache=cache)
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg')}
+        p.run([Path('/foo')])
+        self.mock_load_metadata.assert_called_once()
+        cache.put.assert_called_once_with(self.file, False)
+
+    @patch('media.media_processor.write_sha256_xattr')
+    @patch('media.media_processor.read_sha256_xattr')
+    def test_uses_sha256_from_xattr(self, mock_read_xattr, mock_write_xattr):
+        mock_read_xattr.return_value = self.file.sha256
+        p = MediaProcessor(use_xattr=True)
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg')}
+        p.run([Path('/foo')])
+        self.mock_load_metadata.assert_called_once_with(Path('/foo/bar.jpg'), False, sha256=self.file.sha256, fingerprint=self.file.fingerprint, defer_sha256=False, reduce=False)
+        mock_write_xattr.assert_not_called()
+
+    @patch('media.media_processor.write_sha256_xattr')
+    @patch('media.media_processor.read_sha256_xattr')
+    def test_stores_sha256_in_xattr(self, mock_read_xattr, mock_write_xattr):
+        mock_read_xattr.return_value = None
+        p = MediaProcessor(use_xattr=True)
+        p.get_file_list = lambda *_, **__: {Path('/foo/bar.jpg')}
+        p.run([Path('/foo')])
+        mock_write_xattr.assert_called_once_with(Path('/foo/bar.jpg'), self.file.sha256)
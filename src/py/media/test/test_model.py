@@ -0,0 +1,82 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Unit tests for the model module
+#
+
+'''
+Unit tests for the model module
+'''
+
+# System Imports
+import unittest
+
+# Local imports
+from media.model import FileMetadata, MediaBatch, FILE_FIELDS
+
+
+class TestMediaBatch(unittest.TestCase):
+    def setUp(self):
+        self.image = FileMetadata(path='/foo/bar.jpg', type='image', timestamp=1718338124, size=1234, width=1920, height=1080, sha256='a' * 64, fingerprint='b' * 32, thumbnail=b'xxx')
+        self.video = FileMetadata(path='/foo/bar.mp4', type='video', timestamp=1718338125, size=4321, width=1280, height=720, duration=5000, latitude=-27.5, longitude=153, sha256='c' * 64, fingerprint='d' * 32, thumbnail=b'yyy')
+
+    def test_fields_match_model(self):
+        self.assertEqual(FILE_FIELDS, tuple(FileMetadata.__annotations__.keys()))
+
+    def test_rows_match_model_dump(self):
+        batch = MediaBatch([self.image, self.video])
+        self.assertEqual(len(batch), 2)
+        self.assertEqual(list(batch.rows()), [tuple(self.image.model_dump().values()), tuple(self.video.model_dump().values())])
+
+    def test_records(self):
+        records = MediaBatch([self.image]).records(exclude=frozenset({'thumbnail', 'thumbnails', 'storyboard'}))
+        self.assertEqual(records, [self.image.model_dump(exclude={'thumbnail', 'thumbnails', 'storyboard'})])
+
+    def test_select(self):
+        batch = MediaBatch([self.image, self.video]).select([1])
+        self.assertEqual(batch.to_metadata(), [self.video])
+
+    def test_valid_batch(self):
+        self.assertEqual(MediaBatch([self.image, self.video]).validate(), {})
+
+    def test_empty_batch(self):
+        self.assertEqual(MediaBatch().validate(), {})
+
+    def test_reports_first_error_of_each_file(self):
+        self.image.size = 0
+        self.image.width = 0
+        self.video.duration = None
+        errors = MediaBatch([self.image, self.video]).validate()
+        self.assertEqual(errors, {0: 'Validation failed: invalid size of 0', 1: 'Validation failed: Invalid video duration of None'})
+
+    def test_image_with_duration(self):
+        self.image.duration = 10
+        self.assertEqual(MediaBatch([self.image]).validate(), {0: 'Validation failed: Duration must not be set for images: 10'})
+
+    def test_sha256_can_be_optional(self):
+        self.image.sha256 = None
+        self.assertIn(0, MediaBatch([self.image]).validate())
+        self.assertEqual(MediaBatch([self.image]).validate(require_sha256=False), {})
+
+    def test_sha256_is_checked_after_model_and_before_fingerprint(self):
+        self.image.model = ''
+        self.image.sha256 = None
+        self.image.fingerprint = None
+        self.assertEqual(MediaBatch([self.image]).validate(), {0: 'Validation failed: Invalid model of '})
+        self.image.model = None
+        self.assertEqual(MediaBatch([self.image]).validate(), {0: 'Validation failed: Invalid sha256 of None'})
+        self.assertEqual(MediaBatch([self.image]).validate(require_sha256=False), {0: 'Validation failed: Invalid fingerprint of None'})
+
+    def test_thumbnail_pyramid_must_match_sizes(self):
+        self.image.thumbnail_sizes = [128, 256]
+        self.image.thumbnails = [b'xx']
+        self.assertEqual(MediaBatch([self.image]).validate(), {0: 'Validation failed: 1 thumbnails for sizes [128, 256]'})
+
+    def test_objects_without_fields_are_invalid(self):
+        self.assertEqual(MediaBatch([object()]).validate(), {0: 'Validation failed: Invalid type of None'})
+
+
+if __name__ == '__main__':
+    unittest.main()
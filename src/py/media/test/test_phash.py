@@ -0,0 +1,74 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Unit tests for the phash module
+#
+
+'''
+Unit tests for the phash module
+'''
+
+# System Imports
+import unittest
+
+# 3rd Party Imports
+import numpy as np
+
+# Local imports
+from media.phash import PhashIndex, MAX_DISTANCE, hamming_distance
+
+
+class TestHammingDistance(unittest.TestCase):
+    def test_can_calculate_distance(self):
+        self.assertEqual(hamming_distance(np.array([0, -1, 5]), 0).tolist(), [0, 64, 2])
+
+    def test_can_broadcast(self):
+        dist = hamming_distance(np.array([0, 1])[:, None], np.array([0, 1, 3])[None, :])
+        self.assertEqual(dist.tolist(), [[0, 1, 2], [1, 0, 1]])
+
+
+class TestPhashIndex(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(1234)
+        self.hashes = rng.integers(-2**63, 2**63 - 1, 1000, dtype=np.int64)
+        # Near duplicates of item 10
+        self.hashes[20] = self.hashes[10] ^ (1 << 3) ^ (1 << 60)
+        self.hashes[30] = self.hashes[10] ^ 0b1111
+        # Near duplicate of item 20, but not item 10
+        self.hashes[40] = self.hashes[20] ^ (0b111 << 20)
+        # Exact duplicates
+        self.hashes[50] = self.hashes[60]
+        self.ids = list(range(100, 1100))
+
+    def test_can_query(self):
+        index = PhashIndex(self.ids, self.hashes)
+        self.assertEqual(len(index), 1000)
+        self.assertEqual(index.query(int(self.hashes[10])), [(110, 0), (120, 2), (130, 4)])
+        self.assertEqual(index.query(int(self.hashes[10]), 2), [(110, 0), (120, 2)])
+
+    def test_query_finds_nothing_for_unknown_hash(self):
+        index = PhashIndex(self.ids, self.hashes)
+        self.assertEqual(index.query(int(self.hashes[10] ^ 0xffff)), [])
+
+    def test_can_find_clusters(self):
+        index = PhashIndex(self.ids, self.hashes)
+        self.assertEqual(index.clusters(), [[110, 120, 130, 140], [150, 160]])
+
+    def test_clusters_respect_distance(self):
+        index = PhashIndex(self.ids, self.hashes)
+        self.assertEqual(index.clusters(2), [[110, 120], [150, 160]])
+
+    def test_rejects_distances_that_make_chunks_too_narrow(self):
+        self.assertRaises(ValueError, PhashIndex, self.ids, self.hashes, MAX_DISTANCE + 1)
+        self.assertRaises(ValueError, PhashIndex, self.ids, self.hashes, -1)
+        self.assertTrue(all(width >= 12 for _, width in PhashIndex(self.ids, self.hashes, MAX_DISTANCE).chunks))
+
+    def test_can_find_pairs_in_large_buckets(self):
+        hashes = np.zeros(50, dtype=np.int64)
+        hashes[1::2] = 1
+        index = PhashIndex(range(50), hashes, max_distance=1)
+        pairs = {tuple(sorted(p)) for p in index.pairs(tile=8)}
+        self.assertEqual(len(pairs), 50 * 49 // 2)
+        self.assertEqual(index.clusters(0), [list(range(0, 50, 2)), list(range(1, 50, 2))])
@@ -0,0 +1,263 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Unit tests for the raw module
+#
+
+# System Imports
+import io
+import os
+import struct
+import tempfile
+import unittest
+from typing import List, Tuple
+
+# 3rd Party Imports
+from PIL import Image
+
+# Local Imports
+from media.raw import is_raw, jpeg_info, read_raw, TiffReader
+
+
+def make_jpeg(width: int, height: int, progressive: bool = False, exif: bytes = None) -> bytes:
+    '''
+    Encode a small solid JPEG
+    '''
+    buf = io.BytesIO()
+    kwargs = {'exif': exif} if exif else {}
+    Image.new('RGB', (width, height), (200, 50, 50)).save(buf, 'JPEG', progressive=progressive, **kwargs)
+    return buf.getvalue()
+
+
+def make_ifd(offset: int, entries: List[Tuple[int, int, int, bytes]], next_ifd: int = 0) -> bytes:
+    '''
+    Build a little endian IFD at an offset, with values that don't fit in the
+    entry stored directly after it
+    '''
+    entries = sorted(entries)
+    data = struct.pack('<H', len(entries))
+    extra = b''
+    extra_offset = offset + 2 + 12 * len(entries) + 4
+    for tag, type, count, value in entries:
+        if len(value) <= 4:
+            field = value.ljust(4, b'\x00')
+        else:
+            field = struct.pack('<I', extra_offset + len(extra))
+            extra += value + b'\x00' * (len(value) % 2)
+        data += struct.pack('<HHI', tag, type, count) + field
+    return data + struct.pack('<I', next_ifd) + extra
+
+
+def ascii(tag: int, value: str) -> Tuple[int, int, int, bytes]:
+    return tag, 2, len(value) + 1, value.encode() + b'\x00'
+
+
+def short(tag: int, value: int) -> Tuple[int, int, int, bytes]:
+    return tag, 3, 1, struct.pack('<H', value)
+
+
+def long(tag: int, value: int) -> Tuple[int, int, int, bytes]:
+    return tag, 4, 1, struct.pack('<I', value)
+
+
+def rationals(tag: int, values: List[Tuple[int, int]]) -> Tuple[int, int, int, bytes]:
+    return tag, 5, len(values), b''.join(struct.pack('<II', n, d) for n, d in values)
+
+
+def make_tiff_raw(preview: bytes, thumbnail: bytes) -> bytes:
+    '''
+    Build a TIFF based RAW file, with a small thumbnail in IFD0, a larger
+    preview in a sub IFD, a sensor image in another sub IFD, and EXIF and GPS
+    IFDs
+    '''
+    # Every IFD here has a fixed size, so lay them out with placeholder offsets first
+    offsets = dict.fromkeys(['exif', 'gps', 'preview', 'sensor', 'thumbnail', 'jpeg'], 0)
+    for _ in range(2):
+        ifds = {
+            'ifd0': [
+                short(0x0100, 160), short(0x0101, 120), short(0x0112, 6),
+                ascii(0x010F, 'Canon'), ascii(0x0110, 'EOS R5'), ascii(0x0132, '2020:01:02 03:04:05'),
+                long(0x0201, offsets['thumbnail']), long(0x0202, len(thumbnail)),
+                (0x014A, 4, 2, struct.pack('<II', offsets['preview'], offsets['sensor'])),
+                long(0x8769, offsets['exif']), long(0x8825, offsets['gps']),
+            ],
+            'exif': [ascii(0x9003, '2021:06:07 08:09:10'), short(0xA002, 6000), short(0xA003, 4000)],
+            'gps': [
+                ascii(0x0001, 'S'), rationals(0x0002, [(27, 1), (30, 1), (0, 1)]),
+                ascii(0x0003, 'E'), rationals(0x0004, [(153, 1), (0, 1), (0, 1)]),
+            ],
+            'preview': [long(0x0201, offsets['jpeg']), long(0x0202, len(preview))],
+            'sensor': [short(0x0100, 6048), short(0x0101, 4024), short(0x0103, 1)],
+        }
+        data = struct.pack('<2sHI', b'II', 42, 8)
+        for name in ['ifd0', 'exif', 'gps', 'preview', 'sensor']:
+            offsets[name] = len(data)
+            data += make_ifd(len(data), ifds[name])
+        offsets['thumbnail'] = len(data)
+        data += thumbnail
+        offsets['jpeg'] = len(data)
+        data += preview
+    return data
+
+
+class RawTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, name: str, data: bytes) -> str:
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        return path
+
+
+class TestIsRaw(unittest.TestCase):
+    def test_raw_extensions(self):
+        self.assertTrue(is_raw('/foo/IMG_0001.CR2'))
+        self.assertTrue(is_raw('/foo/DSC_0001.nef'))
+        self.assertTrue(is_raw('/foo/DSCF0001.RAF'))
+
+    def test_other_extensions(self):
+        self.assertFalse(is_raw('/foo/IMG_0001.jpg'))
+        self.assertFalse(is_raw('/foo/IMG_0001.heic'))
+        self.assertFalse(is_raw('/foo/raw'))
+
+
+class TestJpegInfo(unittest.TestCase):
+    def test_baseline(self):
+        data = make_jpeg(64, 48)
+        self.assertEqual(jpeg_info(io.BytesIO(data), 0, len(data)), (64, 48))
+
+    def test_progressive(self):
+        data = make_jpeg(64, 48, progressive=True)
+        self.assertEqual(jpeg_info(io.BytesIO(data), 0, len(data)), (64, 48))
+
+    def test_at_offset(self):
+        data = make_jpeg(64, 48)
+        self.assertEqual(jpeg_info(io.BytesIO(b'\x00' * 100 + data), 100, len(data)), (64, 48))
+
+    def test_lossless_jpeg(self):
+        data = bytearray(make_jpeg(64, 48))
+        data[data.index(b'\xff\xc0') + 1] = 0xC3
+        self.assertIsNone(jpeg_info(io.BytesIO(bytes(data)), 0, len(data)))
+
+    def test_not_jpeg(self):
+        self.assertIsNone(jpeg_info(io.BytesIO(b'\x00' * 100), 0, 100))
+
+    def test_truncated(self):
+        data = make_jpeg(64, 48)
+        self.assertIsNone(jpeg_info(io.BytesIO(data[:20]), 0, 20))
+
+
+class TestTiffReader(unittest.TestCase):
+    def test_not_tiff(self):
+        self.assertRaises(ValueError, TiffReader, io.BytesIO(b'XX\x2a\x00\x08\x00\x00\x00'))
+
+    def test_unknown_magic(self):
+        self.assertRaises(ValueError, TiffReader, io.BytesIO(b'II\x2b\x00\x08\x00\x00\x00'))
+
+    def test_big_endian(self):
+        data = struct.pack('>2sHIH', b'MM', 42, 8, 1) + struct.pack('>HHIHH', 0x0112, 3, 1, 8, 0) + struct.pack('>I', 0)
+        tiff = TiffReader(io.BytesIO(data))
+        ifd0, next_ifd = tiff.read_ifd(tiff.first_ifd)
+        self.assertEqual(tiff.value(ifd0[0x0112]), 8)
+        self.assertEqual(next_ifd, 0)
+
+    def test_ifd_loop(self):
+        data = struct.pack('<2sHI', b'II', 42, 8) + make_ifd(8, [short(0x0112, 1)], next_ifd=8)
+        self.assertEqual(len(TiffReader(io.BytesIO(data)).ifds()), 1)
+
+    def test_truncated_ifd(self):
+        data = struct.pack('<2sHIH', b'II', 42, 8, 10)
+        tiff = TiffReader(io.BytesIO(data))
+        self.assertRaises(ValueError, tiff.read_ifd, tiff.first_ifd)
+
+    def test_values(self):
+        data = struct.pack('<2sHI', b'II', 42, 8) + make_ifd(8, [ascii(0x010F, 'Nikon'), rationals(0x0002, [(1, 2), (3, 0)]), (0x9000, 7, 4, b'0231')])
+        tiff = TiffReader(io.BytesIO(data))
+        ifd0, _ = tiff.read_ifd(tiff.first_ifd)
+        self.assertEqual(tiff.value(ifd0[0x010F]), 'Nikon')
+        self.assertEqual(tiff.value(ifd0[0x0002]), (0.5, 0.0))
+        self.assertEqual(tiff.value(ifd0[0x9000]), b'0231')
+
+
+class TestReadTiffRaw(RawTestCase):
+    def test_reads_metadata(self):
+        path = self.write('IMG_0001.CR2', make_tiff_raw(make_jpeg(640, 480), make_jpeg(160, 120)))
+        raw = read_raw(path)
+        self.assertEqual((raw.width, raw.height), (6048, 4024))
+        self.assertEqual(raw.orientation, 6)
+        self.assertEqual(raw.exif['Make'], 'Canon')
+        self.assertEqual(raw.exif['Model'], 'EOS R5')
+        self.assertEqual(raw.exif['DateTime'], '2020:01:02 03:04:05')
+        self.assertEqual(raw.exif['ExifOffset'], {'DateTimeOriginal': '2021:06:07 08:09:10', 'ExifImageWidth': 6000, 'ExifImageHeight': 4000})
+        self.assertEqual(raw.exif['GPSInfo'], {'GPSLatitudeRef': 'S', 'GPSLatitude': (27.0, 30.0, 0.0), 'GPSLongitudeRef': 'E', 'GPSLongitude': (153.0, 0.0, 0.0)})
+
+    def test_picks_largest_preview(self):
+        preview = make_jpeg(640, 480)
+        path = self.write('IMG_0001.CR2', make_tiff_raw(preview, make_jpeg(160, 120)))
+        self.assertEqual(read_raw(path).preview, preview)
+
+    def test_skips_undecodable_preview(self):
+        preview = bytearray(make_jpeg(640, 480))
+        preview[preview.index(b'\xff\xc0') + 1] = 0xC3
+        thumbnail = make_jpeg(160, 120)
+        path = self.write('IMG_0001.DNG', make_tiff_raw(bytes(preview), thumbnail))
+        self.assertEqual(read_raw(path).preview, thumbnail)
+
+    def test_not_a_raw_file(self):
+        path = self.write('IMG_0001.CR2', b'not a raw file')
+        self.assertRaises(ValueError, read_raw, path)
+
+    def test_truncated_file(self):
+        data = make_tiff_raw(make_jpeg(640, 480), make_jpeg(160, 120))
+        path = self.write('IMG_0001.CR2', data[:40])
+        self.assertRaises(ValueError, read_raw, path)
+
+
+class TestReadRaf(RawTestCase):
+    def test_reads_metadata(self):
+        tiff = struct.pack('<2sHI', b'II', 42, 8)
+        tiff += make_ifd(8, [ascii(0x010F, 'FUJIFILM'), short(0x0112, 3), long(0x8769, 8 + 2 + 12 * 3 + 4 + 10)])
+        tiff += make_ifd(len(tiff), [short(0xA002, 6240), short(0xA003, 4160)])
+        preview = make_jpeg(640, 480, exif=b'Exif\x00\x00' + tiff)
+        data = b'FUJIFILMCCD-RAW 0201FF383501'.ljust(84, b'\x00') + struct.pack('>II', 100, len(preview))
+        data = data.ljust(100, b'\x00') + preview
+        raw = read_raw(self.write('DSCF0001.RAF', data))
+        self.assertEqual((raw.width, raw.height), (6240, 4160))
+        self.assertEqual(raw.orientation, 3)
+        self.assertEqual(raw.exif['Make'], 'FUJIFILM')
+        self.assertEqual(raw.preview, preview)
+
+    def test_missing_preview(self):
+        data = b'FUJIFILMCCD-RAW 0201FF383501'.ljust(84, b'\x00') + struct.pack('>II', 100, 100)
+        raw = read_raw(self.write('DSCF0001.RAF', data.ljust(200, b'\x00')))
+        self.assertIsNone(raw.preview)
+
+
+class TestReadCr3(RawTestCase):
+    @staticmethod
+    def box(type: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data) + 8) + type + data
+
+    def test_reads_metadata(self):
+        cmt1 = struct.pack('<2sHI', b'II', 42, 8) + make_ifd(8, [ascii(0x010F, 'Canon'), short(0x0112, 8)])
+        cmt2 = struct.pack('<2sHI', b'II', 42, 8) + make_ifd(8, [ascii(0x9003, '2022:01:01 00:00:00'), short(0xA002, 6000), short(0xA003, 4000)])
+        preview = make_jpeg(640, 480)
+        prvw = b'\x00' * 6 + struct.pack('>HHH', 640, 480, 0) + struct.pack('>I', len(preview)) + preview
+        data = self.box(b'ftyp', b'crx \x00\x00\x00\x01') + self.box(b'CMT1', cmt1) + self.box(b'CMT2', cmt2) + self.box(b'PRVW', prvw)
+        raw = read_raw(self.write('IMG_0001.CR3', data))
+        self.assertEqual((raw.width, raw.height), (6000, 4000))
+        self.assertEqual(raw.orientation, 8)
+        self.assertEqual(raw.exif['Make'], 'Canon')
+        self.assertEqual(raw.exif['ExifOffset']['DateTimeOriginal'], '2022:01:01 00:00:00')
+        self.assertEqual(raw.preview, preview)
+
+
+if __name__ == '__main__':
+    unittest.main()
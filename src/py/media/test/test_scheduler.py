@@ -0,0 +1,76 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Unit tests for the scheduler module
+#
+
+'''
+Unit tests for the scheduler module
+'''
+
+# System Imports
+import unittest
+from pathlib import Path
+
+# Local imports
+from media.jobs import Job
+from media.scheduler import Scheduler
+
+
+class TestScheduler(unittest.TestCase):
+    def test_orders_by_priority_then_newest(self):
+        scheduler = Scheduler()
+        scheduler.add(Job([Path('/backfill')], 'backfill'), {Path('/b1'): 100, Path('/b2'): 300})
+        scheduler.add(Job([Path('/sync')], 'sync'), {Path('/s1'): 50, Path('/s2'): 200})
+        scheduler.add(Job([Path('/ui')], 'interactive'), {Path('/i1'): 10})
+        self.assertEqual(scheduler.take(10), [Path('/i1'), Path('/s2'), Path('/s1'), Path('/b2'), Path('/b1')])
+
+    def test_take_is_limited(self):
+        scheduler = Scheduler()
+        scheduler.add(Job([Path('/foo')]), {Path('/a'): 1, Path('/b'): 2, Path('/c'): 3})
+        self.assertEqual(scheduler.take(2), [Path('/c'), Path('/b')])
+        self.assertEqual(scheduler.take(2), [Path('/a')])
+        self.assertEqual(scheduler.take(2), [])
+        self.assertEqual(len(scheduler), 3)
+
+    def test_finishes_jobs_when_all_files_reported(self):
+        scheduler = Scheduler()
+        job = Job([Path('/foo')])
+        scheduler.add(job, {Path('/a'): 1, Path('/b'): 2})
+        scheduler.take(2)
+        scheduler.report(Path('/a'), 'processed')
+        self.assertFalse(job.is_done())
+        scheduler.report(Path('/b'), 'failed', 'corrupt')
+        scheduler.report(Path('/b'), 'processed')
+        self.assertEqual(job.state, 'complete')
+        self.assertEqual(job.summary()['counts'], {'processed': 1, 'failed': 1})
+        self.assertEqual(len(scheduler), 0)
+
+    def test_finishes_empty_job(self):
+        job = Job([Path('/foo')])
+        Scheduler().add(job, {})
+        self.assertEqual(job.state, 'complete')
+
+    def test_shared_file_is_raised_to_higher_priority(self):
+        scheduler = Scheduler()
+        backfill = Job([Path('/foo')], 'backfill')
+        interactive = Job([Path('/foo/a')], 'interactive')
+        scheduler.add(backfill, {Path('/foo/a'): 1, Path('/foo/b'): 2})
+        scheduler.add(interactive, {Path('/foo/a'): 1})
+        self.assertEqual(scheduler.take(1), [Path('/foo/a')])
+        scheduler.report(Path('/foo/a'), 'processed')
+        self.assertEqual(interactive.state, 'complete')
+        self.assertEqual(backfill.summary()['counts'], {'processed': 1})
+        self.assertEqual(scheduler.take(5), [Path('/foo/b')])
+
+    def test_running_file_is_not_taken_again(self):
+        scheduler = Scheduler()
+        scheduler.add(Job([Path('/foo')], 'backfill'), {Path('/foo/a'): 1})
+        self.assertEqual(scheduler.take(1), [Path('/foo/a')])
+        job = Job([Path('/foo/a')], 'interactive')
+        scheduler.add(job, {Path('/foo/a'): 1})
+        self.assertEqual(scheduler.take(1), [])
+        scheduler.report(Path('/foo/a'), 'processed')
+        self.assertEqual(job.state, 'complete')
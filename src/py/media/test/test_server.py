@@ -0,0 +1,103 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Unit tests for the server module
+#
+
+'''
+Unit tests for the server module
+'''
+
+# System Imports
+import tempfile
+import unittest
+from unittest.mock import patch
+from pathlib import Path
+
+# Local imports
+from media.jobs import JobQueue
+from media.server import JobServer, JobClient
+from media.concurrency import ConcurrencyController
+from media.logger import logger
+
+
+# Disable logging
+logger.disabled = True
+
+
+class TestJobServer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpdir.name) / 'processor.sock'
+        self.jobs = JobQueue()
+        self.controller = ConcurrencyController(2, max_workers=8)
+        self.server = JobServer(self.path, self.jobs, self.controller)
+        self.thread = self.server.start()
+        self.client = JobClient(self.path, timeout=5)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.tmpdir.cleanup()
+
+    def test_can_submit_job(self):
+        id = self.client.submit(['/foo/bar.jpg', '/foo/baz'], 'sync')
+        job = self.jobs.get(0)
+        assert job is not None
+        self.assertEqual((job.id, job.paths, job.priority), (id, [Path('/foo/bar.jpg'), Path('/foo/baz')], 'sync'))
+        self.assertEqual(self.client.status(id)['state'], 'queued')
+
+    def test_rejects_invalid_requests(self):
+        self.assertRaisesRegex(ValueError, 'Invalid priority', self.client.submit, ['/foo'], 'urgent')
+        self.assertRaisesRegex(ValueError, 'paths', self.client.request, {'op': 'submit', 'paths': '/foo'})
+        self.assertRaisesRegex(ValueError, 'Unknown job', self.client.status, 'nope')
+        self.assertRaisesRegex(ValueError, 'Unknown op', self.client.request, {'op': 'delete'})
+        self.client.sock.sendall(b'not json\n')
+        self.assertRaises(ValueError, self.client.read)
+
+    def test_reports_unexpected_errors(self):
+        with patch.object(self.jobs, 'submit', side_effect=RuntimeError('boom')):
+            self.assertRaisesRegex(ValueError, 'boom', self.client.submit, ['/foo'])
+        self.assertEqual(self.client.status(self.client.submit(['/foo']))['state'], 'queued')
+
+    def test_can_wait_for_job(self):
+        id = self.client.submit(['/foo'])
+        job = self.jobs.get(0)
+        assert job is not None
+        self.assertEqual(self.client.wait(id, timeout=0.01)['state'], 'queued')
+        job.start()
+        job.report(Path('/foo/bar.jpg'), 'processed')
+        job.finish()
+        summary = self.client.wait(id, results=True)
+        self.assertEqual(summary['state'], 'complete')
+        self.assertEqual(summary['results'], [{'path': '/foo/bar.jpg', 'status': 'processed', 'error': None}])
+
+    def test_can_stream_results(self):
+        id = self.client.submit(['/foo'])
+        job = self.jobs.get(0)
+        assert job is not None
+        job.report(Path('/foo/bar.jpg'), 'processed')
+        stream = self.client.stream(id)
+        self.assertEqual(next(stream)['path'], '/foo/bar.jpg')
+        job.report(Path('/foo/baz.jpg'), 'failed', 'corrupt')
+        self.assertEqual(next(stream)['error'], 'corrupt')
+        job.finish()
+        self.assertEqual(next(stream)['counts'], {'processed': 1, 'failed': 1})
+        self.assertRaises(StopIteration, next, stream)
+
+    def test_removes_socket_on_close(self):
+        self.assertTrue(self.path.exists())
+        self.server.server_close()
+        self.assertFalse(self.path.exists())
+
+    def test_can_change_concurrency(self):
+        self.assertEqual(self.client.concurrency()['workers'], {'io': 2, 'decode': 2})
+        state = self.client.concurrency(workers={'decode': 4}, adaptive=False)
+        self.assertEqual((state['workers'], state['adaptive']), ({'io': 2, 'decode': 4}, False))
+        self.assertEqual(self.controller.get('decode'), 4)
+        self.assertRaisesRegex(ValueError, 'Invalid stage', self.client.concurrency, workers={'gpu': 1})
+        self.assertRaisesRegex(ValueError, 'adaptive', self.client.concurrency, adaptive='false')
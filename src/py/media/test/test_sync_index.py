@@ -0,0 +1,73 @@
+#
+# MIT License
+#
+# Author: Josef Barnes
+#
+# Unit tests for the sync_index module
+#
+
+'''
+Unit tests for the sync_index module
+'''
+
+# System Imports
+import tempfile
+import unittest
+from pathlib import Path
+
+# Local imports
+from media.sync_index import SyncIndex
+
+
+class TestSyncIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmpdir.name)
+        self.index = SyncIndex(self.dir / 'index.db')
+
+    def tearDown(self):
+        self.index.close()
+        self.tmpdir.cleanup()
+
+    def test_can_add_files(self):
+        self.assertFalse(self.index.contains(Path('/dst'), Path('a/b.jpg')))
+        self.index.add(Path('/dst'), [Path('a/b.jpg'), Path('c.jpg')])
+        self.assertTrue(self.index.contains(Path('/dst'), Path('a/b.jpg')))
+        self.assertEqual(self.index.get(Path('/dst')), {Path('a/b.jpg'), Path('c.jpg')})
+
+    def test_adding_twice_is_ignored(self):
+        self.index.add(Path('/dst'), [Path('c.jpg')])
+        self.index.add(Path('/dst'), [Path('c.jpg')])
+        self.assertEqual(self.index.get(Path('/dst')), {Path('c.jpg')})
+
+    def test_files_are_per_dst(self):
+        self.index.add(Path('/dst'), [Path('c.jpg')])
+        self.assertFalse(self.index.contains(Path('/other'), Path('c.jpg')))
+        self.assertEqual(self.index.get(Path('/other')), set())
+
+    def test_can_replace_files(self):
+        self.index.add(Path('/dst'), [Path('a.jpg'), Path('b.jpg')])
+        self.index.add(Path('/other'), [Path('a.jpg')])
+        self.index.replace(Path('/dst'), [Path('b.jpg'), Path('c.jpg')])
+        self.assertEqual(self.index.get(Path('/dst')), {Path('b.jpg'), Path('c.jpg')})
+        self.assertEqual(self.index.get(Path('/other')), {Path('a.jpg')})
+
+    def test_failed_replace_is_rolled_back(self):
+        self.index.add(Path('/dst'), [Path('a.jpg')])
+
+        def paths():
+            yield Path('b.jpg')
+            raise OSError('walk failed')
+
+        self.assertRaises(OSError, self.index.replace, Path('/dst'), paths())
+        self.assertEqual(self.index.get(Path('/dst')), {Path('a.jpg')})
+
+    def test_index_persists(self):
+        self.index.add(Path('/dst'), [Path('a.jpg')])
+        self.index.close()
+        self.index = SyncIndex(self.dir / 'index.db')
+        self.assertTrue(self.index.contains(Path('/dst'), Path('a.jpg')))
+
+
+if __name__ == '__main__':
+    unittest.main()
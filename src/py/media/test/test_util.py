@@ -11,20 +11,26 @@ Unit tests for the util functions
 '''
 
 # System Imports
+import io
 import unittest
 import os
+import tempfile
 from unittest.mock import MagicMock, patch
 from types import SimpleNamespace
 from pathlib import Path
 
 # 3rd Party Imports
 from PIL import Image
+import av
+import numpy as np
 import pyfakefs.fake_filesystem_unittest
 
 # Local imports
 from media.model import FileMetadata
+from media.raw import RawMetadata
+from media.geo import quadkey
 from media.logger import logger
-from media.util import generate_image_thumbnail, parse_exif_timestamp, parse_video_duration, decode_exif, parse_exif_property, parse_exif_gps, calculate_sha256, load_video_metadata, load_image_metadata, load_file_metadata, get_file_stats
+from media.util import resize_thumbnails, encode_thumbnail, generate_thumbnails, get_thumbnail_config, generate_storyboard, calculate_dhash, parse_exif_timestamp, parse_video_duration, decode_exif, extract_exif, parse_exif_property, parse_exif_gps, calculate_sha256, calculate_fingerprint, load_video_metadata, load_image_metadata, load_raw_metadata, decode_raw_preview, load_file_metadata, load_thumbnails, get_file_stats, clone_file_metadata, estimate_decode_size
 
 
 # Disable logging
@@ -41,25 +47,19 @@ class TestGetFileStats(unittest.TestCase):
         self.assertEqual(get_file_stats('test.foo'), (1720448887, 1234))
 
 
-class TestGenerateImageThumbnail(unittest.TestCase):
-    def setUp(self):
-        pass
-
-    def tearDown(self):
-        pass
-
+class TestResizeThumbnails(unittest.TestCase):
     def test_can_generate_thumbnail_landscape(self):
         mock_image = MagicMock(spec=Image.Image)
         mock_image.width = 1920
         mock_image.height = 1080
-        generate_image_thumbnail(mock_image, 320)
+        resize_thumbnails(mock_image, [320])
         mock_image.crop.assert_called_with((420, 0, 1500, 1080))
 
     def test_can_generate_thumbnail_portrait(self):
         mock_image = MagicMock(spec=Image.Image)
         mock_image.width = 1080
         mock_image.height = 1920
-        generate_image_thumbnail(mock_image, 320)
+        resize_thumbnails(mock_image, [320])
         mock_image.crop.assert_called_with((0, 420, 1080, 1500))
 
     def test_converts_color_mode(self):
@@ -68,9 +68,116 @@ class TestGenerateImageThumbnail(unittest.TestCase):
         mock_image.height = 1080
         mock_image.mode = 'P'
         mock_image.crop.return_value = mock_image
-        generate_image_thumbnail(mock_image, 320)
+        resize_thumbnails(mock_image, [320])
         mock_image.convert.assert_called_with('RGB')
 
+    def test_returns_each_size(self):
+        img = Image.new('RGB', (640, 480), 'red')
+        thumbs = resize_thumbnails(img, [32, 64])
+        self.assertEqual({s: t.size for s, t in thumbs.items()}, {32: (32, 32), 64: (64, 64)})
+        self.assertEqual(Image.open(io.BytesIO(encode_thumbnail(thumbs[64], 'webp', 60))).format, 'WEBP')
+
+
+class TestGenerateThumbnails(unittest.TestCase):
+    def setUp(self):
+        self.environ_patcher = patch.dict(os.environ, {'THUMBNAIL_SIZE': '64'})
+        self.environ_patcher.start()
+        self.file = FileMetadata(path='example.jpg', type='image', timestamp=1632345600, size=1024)
+        self.img = Image.effect_mandelbrot((640, 480), (-2, -1.5, 1, 1.5), 100).convert('RGB')
+
+    def tearDown(self):
+        self.environ_patcher.stop()
+
+    def test_default_config(self):
+        self.assertEqual(get_thumbnail_config(), (64, [64], 'jpeg', 75))
+
+    def test_config_from_env(self):
+        os.environ.update({'THUMBNAIL_SIZES': '128, 32,64', 'THUMBNAIL_FORMAT': 'WEBP', 'THUMBNAIL_QUALITY': '60'})
+        self.assertEqual(get_thumbnail_config(), (64, [32, 64, 128], 'webp', 60))
+
+    def test_rejects_invalid_format(self):
+        os.environ['THUMBNAIL_FORMAT'] = 'gif'
+        self.assertRaises(ValueError, get_thumbnail_config)
+
+    def test_single_size(self):
+        generate_thumbnails(self.file, self.img)
+        self.assertEqual(Image.open(io.BytesIO(self.file.thumbnail)).size, (64, 64))
+        self.assertEqual(self.file.thumbnail_format, 'jpeg')
+        self.assertEqual(self.file.thumbnail_sizes, [])
+        self.assertEqual(self.file.thumbnails, [])
+        self.assertEqual(self.file.phash, calculate_dhash(resize_thumbnails(self.img, [64])[64]))
+
+    def test_generates_pyramid(self):
+        os.environ.update({'THUMBNAIL_SIZES': '32,128', 'THUMBNAIL_FORMAT': 'webp'})
+        generate_thumbnails(self.file, self.img)
+        self.assertEqual(self.file.thumbnail_format, 'webp')
+        self.assertEqual(self.file.thumbnail_sizes, [32, 64, 128])
+        self.assertIsNone(self.file.thumbnails[1])
+        for size, thumb in [(32, self.file.thumbnails[0]), (64, self.file.thumbnail), (128, self.file.thumbnails[2])]:
+            img = Image.open(io.BytesIO(thumb))
+            self.assertEqual(img.format, 'WEBP')
+            self.assertEqual(img.size, (size, size))
+
+    def test_doesnt_upscale_small_images(self):
+        os.environ['THUMBNAIL_SIZES'] = '128'
+        generate_thumbnails(self.file, self.img.resize((100, 80)))
+        self.assertEqual(Image.open(io.BytesIO(self.file.thumbnails[1])).size, (80, 80))
+
+
+class TestGenerateStoryboard(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Encode a 4 second video with a keyframe every second
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.path = os.path.join(cls.tmpdir.name, 'test.mp4')
+        with av.open(cls.path, 'w') as container:
+            stream = container.add_stream('mpeg4', rate=10, options={'g': '10', 'sc_threshold': '1000000000'})
+            stream.width, stream.height, stream.pix_fmt = 64, 48, 'yuv420p'
+            for i in range(40):
+                frame = av.VideoFrame.from_ndarray(np.full((48, 64, 3), i * 6, dtype=np.uint8), format='rgb24')
+                container.mux(stream.encode(frame))
+            container.mux(stream.encode())
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def setUp(self):
+        self.environ_patcher = patch.dict(os.environ, {'THUMBNAIL_SIZE': '64'})
+        self.environ_patcher.start()
+
+    def tearDown(self):
+        self.environ_patcher.stop()
+
+    def test_tiles_keyframes(self):
+        data, columns, times = generate_storyboard(self.path, 4, 32)
+        self.assertEqual(columns, 2)
+        self.assertEqual(times, [0, 1000, 2000, 3000])
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (64, 48))
+
+    def test_skips_repeated_keyframes(self):
+        _, columns, times = generate_storyboard(self.path, 8, 32)
+        self.assertEqual(times, [0, 1000, 2000, 3000])
+        self.assertEqual(columns, 2)
+
+    def test_rotates_frames(self):
+        data, columns, times = generate_storyboard(self.path, 1, 24, 90)
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (24, 32))
+
+
+class TestCalculateDHash(unittest.TestCase):
+    def test_gradient_hash(self):
+        self.assertEqual(calculate_dhash(Image.linear_gradient('L')), 0)
+        self.assertEqual(calculate_dhash(Image.linear_gradient('L').rotate(90)), -1)
+
+    def test_hash_survives_resizing(self):
+        img = Image.effect_mandelbrot((512, 512), (-2, -1.5, 1, 1.5), 100)
+        self.assertEqual(calculate_dhash(img), calculate_dhash(img.resize((100, 100))))
+
+    def test_different_images_have_different_hashes(self):
+        img = Image.effect_mandelbrot((256, 256), (-2, -1.5, 1, 1.5), 100)
+        self.assertNotEqual(calculate_dhash(img), calculate_dhash(img.rotate(90)))
+
 
 class TestDecodeExifTimestamp(unittest.TestCase):
     def setUp(self):
@@ -212,6 +319,25 @@ class TestDecodeExif(unittest.TestCase):
     def test_returns_none_if_exif_is_none(self):
         self.assertIsNone(decode_exif(None))
 
+    def test_can_extract_used_exif_tags(self):
+        exif = extract_exif(self.exif)
+        decoded = decode_exif(self.exif)
+        self.assertEqual(exif, {
+            'Make': 'samsung',
+            'Model': 'SM-G991B',
+            'DateTime': '2023:09:22 10:10:29',
+            'ExifOffset': {
+                'DateTimeDigitized': '2023:09:22 10:10:29',
+                'DateTimeOriginal': '2023:09:22 10:10:29',
+            },
+            'GPSInfo': {k: decoded['GPSInfo'][k] for k in ['GPSLatitudeRef', 'GPSLatitude', 'GPSLongitudeRef', 'GPSLongitude']},
+        })
+        self.assertEqual(parse_exif_gps(exif), parse_exif_gps(decoded))
+        self.assertEqual(parse_exif_timestamp(exif), parse_exif_timestamp(decoded))
+
+    def test_extract_handles_missing_tags(self):
+        self.assertEqual(extract_exif(Image.Exif()), {})
+
 
 class TestParseExifProperty(unittest.TestCase):
     def test_can_parse_property(self):
@@ -275,6 +401,31 @@ class TestCalculateSHA256(pyfakefs.fake_filesystem_unittest.TestCase):
         self.assertEqual(calculate_sha256(Path(self.id())), '1432bdc73930323a72540d53a607cddc754af291656653840d63f7c0413c31d1')
 
 
+class TestCalculateFingerprint(pyfakefs.fake_filesystem_unittest.TestCase):
+    def setUp(self):
+        self.setUpPyfakefs()
+
+    def test_can_fingerprint_small_file(self):
+        self.fs.create_file('a', contents='hello')
+        self.fs.create_file('b', contents='hello')
+        self.fs.create_file('c', contents='hellp')
+        self.assertEqual(len(calculate_fingerprint('a')), 32)
+        self.assertEqual(calculate_fingerprint('a'), calculate_fingerprint('b'))
+        self.assertNotEqual(calculate_fingerprint('a'), calculate_fingerprint('c'))
+
+    def test_fingerprint_samples_blocks_of_large_file(self):
+        self.fs.create_file('a', contents='a' * 10 + 'b' * 100 + 'c' * 10)
+        self.fs.create_file('b', contents='a' * 10 + 'b' * 20 + 'x' + 'b' * 79 + 'c' * 10)
+        self.fs.create_file('c', contents='a' * 10 + 'b' * 100 + 'c' * 9 + 'x')
+        self.assertEqual(calculate_fingerprint('a', 10), calculate_fingerprint('b', 10))
+        self.assertNotEqual(calculate_fingerprint('a', 10), calculate_fingerprint('c', 10))
+
+    def test_fingerprint_includes_size(self):
+        self.fs.create_file('a', contents='a' * 10 + 'b' * 100 + 'c' * 10)
+        self.fs.create_file('b', contents='a' * 10 + 'b' * 101 + 'c' * 10)
+        self.assertNotEqual(calculate_fingerprint('a', 10), calculate_fingerprint('b', 10))
+
+
 class TestLoadVideoMetadata(unittest.TestCase):
     def setUp(self):
         self.file = FileMetadata(
@@ -306,7 +457,7 @@ class TestLoadVideoMetadata(unittest.TestCase):
 
     @patch('media.util.ffmpeg.probe')
     @patch('media.util.av.open', MagicMock())
-    @patch('media.util.generate_image_thumbnail', MagicMock())
+    @patch('media.util.generate_thumbnails', MagicMock())
     def test_can_load_metadata(self, mock_probe):
         mock_probe.return_value = {
             'streams': [
@@ -324,7 +475,7 @@ class TestLoadVideoMetadata(unittest.TestCase):
 
     @patch('media.util.ffmpeg.probe')
     @patch('media.util.av.open', MagicMock())
-    @patch('media.util.generate_image_thumbnail', MagicMock())
+    @patch('media.util.generate_thumbnails', MagicMock())
     def test_can_load_metadata_if_cannot_get_rotation(self, mock_probe):
         mock_probe.return_value = {
             'streams': [
@@ -349,19 +500,56 @@ class TestLoadVideoMetadata(unittest.TestCase):
         self.assertEqual(self.file.width, 1920)
 
 
+    @patch('media.util.ffmpeg.probe')
+    @patch('media.util.av.open', MagicMock())
+    @patch('media.util.generate_thumbnails', MagicMock())
+    @patch('media.util.generate_storyboard')
+    def test_generates_storyboard_if_enabled(self, mock_storyboard, mock_probe):
+        mock_probe.return_value = {'streams': [{'codec_type': 'video', 'width': 1920, 'height': 1080, 'duration': 123}]}
+        mock_storyboard.return_value = (b'xxx', 2, [0, 1000, 2000])
+        with patch.dict(os.environ, {'STORYBOARD_FRAMES': '3', 'STORYBOARD_SIZE': '100'}):
+            load_video_metadata(self.file)
+        mock_storyboard.assert_called_with(self.file.path, 3, 100, 0)
+        self.assertEqual((self.file.storyboard, self.file.storyboard_columns, self.file.storyboard_times), (b'xxx', 2, [0, 1000, 2000]))
+
+    @patch('media.util.ffmpeg.probe')
+    @patch('media.util.av.open', MagicMock())
+    @patch('media.util.generate_thumbnails', MagicMock())
+    @patch('media.util.generate_storyboard')
+    def test_loads_video_if_storyboard_fails(self, mock_storyboard, mock_probe):
+        mock_probe.return_value = {'streams': [{'codec_type': 'video', 'width': 1920, 'height': 1080, 'duration': 123}]}
+        mock_storyboard.side_effect = ValueError('No keyframes found for storyboard')
+        storyboard = (self.file.storyboard, self.file.storyboard_columns, self.file.storyboard_times)
+        with patch.dict(os.environ, {'STORYBOARD_FRAMES': '3', 'STORYBOARD_SIZE': '100'}):
+            load_video_metadata(self.file)
+        mock_storyboard.assert_called_once()
+        self.assertEqual((self.file.width, self.file.height), (1920, 1080))
+        self.assertEqual((self.file.storyboard, self.file.storyboard_columns, self.file.storyboard_times), storyboard)
+
+    @patch('media.util.ffmpeg.probe')
+    @patch('media.util.av.open', MagicMock())
+    @patch('media.util.generate_thumbnails', MagicMock())
+    @patch('media.util.generate_storyboard')
+    def test_storyboard_disabled_by_default(self, mock_storyboard, mock_probe):
+        mock_probe.return_value = {'streams': [{'codec_type': 'video', 'width': 1920, 'height': 1080, 'duration': 123}]}
+        load_video_metadata(self.file)
+        mock_storyboard.assert_not_called()
+        self.assertIsNone(self.file.storyboard)
+
+
 class TestLoadImageMetadata(unittest.TestCase):
     def setUp(self):
         self.image_patcher = patch('media.util.Image.open')
         self.mock_image = self.image_patcher.start()
-        self.decode_exif_patcher = patch('media.util.decode_exif')
+        self.decode_exif_patcher = patch('media.util.extract_exif')
         self.mock_decode_exif = self.decode_exif_patcher.start()
-        self.generate_image_thumbnail_patcher = patch('media.util.generate_image_thumbnail')
-        self.mock_generate_image_thumbnail = self.generate_image_thumbnail_patcher.start()
+        self.generate_thumbnails_patcher = patch('media.util.generate_thumbnails')
+        self.mock_generate_thumbnails = self.generate_thumbnails_patcher.start()
 
     def tearDown(self):
         self.image_patcher.stop()
         self.decode_exif_patcher.stop()
-        self.generate_image_thumbnail_patcher.stop()
+        self.generate_thumbnails_patcher.stop()
 
     def test_loads_metadata_with_valid_exif(self):
         os.environ['THUMBNAIL_SIZE'] = '128'
@@ -392,6 +580,7 @@ class TestLoadImageMetadata(unittest.TestCase):
         self.assertEqual(file.timestamp, 1632304800)
         self.assertEqual(file.latitude, 40.5)
         self.assertEqual(file.longitude, 70.66666666666667)
+        self.assertEqual(file.quadkey, quadkey(40.5, 70.66666666666667))
         self.assertIsNotNone(file.thumbnail)
 
     def test_handles_corrupted_or_incomplete_exif(self):
@@ -476,8 +665,108 @@ class TestLoadImageMetadata(unittest.TestCase):
         self.assertEqual(file.timestamp, 1632345600)
         self.assertIsNone(file.latitude)
         self.assertIsNone(file.longitude)
+        self.assertIsNone(file.quadkey)
         self.assertIsNotNone(file.thumbnail)
 
+    @patch.dict(os.environ, {'THUMBNAIL_SIZE': '128', 'THUMBNAIL_SIZES': '64,256'})
+    def test_decodes_heif_thumbnail(self):
+        self.mock_image.return_value.size = (4032, 3024)
+        self.mock_image.return_value.format = 'HEIF'
+        self.mock_decode_exif.return_value = None
+        file = FileMetadata(path='example.heic', type='image', timestamp=1632345600, size=1024)
+        load_image_metadata(file, True)
+        self.assertEqual(file.width, 4032)
+        self.mock_image.return_value.draft.assert_called_once_with('RGB', (256, 256))
+
+    def test_decodes_full_jpeg(self):
+        self.mock_image.return_value.size = (1920, 1080)
+        self.mock_image.return_value.format = 'JPEG'
+        self.mock_decode_exif.return_value = None
+        file = FileMetadata(path='example.jpg', type='image', timestamp=1632345600, size=1024)
+        load_image_metadata(file, True)
+        self.mock_image.return_value.draft.assert_not_called()
+
+
+    @patch.dict(os.environ, {'THUMBNAIL_SIZE': '128', 'THUMBNAIL_SIZES': '64,256'})
+    def test_reduces_jpeg_decode(self):
+        self.mock_image.return_value.size = (12000, 8000)
+        self.mock_image.return_value.format = 'JPEG'
+        self.mock_decode_exif.return_value = None
+        file = FileMetadata(path='example.jpg', type='image', timestamp=1632345600, size=1024)
+        load_image_metadata(file, True, reduce=True)
+        self.assertEqual(file.width, 12000)
+        self.mock_image.return_value.draft.assert_called_once_with('RGB', (256, 256))
+
+
+class TestEstimateDecodeSize(unittest.TestCase):
+    def test_estimates_image_from_header(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / 'foo.png'
+            Image.new('RGBA', (300, 200)).save(path)
+            self.assertEqual(estimate_decode_size(path), 300 * 200 * 4)
+
+    @patch('media.raw.read_raw')
+    def test_estimates_raw_half_size(self, mock_read_raw):
+        mock_read_raw.return_value = RawMetadata(width=6000, height=4000)
+        self.assertEqual(estimate_decode_size(Path('foo.cr2')), 3000 * 2000 * 3)
+
+    def test_ignores_videos_and_unreadable_files(self):
+        self.assertEqual(estimate_decode_size(Path('foo.mp4')), 0)
+        self.assertEqual(estimate_decode_size(Path('/does/not/exist.jpg')), 0)
+
+@patch.dict(os.environ, {'THUMBNAIL_SIZE': '128'})
+class TestDecodeRawPreview(unittest.TestCase):
+    @staticmethod
+    def make_preview(width, height):
+        buf = io.BytesIO()
+        Image.new('RGB', (width, height)).save(buf, 'JPEG')
+        return buf.getvalue()
+
+    def test_uses_preview(self):
+        raw = RawMetadata(width=6000, height=4000, preview=self.make_preview(300, 200))
+        with patch('media.util.rawpy') as mock_rawpy:
+            img = decode_raw_preview('foo.cr2', raw)
+            mock_rawpy.imread.assert_not_called()
+        self.assertEqual(img.size, (300, 200))
+
+    def test_applies_raw_orientation(self):
+        raw = RawMetadata(width=6000, height=4000, orientation=6, preview=self.make_preview(300, 200))
+        self.assertEqual(decode_raw_preview('foo.cr2', raw).size, (200, 300))
+
+    @patch('media.util.rawpy')
+    def test_decodes_raw_if_preview_too_small(self, mock_rawpy):
+        mock_rawpy.imread.return_value.__enter__.return_value.postprocess.return_value = np.zeros((400, 600, 3), dtype=np.uint8)
+        raw = RawMetadata(width=6000, height=4000, preview=self.make_preview(160, 120))
+        img = decode_raw_preview('foo.cr2', raw)
+        mock_rawpy.imread.assert_called_once_with('foo.cr2')
+        self.assertEqual(img.size, (600, 400))
+
+    @patch('media.util.rawpy', None)
+    def test_uses_small_preview_without_rawpy(self):
+        raw = RawMetadata(width=6000, height=4000, preview=self.make_preview(160, 120))
+        self.assertEqual(decode_raw_preview('foo.cr2', raw).size, (160, 120))
+
+    @patch('media.util.rawpy', None)
+    def test_fails_without_preview_or_rawpy(self):
+        raw = RawMetadata(width=6000, height=4000)
+        self.assertRaises(ValueError, decode_raw_preview, 'foo.cr2', raw)
+
+
+class TestLoadRawMetadata(unittest.TestCase):
+    @patch('media.util.decode_raw_preview')
+    @patch('media.util.generate_thumbnails')
+    @patch('media.raw.read_raw')
+    def test_loads_metadata(self, mock_read_raw, mock_generate_thumbnails, mock_decode_raw_preview):
+        mock_read_raw.return_value = RawMetadata(width=6000, height=4000, exif={'Make': 'Canon', 'Model': 'EOS R5', 'DateTime': '2021:09:22 20:00:00'})
+        file = FileMetadata(path='foo.cr2', type='image', timestamp=1632345600, size=1024)
+        load_raw_metadata(file, False)
+        self.assertEqual((file.width, file.height), (6000, 4000))
+        self.assertEqual(file.make, 'Canon')
+        self.assertEqual(file.model, 'EOS R5')
+        self.assertEqual(file.timestamp, 1632304800)
+        mock_decode_raw_preview.assert_called_once_with('foo.cr2', mock_read_raw.return_value)
+        mock_generate_thumbnails.assert_called_once_with(file, mock_decode_raw_preview.return_value)
+
 
 class TestLoadFileMetadata(unittest.TestCase):
     def setUp(self):
@@ -487,6 +776,8 @@ class TestLoadFileMetadata(unittest.TestCase):
         self.mock_load_video_metadata = self.load_video_metadata_patcher.start()
         self.calculate_sha256_patcher = patch('media.util.calculate_sha256')
         self.mock_calculate_sha256 = self.calculate_sha256_patcher.start()
+        self.calculate_fingerprint_patcher = patch('media.util.calculate_fingerprint')
+        self.mock_calculate_fingerprint = self.calculate_fingerprint_patcher.start()
         self.stat_patcher = patch('media.util.get_file_stats')
         self.mock_stat = self.stat_patcher.start()
         self.mock_stat.return_value = 1632304800, 8675309
@@ -495,6 +786,7 @@ class TestLoadFileMetadata(unittest.TestCase):
         self.load_image_metadata_patcher.stop()
         self.load_video_metadata_patcher.stop()
         self.calculate_sha256_patcher.stop()
+        self.calculate_fingerprint_patcher.stop()
         self.stat_patcher.stop()
 
     def test_returns_none_if_invalid_mime_type(self):
@@ -520,3 +812,93 @@ class TestLoadFileMetadata(unittest.TestCase):
         self.mock_load_video_metadata.assert_called_once()
         call = self.mock_load_video_metadata.mock_calls[0]
         self.assertEqual(call.args[0].path, 'foo.mp4')
+
+    @patch('media.util.load_raw_metadata')
+    def test_calls_load_raw_metadata(self, mock_load_raw_metadata):
+        file = load_file_metadata(Path('foo.CR2'), True)
+        self.mock_load_image_metadata.assert_not_called()
+        mock_load_raw_metadata.assert_called_once()
+        self.assertEqual(file.type, 'image')
+
+    def test_uses_known_hashes(self):
+        file = load_file_metadata(Path('foo.jpg'), True, sha256='abc', fingerprint='def')
+        self.mock_calculate_sha256.assert_not_called()
+        self.mock_calculate_fingerprint.assert_not_called()
+        self.assertEqual(file.sha256, 'abc')
+        self.assertEqual(file.fingerprint, 'def')
+
+    def test_can_defer_sha256(self):
+        file = load_file_metadata(Path('foo.jpg'), True, defer_sha256=True)
+        self.mock_calculate_sha256.assert_not_called()
+        self.mock_calculate_fingerprint.assert_called_once()
+        self.assertIsNone(file.sha256)
+
+
+class TestLoadThumbnails(unittest.TestCase):
+    def setUp(self):
+        self.generate_thumbnails_patcher = patch('media.util.generate_thumbnails')
+        self.mock_generate_thumbnails = self.generate_thumbnails_patcher.start()
+
+    def tearDown(self):
+        self.generate_thumbnails_patcher.stop()
+
+    @patch('media.util.ffmpeg.probe')
+    @patch('media.util.Image.open')
+    def test_loads_image_thumbnails(self, mock_open, mock_probe):
+        mock_open.return_value = Image.new('RGB', (64, 48))
+        file = FileMetadata(path='example.jpg', type='image', timestamp=0, size=0)
+        load_thumbnails(file)
+        mock_open.assert_called_with('example.jpg')
+        mock_probe.assert_not_called()
+        self.mock_generate_thumbnails.assert_called_once()
+
+    @patch('media.util.ffmpeg.probe')
+    @patch('media.util.av.open')
+    def test_loads_rotated_video_thumbnails(self, mock_av, mock_probe):
+        mock_probe.return_value = {'streams': [{'codec_type': 'video', 'tags': {'rotate': '90'}}]}
+        frame = MagicMock()
+        mock_av.return_value.decode.return_value = iter([frame])
+        file = FileMetadata(path='example.mp4', type='video', timestamp=0, size=0)
+        load_thumbnails(file)
+        frame.to_image.return_value.rotate.assert_called_with(-90)
+        self.mock_generate_thumbnails.assert_called_with(file, frame.to_image.return_value.rotate.return_value)
+
+    @patch('media.util.decode_raw_preview')
+    @patch('media.raw.read_raw')
+    def test_loads_raw_thumbnails(self, mock_read_raw, mock_decode_raw_preview):
+        file = FileMetadata(path='example.nef', type='image', timestamp=0, size=0)
+        load_thumbnails(file)
+        mock_decode_raw_preview.assert_called_once_with('example.nef', mock_read_raw.return_value)
+        self.mock_generate_thumbnails.assert_called_with(file, mock_decode_raw_preview.return_value)
+
+    @patch('media.util.ffmpeg.probe')
+    def test_fails_for_video_without_stream(self, mock_probe):
+        mock_probe.return_value = {'streams': [{'codec_type': 'audio'}]}
+        file = FileMetadata(path='example.mp4', type='video', timestamp=0, size=0)
+        self.assertRaises(ValueError, load_thumbnails, file)
+
+
+class TestCloneFileMetadata(unittest.TestCase):
+    def setUp(self):
+        self.source = FileMetadata(path='/foo/bar.jpg', type='image', timestamp=1632345600, size=1024, width=640, height=480, make='Foo', sha256='abc', thumbnail=b'xxx')
+
+    @patch('media.util.get_file_stats', lambda _: (1720448887, 1024))
+    def test_clones_metadata(self):
+        file = clone_file_metadata(Path('/foo/baz.jpg'), self.source, False)
+        self.assertEqual(file.path, '/foo/baz.jpg')
+        self.assertEqual(file.timestamp, 1632345600)
+        self.assertEqual(file.width, 640)
+        self.assertEqual(file.make, 'Foo')
+        self.assertEqual(file.thumbnail, b'xxx')
+        self.assertEqual(self.source.path, '/foo/bar.jpg')
+
+    @patch('media.util.get_file_stats', lambda _: (1720448887, 1024))
+    def test_clone_uses_new_fingerprint(self):
+        self.assertIsNone(clone_file_metadata(Path('/foo/baz.jpg'), self.source, False).fingerprint)
+        file = clone_file_metadata(Path('/foo/baz.jpg'), self.source, False, 'a' * 32)
+        self.assertEqual(file.fingerprint, 'a' * 32)
+
+    @patch('media.util.get_file_stats', lambda _: (1720448887, 1024))
+    def test_clone_uses_file_time_if_asked(self):
+        file = clone_file_metadata(Path('/foo/baz.jpg'), self.source, True)
+        self.assertEqual(file.timestamp, 1720448887)
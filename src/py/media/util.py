@@ -11,29 +11,54 @@ Function to load metadata from media files
 '''
 
 # System Imports
+from __future__ import annotations
 import os
 import io
 import time
+import math
 import mimetypes
 import datetime
 import binascii
 import hashlib
 from pathlib import Path
-from typing import Optional, Dict
-
-# 3rd Party Imports
-import ffmpeg
-import av
-from PIL.ExifTags import TAGS, GPSTAGS
-from PIL import Image, TiffImagePlugin, ImageOps, ImageFile
+from types import ModuleType
+from typing import Optional, Dict, List, Tuple
 
 # Local Imports
 from media.logger import logger
 from media.model import FileMetadata
+from media.hashing import hash_engine
+from media.lazy import LazyModule
+from media.geo import quadkey
+
+
+def init_pillow(module: ModuleType):
+    '''
+    Configure Pillow the first time any of its modules are used
+
+    Args:
+        module: The Pillow module that was loaded
+    '''
+    # Allow loading truncated images
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+    # Allow Pillow to open HEIF/HEIC images, if pillow_heif is installed
+    if pillow_heif:
+        pillow_heif.register_heif_opener()
 
 
-# Set this to allow loading truncated images
-ImageFile.LOAD_TRUNCATED_IMAGES = True
+# 3rd Party Imports. These are slow to import, and only needed once a file is
+# decoded, so they are imported on first use
+ffmpeg = LazyModule('ffmpeg')
+av = LazyModule('av')
+np = LazyModule('numpy')
+ExifTags = LazyModule('PIL.ExifTags')
+Image = LazyModule('PIL.Image', on_load=init_pillow)
+ImageFile = LazyModule('PIL.ImageFile')
+ImageOps = LazyModule('PIL.ImageOps', on_load=init_pillow)
+TiffImagePlugin = LazyModule('PIL.TiffImagePlugin', on_load=init_pillow)
+pillow_heif = LazyModule('pillow_heif', optional=True)
+rawpy = LazyModule('rawpy', optional=True)
 
 
 def get_file_stats(path: Path):
@@ -50,28 +75,179 @@ def get_file_stats(path: Path):
     return int(stats.st_mtime), stats.st_size
 
 
-def generate_image_thumbnail(img: Image.Image, size: int):
+def calculate_dhash(img: Image.Image) -> int:
+    '''
+    Calculate a perceptual difference hash (dHash) of an image. Each of the
+    64 bits is set if a pixel is brighter than its right hand neighbour in
+    a 9x8 greyscale version of the image.
+
+    Args:
+        img: The image to hash
+
+    Returns:
+        The hash as a signed 64 bit integer (to fit a postgres INT8)
+    '''
+    pixels = np.asarray(img.convert('L').resize((9, 8), Image.Resampling.BILINEAR), dtype=np.int16)
+    bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return int(bits.view('>i8')[0])
+
+
+def resize_thumbnails(img: Image.Image, sizes: List[int]) -> Dict[int, Image.Image]:
     '''
-    Generate a square thumbnail for an image
+    Crop the centre square of an image and shrink it to each of the
+    thumbnail sizes. Each size is downscaled from the next largest one
+    rather than from the full image, so the expensive resample of the full
+    image only happens once.
 
     Args:
-        img:    The image to generate the thumb from
-        size:   The width/height of the thumbnail to generate, in pixels
+        img:    The image to generate the thumbs from
+        sizes:  The width/height of each thumbnail to generate, in pixels
 
     Returns:
-        A size x size thumbnail of the image
+        A map of size to thumbnail image
     '''
     min_xy = min(img.width, img.height)
     box = ((img.width - min_xy) // 2, (img.height - min_xy) // 2, (img.width + min_xy) // 2, (img.height + min_xy) // 2)
-    cropped = img.crop(box)
-    cropped.thumbnail((size, size))
+    current = img.crop(box)
+    if current.mode in ('RGBA', 'P'):
+        current = current.convert('RGB')
+    thumbs: Dict[int, Image.Image] = {}
+    for size in sorted(set(sizes), reverse=True):
+        current = current.copy()
+        current.thumbnail((size, size))
+        thumbs[size] = current
+    return thumbs
+
+
+def encode_thumbnail(img: Image.Image, format: str = 'jpeg', quality: int = 75) -> bytes:
+    '''
+    Encode a thumbnail image
+
+    Args:
+        img:     The thumbnail to encode
+        format:  The image format (jpeg or webp)
+        quality: The encoder quality (0-100)
+
+    Returns:
+        The encoded image
+    '''
     thumb = io.BytesIO()
-    if cropped.mode in ('RGBA', 'P'):
-        cropped = cropped.convert('RGB')
-    cropped.save(thumb, format='JPEG')
+    img.save(thumb, format=format.upper(), quality=quality)
     return thumb.getvalue()
 
 
+def get_thumbnail_config() -> Tuple[int, List[int], str, int]:
+    '''
+    Get the thumbnail settings from the environment. THUMBNAIL_SIZE is the
+    main thumbnail, and THUMBNAIL_SIZES is an optional comma separated list
+    of extra sizes to generate. THUMBNAIL_FORMAT (jpeg or webp) and
+    THUMBNAIL_QUALITY apply to all sizes.
+
+    Returns:
+        A tuple of (main size, all sizes ascending, format, quality)
+    '''
+    size = int(os.environ['THUMBNAIL_SIZE'])
+    sizes = sorted({size} | {int(s) for s in os.environ.get('THUMBNAIL_SIZES', '').split(',') if s.strip()})
+    format = os.environ.get('THUMBNAIL_FORMAT', 'jpeg').lower()
+    if format not in ('jpeg', 'webp'):
+        raise ValueError(f'Invalid thumbnail format: {format}')
+    quality = int(os.environ.get('THUMBNAIL_QUALITY', '75'))
+    return size, sizes, format, quality
+
+
+def generate_thumbnails(file: FileMetadata, img: Image.Image):
+    '''
+    Generate the thumbnail pyramid and perceptual hash of a file from a
+    single decoded image. The main size is stored in file.thumbnail, and
+    the extra sizes in file.thumbnails (with None in place of the main size).
+
+    Args:
+        file: The file to set the thumbnails of
+        img:  The decoded image
+    '''
+    size, sizes, format, quality = get_thumbnail_config()
+    thumbs = resize_thumbnails(img, sizes)
+    file.thumbnail = encode_thumbnail(thumbs[size], format, quality)
+    file.phash = calculate_dhash(thumbs[size])
+    file.thumbnail_format = format
+    if len(sizes) > 1:
+        file.thumbnail_sizes = sizes
+        file.thumbnails = [None if s == size else encode_thumbnail(thumbs[s], format, quality) for s in sizes]
+    else:
+        file.thumbnail_sizes = []
+        file.thumbnails = []
+
+
+def get_storyboard_config() -> Tuple[int, int]:
+    '''
+    Get the video storyboard settings from the environment. Storyboards are
+    only generated if STORYBOARD_FRAMES is set to a positive number of
+    frames. STORYBOARD_SIZE is the width of each frame in pixels.
+
+    Returns:
+        A tuple of (number of frames, frame width)
+    '''
+    return int(os.environ.get('STORYBOARD_FRAMES', '0')), int(os.environ.get('STORYBOARD_SIZE', '160'))
+
+
+def generate_storyboard(path: str, frames: int, width: int, rotation: int = 0) -> Tuple[bytes, int, List[int]]:
+    '''
+    Generate a storyboard for a video by seeking to evenly spaced points and
+    decoding the keyframe at (or before) each one. Only keyframes are
+    decoded, so the cost depends on the number of frames rather than the
+    length of the video. The frames are tiled left to right, top to bottom
+    in a single sprite sheet.
+
+    Args:
+        path:     The path of the video
+        frames:   The number of frames to capture
+        width:    The width of each frame, in pixels
+        rotation: The rotation of the video, in degrees
+
+    Returns:
+        A tuple of the encoded sprite sheet, the number of columns in the
+        sheet, and the time of each frame in milliseconds
+    '''
+    _, _, format, quality = get_thumbnail_config()
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        stream.codec_context.skip_frame = 'NONKEY'
+        if stream.duration is not None and stream.time_base is not None:
+            duration = float(stream.duration * stream.time_base)
+        elif container.duration is not None:
+            duration = container.duration / av.time_base
+        else:
+            raise ValueError('Unable to find video duration')
+
+        tiles: List[Image.Image] = []
+        times: List[int] = []
+        for i in range(frames):
+            target = duration * (i + 0.5) / frames
+            offset = int(target / stream.time_base) + (stream.start_time or 0)
+            container.seek(offset, stream=stream, backward=True, any_frame=False)
+            frame = next(container.decode(stream), None)
+            if frame is None or frame.time is None:
+                continue
+            time_ms = int(frame.time * 1000)
+            if times and time_ms <= times[-1]:
+                # Seeking landed on a keyframe that is already in the storyboard
+                continue
+            img = frame.to_image().rotate(-rotation, expand=True)
+            img.thumbnail((width, width * img.height // img.width or 1))
+            tiles.append(img)
+            times.append(time_ms)
+
+    if not tiles:
+        raise ValueError('No keyframes found for storyboard')
+    columns = math.ceil(math.sqrt(len(tiles)))
+    rows = math.ceil(len(tiles) / columns)
+    tile_w, tile_h = tiles[0].size
+    sheet = Image.new('RGB', (columns * tile_w, rows * tile_h))
+    for i, tile in enumerate(tiles):
+        sheet.paste(tile.resize((tile_w, tile_h)), ((i % columns) * tile_w, (i // columns) * tile_h))
+    return encode_thumbnail(sheet, format, quality), columns, times
+
+
 def parse_exif_timestamp(exif: Dict) -> Optional[int]:
     '''
     Find the EXIF timestamp and convert to unix epoch seconds
@@ -145,6 +321,22 @@ def parse_video_duration(probe: Dict, video_info: Dict) -> int:
     raise ValueError('Unable to find video duration')
 
 
+def parse_video_rotation(video_info: Dict) -> int:
+    '''
+    Get the video rotation from the ffprobe metadata
+
+    Args:
+        video_info: The stream info for the video
+
+    Returns:
+        The rotation in degrees (0 if unknown)
+    '''
+    try:
+        return int(video_info.get('tags', {}).get('rotate', 0))
+    except:
+        return 0
+
+
 def parse_exif_gps(exif):
     '''
     Get the GPS latitude/longitude from the EXIF data
@@ -177,7 +369,7 @@ def decode_exif(data, key=None):
     Returns:
         The decoded exif node
     '''
-    tags = GPSTAGS if key == 'GPSInfo' else TAGS
+    tags = ExifTags.GPSTAGS if key == 'GPSInfo' else ExifTags.TAGS
     if isinstance(data, Image.Exif):
         res = {}
         for tag, val in data.items():
@@ -206,6 +398,40 @@ def decode_exif(data, key=None):
     return data
 
 
+# The EXIF tags that are used when loading image metadata
+EXIF_TAGS = {0x010F: 'Make', 0x0110: 'Model', 0x0132: 'DateTime'}
+EXIF_OFFSET_TAG = 0x8769
+EXIF_OFFSET_TAGS = {0x9003: 'DateTimeOriginal', 0x9004: 'DateTimeDigitized'}
+EXIF_GPS_TAG = 0x8825
+EXIF_GPS_TAGS = {0x0001: 'GPSLatitudeRef', 0x0002: 'GPSLatitude', 0x0003: 'GPSLongitudeRef', 0x0004: 'GPSLongitude'}
+
+
+def extract_exif(exif: Image.Exif) -> Dict:
+    '''
+    Decode only the EXIF tags that are needed to load image metadata. Sub
+    IFDs are only read if they exist, and every other tag (eg. large maker
+    notes) is left undecoded. The result has the same structure as
+    decode_exif(), so it can be passed to the parse_exif_* functions.
+
+    Args:
+        exif: The raw exif data
+
+    Returns:
+        The decoded subset of exif data
+    '''
+    res: Dict = {name: decode_exif(exif[tag]) for tag, name in EXIF_TAGS.items() if tag in exif}
+
+    if EXIF_OFFSET_TAG in exif:
+        ifd = exif.get_ifd(EXIF_OFFSET_TAG)
+        res['ExifOffset'] = {name: decode_exif(ifd[tag]) for tag, name in EXIF_OFFSET_TAGS.items() if tag in ifd}
+
+    if EXIF_GPS_TAG in exif:
+        ifd = exif.get_ifd(EXIF_GPS_TAG)
+        res['GPSInfo'] = {name: decode_exif(ifd[tag]) for tag, name in EXIF_GPS_TAGS.items() if tag in ifd}
+
+    return res
+
+
 def calculate_sha256(path: Path | str) -> str:
     '''
     Calculate a SHA256 checksum of a file
@@ -216,13 +442,33 @@ def calculate_sha256(path: Path | str) -> str:
     Returns:
         The hex encoded sha256 digest
     '''
-    sha = hashlib.sha256()
-    buf = bytearray(128 * 1024)
-    mv = memoryview(buf)
+    return hash_engine.sha256(path)
+
+
+def calculate_fingerprint(path: Path | str, block_size: int = 64 * 1024) -> str:
+    '''
+    Calculate a cheap fingerprint of a file from its size and the first,
+    middle and last blocks. Files with different fingerprints are guaranteed
+    to have different contents, but the reverse is not true.
+
+    Args:
+        path:       The path of the file to fingerprint
+        block_size: The size of each block to read
+
+    Returns:
+        The hex encoded fingerprint
+    '''
+    digest = hashlib.blake2b(digest_size=16)
     with open(path, 'rb', buffering=0) as fp:
-        while nbytes := fp.readinto(mv):
-            sha.update(mv[:nbytes])
-    return sha.hexdigest()
+        size = os.fstat(fp.fileno()).st_size
+        digest.update(size.to_bytes(8, 'little'))
+        if size <= 3 * block_size:
+            digest.update(fp.read(size))
+        else:
+            for offset in [0, (size - block_size) // 2, size - block_size]:
+                fp.seek(offset)
+                digest.update(fp.read(block_size))
+    return digest.hexdigest()
 
 
 def load_video_metadata(file: FileMetadata):
@@ -246,28 +492,27 @@ def load_video_metadata(file: FileMetadata):
     file.height = int(video_info['height'])
     file.duration = parse_video_duration(probe, video_info)
 
-    try:
-        rotation = int(video_info.get('tags', {}).get('rotate', 0))
-    except:
-        rotation = 0
-
-    size = int(os.environ['THUMBNAIL_SIZE'])
     frames = av.open(file.path).decode(video=0)
-    file.thumbnail = generate_image_thumbnail(next(frames).to_image().rotate(-rotation), size)
+    generate_thumbnails(file, next(frames).to_image().rotate(-parse_video_rotation(video_info)))
 
+    storyboard_frames, storyboard_size = get_storyboard_config()
+    if storyboard_frames > 0:
+        # The storyboard is optional, so a video that doesn't seek well is still indexed without one
+        try:
+            file.storyboard, file.storyboard_columns, file.storyboard_times = generate_storyboard(file.path, storyboard_frames, storyboard_size, parse_video_rotation(video_info))
+        except Exception as e:
+            logger.warning('Unable to generate storyboard for %s: %s', file.path, e)
 
-def load_image_metadata(file: FileMetadata, use_file_time: bool):
+
+def apply_exif(file: FileMetadata, exif: Optional[Dict], use_file_time: bool):
     '''
-    Load the metadata for a image file using ffmpeg
+    Set the metadata of a file from its EXIF data
 
     Args:
-        file:          The file to load the metadata
+        file:          The file to set the metadata of
+        exif:          The EXIF data, as returned by extract_exif()
         use_file_time: Don't get the time from the exif data
     '''
-    img = Image.open(file.path)
-    file.width = img.size[0]
-    file.height = img.size[1]
-    exif = decode_exif(img.getexif())
     if exif is None:
         return
 
@@ -276,44 +521,207 @@ def load_image_metadata(file: FileMetadata, use_file_time: bool):
     timestamp = parse_exif_timestamp(exif)
     if not use_file_time:
         if timestamp is None:
-            logger.warning(f'Invalid time found for {file.path}')
+            logger.warning('Invalid time found for %s', file.path)
         else:
             file.timestamp = timestamp
 
     file.latitude, file.longitude = parse_exif_gps(exif)
-    size = int(os.environ['THUMBNAIL_SIZE'])
-    file.thumbnail = generate_image_thumbnail(ImageOps.exif_transpose(Image.open(file.path)), size)
+    file.quadkey = quadkey(file.latitude, file.longitude)
+
+
+def open_thumbnail_source(img: Image.Image, reduce: bool = False) -> Image.Image:
+    '''
+    Prepare an opened image to generate thumbnails from. HEIF images embed
+    smaller thumbnails of the image, so the smallest one that covers every
+    thumbnail size is decoded rather than the full image. JPEG images can be
+    decoded at 1/2, 1/4 or 1/8 scale, which is done when reduce is set (eg.
+    for images too large to decode in the memory budget).
+
+    Args:
+        img:    The opened image
+        reduce: Decode JPEG images at the smallest scale that covers every thumbnail size
+
+    Returns:
+        The image, with its EXIF orientation applied
+    '''
+    if img.format == 'HEIF' or (reduce and img.format == 'JPEG'):
+        _, sizes, _, _ = get_thumbnail_config()
+        img.draft('RGB', (sizes[-1], sizes[-1]))
+    return ImageOps.exif_transpose(img)
+
+
+def decode_raw_preview(path: str, raw) -> Image.Image:
+    '''
+    Decode the image to generate thumbnails from for a RAW file. This is the
+    largest embedded preview if it covers every thumbnail size, and the RAW
+    data is only decoded (with rawpy, if it is installed) if it doesn't.
+
+    Args:
+        path: The path of the RAW file
+        raw:  The RawMetadata read from the file
+
+    Raises:
+        ValueError: If there is no preview and the RAW data can't be decoded
+
+    Returns:
+        The image, with its orientation applied
+    '''
+    _, sizes, _, _ = get_thumbnail_config()
+    if raw.preview is not None:
+        img = Image.open(io.BytesIO(raw.preview))
+        if min(img.size) >= sizes[-1] or not rawpy:
+            # Previews are often stored without an orientation, so use the one from the RAW file
+            img.getexif().setdefault(0x0112, raw.orientation)
+            return ImageOps.exif_transpose(img)
+    if not rawpy:
+        raise ValueError('No embedded preview found, and rawpy is not installed to decode the RAW data')
+    with rawpy.imread(path) as data:
+        return Image.fromarray(data.postprocess(half_size=True, use_camera_wb=True))
+
+
+def load_image_metadata(file: FileMetadata, use_file_time: bool, reduce: bool = False):
+    '''
+    Load the metadata for a image file using ffmpeg
+
+    Args:
+        file:          The file to load the metadata
+        use_file_time: Don't get the time from the exif data
+        reduce:        Decode the image at a reduced scale where possible
+    '''
+    img = Image.open(file.path)
+    file.width = img.size[0]
+    file.height = img.size[1]
+    apply_exif(file, extract_exif(img.getexif()), use_file_time)
+    generate_thumbnails(file, open_thumbnail_source(img, reduce))
+
+
+def load_raw_metadata(file: FileMetadata, use_file_time: bool):
+    '''
+    Load the metadata for a camera RAW file
+
+    Args:
+        file:          The file to load the metadata
+        use_file_time: Don't get the time from the exif data
+    '''
+    # Imported here, since the raw module uses the EXIF tag tables from this one
+    from media.raw import read_raw
+    raw = read_raw(file.path)
+    file.width = raw.width
+    file.height = raw.height
+    apply_exif(file, raw.exif, use_file_time)
+    generate_thumbnails(file, decode_raw_preview(file.path, raw))
+
+
+def load_thumbnails(file: FileMetadata):
+    '''
+    Regenerate the thumbnails of a file with the current thumbnail settings,
+    without reloading the rest of its metadata
+
+    Args:
+        file: The file to regenerate the thumbnails of
+    '''
+    from media.raw import is_raw, read_raw
+    if file.type == 'video':
+        try:
+            probe = ffmpeg.probe(file.path)
+            video_info = [s for s in probe['streams'] if s['codec_type'] == 'video'][0]
+        except:
+            raise ValueError('No valid video stream found')
+        frames = av.open(file.path).decode(video=0)
+        generate_thumbnails(file, next(frames).to_image().rotate(-parse_video_rotation(video_info)))
+    elif is_raw(file.path):
+        generate_thumbnails(file, decode_raw_preview(file.path, read_raw(file.path)))
+    else:
+        generate_thumbnails(file, open_thumbnail_source(Image.open(file.path)))
 
 
-def load_file_metadata(path: Path, use_file_mtime: bool) -> Optional[FileMetadata]:
+def estimate_decode_size(path: Path) -> int:
+    '''
+    Estimate the memory needed to decode an image from its header, as
+    width x height x bands. RAW files are estimated from a half size decode
+    of the sensor data, which is the most that is ever decoded. Videos only
+    decode a frame at a time, so they aren't counted.
+
+    Args:
+        path: The path of the file
+
+    Returns:
+        The estimated size in bytes, or 0 if it isn't an image (or the header can't be read)
+    '''
+    from media.raw import is_raw, read_raw
+    try:
+        if is_raw(path):
+            raw = read_raw(path)
+            return raw.width * raw.height * 3 // 4
+        mime_type = mimetypes.guess_type(path)[0]
+        if mime_type is None or not mime_type.startswith('image'):
+            return 0
+        with Image.open(path) as img:
+            return img.width * img.height * len(img.getbands())
+    except Exception:
+        return 0
+
+
+def clone_file_metadata(path: Path, source: FileMetadata, use_file_mtime: bool, fingerprint: Optional[str] = None) -> FileMetadata:
+    '''
+    Create the metadata for a file from the metadata of an identical file,
+    without decoding it
+
+    Args:
+        path:           Path of the file to create the metadata for
+        source:         The metadata of a file with the same contents
+        use_file_mtime: Use the mtime form the filesystem rather than the source timestamp
+        fingerprint:    The fingerprint of the file. Media indexed before fingerprints has none to copy
+
+    Returns:
+        The file metadata
+    '''
+    timestamp, size = get_file_stats(path)
+    file = source.model_copy(update={'path': str(path), 'size': size, 'fingerprint': fingerprint or source.fingerprint})
+    if use_file_mtime:
+        file.timestamp = timestamp
+    return file
+
+
+def load_file_metadata(path: Path, use_file_mtime: bool, sha256: Optional[str] = None, fingerprint: Optional[str] = None, defer_sha256: bool = False, reduce: bool = False) -> Optional[FileMetadata]:
     '''
     Load the metadata for a file
 
     Args:
         path:           Path of the file to load
         use_file_mtime: Use the mtime form the filesystem rather than the exif data
+        sha256:         The checksum of the file, if it is already known
+        fingerprint:    The fingerprint of the file, if it is already known
+        defer_sha256:   Leave the checksum unset if it is not already known
+        reduce:         Decode images at a reduced scale where possible
 
     Returns:
         The file metadata, or None if it couldn't be loaded
     '''
-    mime_type = mimetypes.guess_type(path)[0]
+    from media.raw import is_raw
+    mime_type = 'image/raw' if is_raw(path) else mimetypes.guess_type(path)[0]
     if mime_type is None:
-        logger.warning(f'Skipping unsupported file: {path}')
+        logger.warning('Skipping unsupported file: %s', path)
         return None
 
     timestamp, size = get_file_stats(path)
     file = FileMetadata(path=str(path), type=mime_type, timestamp=timestamp, size=size)
 
-    if mime_type.startswith('image'):
+    if mime_type == 'image/raw':
         file.type = 'image'
-        load_image_metadata(file, use_file_mtime)
+        load_raw_metadata(file, use_file_mtime)
+    elif mime_type.startswith('image'):
+        file.type = 'image'
+        load_image_metadata(file, use_file_mtime, reduce)
     elif mime_type.startswith('video') or mime_type in ['audio/3gpp']:
         file.type = 'video'
         load_video_metadata(file)
     else:
-        logger.warning(f'Skipping unsupported file of mime type {mime_type}: {path}')
+        logger.warning('Skipping unsupported file of mime type %s: %s', mime_type, path)
         return None
 
-    file.sha256 = calculate_sha256(file.path)
+    file.fingerprint = fingerprint or calculate_fingerprint(file.path)
+    file.sha256 = sha256 or (None if defer_sha256 else calculate_sha256(file.path))
 
     return file
+
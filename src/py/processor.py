@@ -17,12 +17,19 @@ PGHOST - host of the postgres database
 PGUSER - The user to connect as
 PGDATABASE - The database to connect to
 TIMEZONE - Name of the timezone to use
+
+Without -p, it runs as a daemon that processes the paths sent to it with
+pg_notify('media_processor', path), and (with --socket) the jobs submitted
+to its UNIX socket API. See media/server.py for the socket protocol.
 '''
 
 # System Imports
+import os
 import sys
 import time
 import argparse
+import threading
+import contextlib
 from pathlib import Path
 
 # 3rd Party Imports
@@ -30,8 +37,14 @@ from dotenv import load_dotenv
 
 # Local Imports
 from media.media_processor import MediaProcessor
+from media.cache import ExtractionCache
 from media.logger import logger, init_logger
-from media.database import db
+from media.database import db, Database
+from media.jobs import JobQueue
+from media.server import JobServer
+from media.concurrency import ConcurrencyController
+from media.admission import DecodeBudget
+from media.isolation import IsolatedPool
 
 
 def parse_args():  # pragma: no cover
@@ -52,15 +65,60 @@ def parse_args():  # pragma: no cover
     parser.add_argument('-p', '--path', type=str, help='Process a path and exit')
     parser.add_argument('-r', '--dry-run', action='store_true', help='Don\'t modify the database. Dump to stdout changes to make')
     parser.add_argument('-t', '--use-file-mtime', action='store_true', help='Force the use of the file timestamp')
+    parser.add_argument('--adaptive', action='store_true', help='Adjust the number of threads for each stage to the load in daemon mode')
+    parser.add_argument('--backfill-hashes', action='store_true', help='Calculate missing checksums at low priority and exit')
+    parser.add_argument('--backfill-quadkeys', action='store_true', help='Calculate the map tiles of media with a location but no quadkey and exit')
+    parser.add_argument('--cache', type=str, help='Path to a local cache of extracted metadata (created if it doesn\'t exist)')
+    parser.add_argument('--chunk-size', type=int, help='Number of files to process at a time in daemon mode, between checks for higher priority work (default 2 x ncpu)')
+    parser.add_argument('--copy-streams', type=int, default=4, help='Number of parallel COPY streams to load the table with in rebuild mode')
+    parser.add_argument('--decode-budget', type=int, default=0, help='Maximum estimated memory (in MB) of the images being decoded at once. Larger images are decoded alone (0 for no limit)')
+    parser.add_argument('--dedup', action='store_true', help='Reuse the metadata of already indexed files with the same contents')
+    parser.add_argument('--defer-sha256', action='store_true', help='Only calculate checksums needed for dedup, and backfill the rest later')
+    parser.add_argument('--file-timeout', type=float, default=300, help='Maximum time (in seconds) to decode each file with --isolate (0 for no limit)')
+    parser.add_argument('--isolate', action='store_true', help='Decode files in supervised worker processes, and quarantine files that hang or crash them')
+    parser.add_argument('--log-json', action='store_true', help='Write the log as JSON lines')
+    parser.add_argument('--max-load', type=float, default=1.5, help='Load average per CPU above which the adaptive threads back off')
+    parser.add_argument('--max-rate', type=float, default=0, help='Maximum number of files per second to regenerate thumbnails for (0 for no limit)')
+    parser.add_argument('--max-workers', type=int, help='Maximum number of threads for each stage with --adaptive (default the number of CPUs)')
+    parser.add_argument('--rebuild', action='store_true', help='Re-index the path from scratch into a staging table (with the media outside the path copied over), and swap it in place of the media table')
+    parser.add_argument('--reconcile', action='store_true', help='Update the paths of files that were moved, and remove the media of deleted files, before processing the path')
+    parser.add_argument('--recompute-summaries', action='store_true', help='Rebuild the timeline and search option summaries from the media table and exit')
+    parser.add_argument('--regenerate-thumbnails', action='store_true', help='Rebuild the thumbnails of all indexed media at low priority and exit')
+    parser.add_argument('--socket', type=str, help='Path of a UNIX socket to accept jobs on')
+    parser.add_argument('--xattr', action='store_true', help='Read and store file checksums in the user.media.sha256 extended attribute')
 
     args = parser.parse_args()
 
     if not Path(args.env).exists():
         parser.error(f'{args.env} not found')
+    if args.rebuild and not args.path:
+        parser.error('--rebuild requires a path (-p)')
+    if args.reconcile and not args.path:
+        parser.error('--reconcile requires a path (-p)')
 
     return args
 
 
+def listen_for_paths(jobs: JobQueue):  # pragma: no cover
+    '''
+    Queue the paths sent with pg_notify as interactive jobs. This listens on
+    its own connection, so it doesn't need to wait for the processor.
+
+    Args:
+        jobs: The queue to submit jobs to
+    '''
+    listener = Database()
+    while True:
+        try:
+            with listener.open():
+                for path in listener.listen('media_processor'):
+                    job = jobs.submit([Path(path)], 'interactive')
+                    logger.info('Job %s submitted by notification for %s', job.id, path)
+        except:
+            logger.exception('Lost the notification connection. Will reconnect in 1 minute')
+            time.sleep(60)
+
+
 def main(args: argparse.Namespace):  # pragma: no cover
     '''
     Main function.
@@ -71,26 +129,76 @@ def main(args: argparse.Namespace):  # pragma: no cover
     if args.env:
         load_dotenv(args.env)
 
-    init_logger(args.log_file, args.debug)
-    processor = MediaProcessor(args.ncpu, args.dry_run, args.use_file_mtime)
+    init_logger(args.log_file, args.debug, json_format=args.log_json)
+    cache = ExtractionCache(args.cache) if args.cache else None
+    controller = ConcurrencyController(args.ncpu, args.max_workers, args.max_load, args.adaptive)
+    budget = DecodeBudget(args.decode_budget * 2**20) if args.decode_budget > 0 else None
+    isolation = IsolatedPool(args.file_timeout if args.file_timeout > 0 else None) if args.isolate else None
+    processor = MediaProcessor(args.ncpu, args.dry_run, args.use_file_mtime, args.dedup, args.defer_sha256, cache, args.xattr, controller, budget, isolation)
+
+    with db.open(), isolation or contextlib.nullcontext():
+        # Fill in any checksums that were deferred when files were processed
+        if args.backfill_hashes:
+            os.nice(19)
+            processor.backfill_hashes()
+            return 0
+
+        # Fill in the map tiles of media that was indexed without them
+        if args.backfill_quadkeys:
+            processor.backfill_quadkeys()
+            return 0
+
+        # Rebuild the thumbnails with the current thumbnail settings
+        if args.regenerate_thumbnails:
+            os.nice(19)
+            processor.regenerate_thumbnails(max_rate=args.max_rate)
+            return 0
+
+        # Repair the summary tables
+        if args.recompute_summaries:
+            processor.recompute_summaries()
+            return 0
+
+        # Re-index everything from scratch and swap the new table in
+        if args.rebuild:
+            processor.rebuild([Path(args.path)], args.copy_streams)
+            return 0
+
+        # Catch up with files that were moved or deleted, so moved files aren't processed again
+        if args.reconcile:
+            processor.reconcile([Path(args.path)])
 
-    with db.open():
         # If a path was supplied, run a single process on that path
         if args.path:
             processor.run([Path(args.path)])
             return 0
 
-        # Loop forever connecting to the database and listening for notifications
-        while True:
-            try:
-                for path in db.listen('media_processor'):
-                    processor.run([Path(path)])
-            except KeyboardInterrupt:
-                logger.info('Caught keyboard interrupt. Exiting')
-                break
-            except:
-                logger.exception('Uncaught exception. Will reconnect in 1 minute')
-                time.sleep(60)
+        # Run the jobs from notifications and the socket API until interrupted
+        jobs = JobQueue()
+        threading.Thread(target=listen_for_paths, args=(jobs,), name='listener', daemon=True).start()
+        controller.install_signal_handlers()
+        server = JobServer(args.socket, jobs, controller) if args.socket else None
+        if server is not None:
+            server.start()
+        try:
+            while True:
+                try:
+                    job = jobs.get()
+                    if job is None:
+                        continue
+                    processor.run_jobs(job, jobs, args.chunk_size)
+                    if args.defer_sha256:
+                        processor.backfill_hashes()
+                except KeyboardInterrupt:
+                    logger.info('Caught keyboard interrupt. Exiting')
+                    break
+                except:
+                    logger.exception('Uncaught exception. Will continue in 1 minute')
+                    time.sleep(60)
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
 
 
 if __name__ == '__main__':  # pragma: no cover
@@ -28,10 +28,20 @@ exclude. For example:
   {"src": "/home/foo/qwerty", dst: "/home/qwerty", "glob": "*.mp4", "exclude": "\\.trashed"}
 ]
 
-When an event is detected from syncthing, the paths are processed to copy any
-new files to the media repository, then the media processor is called to insert
-the new files. This script will never overwrite or delete existing files in the
-`dst`, so it is safe from volatility in the syncthing share.
+Each path can also have a "folder", which is the ID of the syncthing folder
+that src is in. If it isn't set, it is found from the syncthing config.
+
+Events are long polled from the syncthing API, and events that arrive within
+a few seconds of each other (the -b flag) are handled as one batch, so a large
+sync is copied and processed in one go. Only the files named in the events
+are copied to the media repository, then the media processor is called to
+insert the new files. The files in each `dst` are kept in a persistent index
+(the -i flag), so this doesn't need to walk the `dst` trees. All of the `src`
+trees are reconciled against the index on startup, and whenever events may
+have been missed (eg. syncthing was restarted). The `dst` trees are only
+walked to rebuild the index every --reconcile-interval seconds. This script
+will never overwrite or delete existing files in the `dst`, so it is safe from
+volatility in the syncthing share.
 
 Like with the manual processor script. You need to provide the path to an
 env file that contains the connection information for postgres, as well as the
@@ -50,10 +60,9 @@ import time
 import sys
 import json
 import argparse
-import shutil
 import re
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, List, Optional, Set, Tuple
 
 # 3rd Party Imports
 import requests
@@ -64,12 +73,21 @@ from pydantic import BaseModel
 # Local Imports
 from media.media_processor import MediaProcessor
 from media.logger import logger, init_logger
-from media.database import db
+from media.database import db, get_timezone
+from media.sync_index import SyncIndex
+from media.copier import CopiedFile, parallel_copy
 
 
 # Disable warnings about self signed certificates
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# The number of events syncthing buffers for each subscription. A response
+# this big may have overflowed the buffer, so events could have been missed.
+EVENT_BUFFER_SIZE = 1000
+
+# The number of seconds to wait for a response, on top of any long poll timeout
+HTTP_TIMEOUT_MARGIN = 30
+
 
 class CopyPath(BaseModel):
     '''
@@ -79,6 +97,7 @@ class CopyPath(BaseModel):
     dst: Path               # The dst path to copy to
     glob: str               # A glob to filter on src files
     exclude: Optional[str]  # A regular expression to exclude certain files
+    folder: Optional[str] = None  # The ID of the syncthing folder that src is in
 
 
 def read_paths(path: Path) -> List[CopyPath]:
@@ -97,84 +116,261 @@ def read_paths(path: Path) -> List[CopyPath]:
         return [CopyPath(**v) for v in data]
 
 
-def get_events_since(session: requests.Session, host: str, since: int):
+def create_session() -> requests.Session:
+    '''
+    Create a session for the syncthing API
+
+    Returns:
+        The session
+    '''
+    session = requests.Session()
+    session.headers['X-API-Key'] = os.environ['SYNCTHING_API_KEY']
+    return session
+
+
+def get_folders(session: requests.Session, host: str) -> Dict[str, Path]:
+    '''
+    Get the syncthing folders
+
+    Args:
+        session: An active requests session
+        host:    The host/port of the syncthing API
+
+    Returns:
+        A map of folder ID to the path of the folder
+    '''
+    folders = session.get(f'{host}/rest/config/folders', verify=False).json()
+    return {f['id']: Path(f['path']).expanduser() for f in folders}
+
+
+def resolve_folders(paths: List[CopyPath], folders: Dict[str, Path]):
     '''
-    Get a list of events with id greater than 'since'
+    Set the syncthing folder of each copy path that doesn't have one, to the
+    folder that its src is in
+
+    Args:
+        paths:   The copy paths
+        folders: A map of folder ID to the path of the folder
+    '''
+    for path in paths:
+        if path.folder is None:
+            matches = [id for id, root in folders.items() if path.src == root or root in path.src.parents]
+            if matches:
+                path.folder = max(matches, key=lambda id: len(folders[id].parts))
+            else:
+                logger.warning(f'{path.src} is not in a syncthing folder. It will only be copied when reconciling')
+        elif path.folder not in folders:
+            logger.warning(f'Unknown syncthing folder {path.folder} for {path.src}')
+
+
+def get_events_since(session: requests.Session, host: str, since: int, timeout: int):
+    '''
+    Get a list of events with id greater than 'since'. This is a long poll,
+    so syncthing holds the request open until there is an event, or the
+    timeout expires.
 
     Args:
         session: An active requests session
         host:    The host/port of the syncthing API
         since:   The since value to pass the the API
+        timeout: The maximum number of seconds to wait for an event
 
     Returns:
         The events that were found
     '''
-    url = f'{host}/rest/events?events=LocalIndexUpdated&since={since}'
-    return session.get(url, verify=False).json()
+    url = f'{host}/rest/events?events=LocalIndexUpdated&since={since}&timeout={timeout}'
+    return session.get(url, verify=False, timeout=timeout + HTTP_TIMEOUT_MARGIN).json()
+
+
+def get_start_time(session: requests.Session, host: str) -> str:
+    '''
+    Get the time that syncthing was started
+
+    Args:
+        session: An active requests session
+        host:    The host/port of the syncthing API
+
+    Returns:
+        The start time, as reported by syncthing
+    '''
+    return session.get(f'{host}/rest/system/status', verify=False, timeout=HTTP_TIMEOUT_MARGIN).json()['startTime']
 
 
-def event_generator(host: str):
+def event_generator(session: requests.Session, host: str, timeout: int = 60, debounce: int = 5):
     '''
-    Generator for syncthing LocalIndexUpdated events
+    Generator for syncthing LocalIndexUpdated events. Events that arrive
+    within the debounce window of each other are yielded as a single batch,
+    so a burst of syncs is copied and processed together.
 
     Args:
-        host: The host/port of the syncthing API
+        session:  An active requests session
+        host:     The host/port of the syncthing API
+        timeout:  The number of seconds to wait for events in each request
+        debounce: The number of seconds without an event that ends a batch
 
     Yields:
-        The events that were found
+        A tuple of the batch of events, and whether events may have been
+        missed before it
     '''
-    session = requests.Session()
-    session.headers['X-API-Key'] = os.environ['SYNCTHING_API_KEY']
     since = 0
+    start_time = get_start_time(session, host)
+    missed = False
     while True:
-        # We continually poll the syncthing API for LocalIndexUpdated events.
-        # The 'since' parameter can be used to only get events with an ID greater
-        # than the since value. However, if syncthing is restarted, then the ids
-        # are reset. So if we dont see any events, then check with a since value
-        # 1 less. If we still dont see any events, then the ids must have been
-        # reset, so restart our since value.
-        events = get_events_since(session, host, since)
-        if not events and since > 0:
-            # No events found, check that the ids haven't been reset
-            if not get_events_since(session, host, since - 1):
+        events = get_events_since(session, host, since, timeout)
+        if not events:
+            # The long poll timed out. If syncthing was restarted, then the ids
+            # have been reset, and the events since the restart have ids lower
+            # than ours, so restart our since value.
+            if since > 0 and (current := get_start_time(session, host)) != start_time:
                 logger.warning('Detected event id reset')
+                start_time = current
                 since = 0
+                missed = True
             continue
-        logger.debug(f'Found {len(events)} syncthing events: {events}')
-        since = events[-1]['id']
-        yield events
+
+        # Keep collecting events until there is a quiet period, but don't
+        # hold the first event for longer than a long poll
+        batch = []
+        deadline = time.monotonic() + timeout
+        while events:
+            # A full response may have overflowed syncthing's buffer
+            missed = missed or len(events) >= EVENT_BUFFER_SIZE
+            batch += events
+            since = events[-1]['id']
+            if time.monotonic() >= deadline:
+                break
+            events = get_events_since(session, host, since, debounce)
+
+        logger.debug('Found %d syncthing events: %s', len(batch), batch)
+        yield batch, missed
+        missed = False
+
+
+def events_incomplete(events: List[Dict]) -> bool:
+    '''
+    Check if any events in a batch don't name all the files that changed, so
+    they aren't enough to know what to copy
+
+    Args:
+        events: The batch of events
+
+    Returns:
+        True if any files may be missing from the events
+    '''
+    return any(len(e['data'].get('filenames') or []) < e['data'].get('items', 0) for e in events)
+
+
+def needs_copy(path: CopyPath, rel: Path, index: SyncIndex) -> bool:
+    '''
+    Check if a file needs to be copied from the src to the dst of a copy path
+
+    Args:
+        path:  The copy path
+        rel:   The path of the file, relative to src
+        index: The index of the files in each dst
+
+    Returns:
+        True if the file should be copied
+    '''
+    if path.exclude is not None and re.search(path.exclude, (path.src / rel).as_posix()):
+        return False
+    if (path.dst / rel).exists():
+        # Not indexed yet, eg. it was added to the dst by something else
+        index.add(path.dst, [rel])
+        return False
+    return True
 
 
-def copy_files(paths: List[CopyPath], dry_run: bool) -> List[Path]:
+def copy_all(copies: List[Tuple[CopyPath, Path]], index: SyncIndex, dry_run: bool, workers: int) -> Dict[Path, Optional[CopiedFile]]:
     '''
-    Copy files from src to dst in the paths
+    Copy files from the src to the dst of their copy paths, in parallel
+
+    Args:
+        copies:  The copy path and the path relative to src of each file
+        index:   The index of the files in each dst
+        dry_run: Log the copies, but don't make them
+        workers: The number of files to copy at once
+
+    Returns:
+        A map of the path of each new file to the result of the copy (None on a dry run)
+    '''
+    for path, rel in copies:
+        logger.info('Copying %s to %s', path.src / rel, path.dst / rel)
+    if dry_run:
+        return {path.dst / rel: None for path, rel in copies}
+
+    for parent in {(path.dst / rel).parent for path, rel in copies}:
+        os.makedirs(parent, exist_ok=True)
+    copied = parallel_copy([(path.src / rel, path.dst / rel) for path, rel in copies], workers)
+    for path, rel in copies:
+        if path.dst / rel in copied:
+            index.add(path.dst, [rel])
+    return dict(copied)
+
+
+def copy_files(paths: List[CopyPath], index: SyncIndex, dry_run: bool, workers: int, rescan: bool = False) -> Dict[Path, Optional[CopiedFile]]:
+    '''
+    Reconcile each src with its dst, and copy any files that are missing
 
     Args:
         paths:   The list of paths to copy
-        dry_run: Do a dry run on rsync
+        index:   The index of the files in each dst
+        dry_run: Log the copies, but don't make them
+        workers: The number of files to copy at once
+        rescan:  Walk each dst to rebuild its index, rather than trusting it
 
     Returns:
-        The list of files that were copied
+        A map of the path of each new file to the result of the copy (None on a dry run)
     '''
-    new_files: List[Path] = []
+    copies: List[Tuple[CopyPath, Path]] = []
     for path in paths:
+        dst_files = index.get(path.dst)
+        if rescan or not dst_files:
+            logger.info(f'Indexing {path.dst}')
+            dst_files = {f.relative_to(path.dst) for f in path.dst.rglob(path.glob)}
+            index.replace(path.dst, dst_files)
         src_files = {f.relative_to(path.src) for f in path.src.rglob(path.glob)}
-        dst_files = {f.relative_to(path.dst) for f in path.dst.rglob(path.glob)}
-
-        diff = src_files - dst_files
-        exclude = re.compile(path.exclude) if path.exclude is not None else None
-        for f in diff:
-            src = path.src / f
-            dst = path.dst / f
-            if exclude is not None and exclude.search(src.as_posix()):
+        copies += [(path, f) for f in src_files - dst_files if needs_copy(path, f, index)]
+
+    return copy_all(copies, index, dry_run, workers)
+
+
+def copy_changed_files(paths: List[CopyPath], folders: Dict[str, Path], events: List[Dict], index: SyncIndex, dry_run: bool, workers: int) -> Dict[Path, Optional[CopiedFile]]:
+    '''
+    Copy only the files named in a batch of LocalIndexUpdated events
+
+    Args:
+        paths:   The list of paths to copy
+        folders: A map of folder ID to the path of the folder
+        events:  The events
+        index:   The index of the files in each dst
+        dry_run: Log the copies, but don't make them
+        workers: The number of files to copy at once
+
+    Returns:
+        A map of the path of each new file to the result of the copy (None on a dry run)
+    '''
+    changed: Dict[str, Set[str]] = {}
+    for event in events:
+        changed.setdefault(event['data']['folder'], set()).update(event['data'].get('filenames') or [])
+
+    copies: List[Tuple[CopyPath, Path]] = []
+    for path in paths:
+        if path.folder not in folders:
+            continue
+        root = folders[path.folder]
+        for name in changed.get(path.folder, ()):
+            src = root / name
+            if path.src != root and path.src not in src.parents:
                 continue
-            logger.info(f'Copying {src} to {dst}')
-            if not dry_run:
-                os.makedirs(dst.parent, exist_ok=True)
-                shutil.copy2(src, dst)
-            new_files.append(dst)
+            rel = src.relative_to(path.src)
+            if not rel.match(path.glob) or index.contains(path.dst, rel) or not src.is_file():
+                # Not a match, already copied, or it was a deletion
+                continue
+            if needs_copy(path, rel, index):
+                copies.append((path, rel))
 
-    return new_files
+    return copy_all(copies, index, dry_run, workers)
 
 
 def parse_args():  # pragma: no cover
@@ -188,12 +384,18 @@ def parse_args():  # pragma: no cover
         description=__doc__,
         formatter_class=argparse.RawTextHelpFormatter
     )
+    parser.add_argument('-b', '--debounce', type=int, default=5, help='Seconds without a sync event that ends a batch of events')
     parser.add_argument('-d', '--debug', action='store_true', help='Enable debug logging')
     parser.add_argument('-e', '--env', required=True, type=str, help='Path to .env file')
     parser.add_argument('-H', '--host', required=True, type=str, help='Host/port of syncthing API')
+    parser.add_argument('-i', '--index', required=True, type=str, help='Path to the index of copied files (a SQLite database)')
     parser.add_argument('-l', '--log-file', required=True, type=str, help='Path to log file')
     parser.add_argument('-n', '--ncpu', type=int, default=2, help='Number of threads to run')
+    parser.add_argument('-p', '--poll-timeout', type=int, default=60, help='Seconds to wait for events in each request to syncthing')
     parser.add_argument('-r', '--dry-run', action='store_true', help='Don\'t make any changes. Log changes that would ba made')
+    parser.add_argument('--copy-workers', type=int, default=4, help='Number of files to copy at once')
+    parser.add_argument('--log-json', action='store_true', help='Write the log as JSON lines')
+    parser.add_argument('--reconcile-interval', type=int, default=86400, help='Seconds between full rescans of the dst paths')
     parser.add_argument('paths', type=str, help='path to a file containing a JSON list of paths to copy')
 
     args = parser.parse_args()
@@ -214,16 +416,40 @@ def main(args: argparse.Namespace):  # pragma: no cover
     if args.env:
         load_dotenv(args.env)
 
-    init_logger(args.log_file, args.debug)
+    init_logger(args.log_file, args.debug, json_format=args.log_json)
+    # The database is only opened once files are copied, so check this up front
+    try:
+        get_timezone()
+    except ValueError as e:
+        logger.error('%s', e)
+        return 1
     processor = MediaProcessor(args.ncpu, args.dry_run)
     copy_paths = read_paths(args.paths)
+    index = SyncIndex(args.index)
+    last_rescan = time.monotonic()
 
     while True:
         try:
-            for _ in event_generator(args.host):
-                new_files = copy_files(copy_paths, args.dry_run)
+            session = create_session()
+            folders = get_folders(session, args.host)
+            resolve_folders(copy_paths, folders)
+
+            # Pick up anything that was sync'd while we weren't listening
+            new_files = copy_files(copy_paths, index, args.dry_run, args.copy_workers)
+            with db.open():
+                processor.run(list(new_files), {p: c for p, c in new_files.items() if c is not None})
+
+            for events, missed in event_generator(session, args.host, args.poll_timeout, args.debounce):
+                if time.monotonic() - last_rescan > args.reconcile_interval:
+                    new_files = copy_files(copy_paths, index, args.dry_run, args.copy_workers, rescan=True)
+                    last_rescan = time.monotonic()
+                elif missed or events_incomplete(events):
+                    logger.info('Events may have been missed. Reconciling all paths')
+                    new_files = copy_files(copy_paths, index, args.dry_run, args.copy_workers)
+                else:
+                    new_files = copy_changed_files(copy_paths, folders, events, index, args.dry_run, args.copy_workers)
                 with db.open():
-                    processor.run(new_files)
+                    processor.run(list(new_files), {p: c for p, c in new_files.items() if c is not None})
         except KeyboardInterrupt:
             logger.info('Caught keyboard interrupt. Exiting')
             break